@@ -0,0 +1,176 @@
+"""
+The event loop annotations run on.
+
+Every annotation call of the process runs as a task on one event loop, kept on
+a background thread, so that LLM requests are awaited instead of holding an OS
+thread each. The sync api submits to the loop and waits for the result, from
+any thread (but not from the loop thread itself, use `await f.acall(...)` there).
+Calls awaited on another loop, e.g. under `asyncio.run`, are moved to it too.
+
+Each backend has a semaphore bounding its requests in flight, set with
+<BACKEND>_CONCURRENCY, e.g. OPENAI_CONCURRENCY=2000:
+
+    openai    1024   AsyncOpenAI
+    vLLM         8   ssh to the vLLM endpoint
+    human        1   input() on the terminal
+    jena        64   sparql queries and updates
+    render      64   templates rendered at once, per nesting depth
+
+Blocking work (jena, mastodon, ssh) runs on AIO_THREADS threads (256 by default)
+of the loop. Templates are rendered on threads of their own instead: rendering
+blocks on the dependencies that were not prefetched, whose calls need threads of
+the loop and renders of their own, so renders holding pool threads could starve
+the pool and hang. Each nesting depth has a pool of RENDER_CONCURRENCY threads:
+renders only wait on renders one level deeper, so a chain of renders always gets
+to finish, and a render that gathers many dependencies does not start a thread
+for each.
+"""
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+import contextlib
+import contextvars
+import functools
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+AIO_THREADS = int(os.getenv("AIO_THREADS", 256))
+DEFAULT_CONCURRENCY = {
+    "openai": 1024,
+    "vLLM": 8,
+    "human": 1,
+    "jena": 64,
+    "render": 64,
+}
+
+_LOOP: asyncio.AbstractEventLoop | None = None
+_THREAD: threading.Thread | None = None
+_LOOP_LOCK = threading.Lock()
+_SEMAPHORES: dict[str, asyncio.Semaphore] = {}
+_RENDER_EXECUTORS: dict[int, ThreadPoolExecutor] = {}
+# how many renders a call is nested in, set in render threads and so in the calls made from them
+_RENDER_DEPTH: contextvars.ContextVar[int] = contextvars.ContextVar("render_depth", default=0)
+
+
+def concurrency(backend: str) -> int | None:
+    value = os.getenv(f"{backend.upper()}_CONCURRENCY")
+    if value is not None:
+        return int(value)
+    return DEFAULT_CONCURRENCY.get(backend)
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    global _LOOP, _THREAD
+    with _LOOP_LOCK:
+        if _LOOP is None:
+            loop = asyncio.new_event_loop()
+            loop.set_default_executor(ThreadPoolExecutor(max_workers=AIO_THREADS, thread_name_prefix="aio"))
+            started = threading.Event()
+
+            def serve():
+                asyncio.set_event_loop(loop)
+                loop.call_soon(started.set)
+                loop.run_forever()
+
+            _THREAD = threading.Thread(target=serve, name="annotation-loop", daemon=True)
+            _THREAD.start()
+            started.wait()
+            _LOOP = loop
+        return _LOOP
+
+def _reset_after_fork():
+    # the loop thread does not survive a fork, children start their own
+    global _LOOP, _THREAD, _LOOP_LOCK
+    _LOOP = None
+    _THREAD = None
+    _LOOP_LOCK = threading.Lock()
+    _SEMAPHORES.clear()
+    _RENDER_EXECUTORS.clear()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def on_loop_thread() -> bool:
+    return _THREAD is not None and threading.current_thread() is _THREAD
+
+def submit(coroutine_f, *args, **kwargs) -> Future:
+    """
+    Starts coroutine_f(*args, **kwargs) on the loop, in a copy of the caller's context.
+    """
+    loop = get_loop()
+    context = contextvars.copy_context()
+    future = Future()
+
+    def start():
+        task = loop.create_task(coroutine_f(*args, **kwargs), context=context)
+
+        def done(task: asyncio.Task):
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception()) # type:ignore
+            else:
+                future.set_result(task.result())
+        task.add_done_callback(done)
+
+    loop.call_soon_threadsafe(start)
+    return future
+
+def run(coroutine_f, *args, **kwargs):
+    """
+    Runs coroutine_f(*args, **kwargs) on the loop and waits for its result.
+    """
+    if on_loop_thread():
+        raise RuntimeError("Blocking on an annotation from the event loop would deadlock it, await acall instead")
+    return submit(coroutine_f, *args, **kwargs).result()
+
+async def on_loop(coroutine_f, *args, **kwargs):
+    """
+    Awaits coroutine_f(*args, **kwargs), moving it to the annotation loop if called from another one.
+    """
+    if asyncio.get_running_loop() is _LOOP:
+        return await coroutine_f(*args, **kwargs)
+    return await asyncio.wrap_future(submit(coroutine_f, *args, **kwargs))
+
+def semaphore(backend: str | None):
+    """
+    The semaphore bounding requests in flight to backend, a no-op if it has no limit.
+    Only used on the loop.
+    """
+    limit = concurrency(backend) if backend is not None else None
+    if limit is None or limit <= 0:
+        return contextlib.nullcontext()
+    if backend not in _SEMAPHORES:
+        _SEMAPHORES[backend] = asyncio.Semaphore(limit) # type:ignore
+    return _SEMAPHORES[backend] # type:ignore
+
+async def to_thread(backend: str | None, f, *args, **kwargs):
+    """
+    Runs the blocking f(*args, **kwargs) on a thread of the loop, within the limit of backend.
+    """
+    async with semaphore(backend):
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(context.run, f, *args, **kwargs))
+
+def _render_executor(depth: int) -> ThreadPoolExecutor:
+    # only used on the loop
+    if depth not in _RENDER_EXECUTORS:
+        limit = concurrency("render")
+        _RENDER_EXECUTORS[depth] = ThreadPoolExecutor(max_workers=limit if limit is not None and limit > 0 else DEFAULT_CONCURRENCY["render"],
+                                                      thread_name_prefix=f"aio-render-{depth}")
+    return _RENDER_EXECUTORS[depth]
+
+async def render(f, *args, **kwargs):
+    """
+    Runs the blocking render f(*args, **kwargs) on a render thread of its nesting depth, see the module docstring.
+    """
+    depth = _RENDER_DEPTH.get()
+    context = contextvars.copy_context()
+
+    def target():
+        _RENDER_DEPTH.set(depth + 1)
+        return f(*args, **kwargs)
+
+    return await asyncio.get_running_loop().run_in_executor(_render_executor(depth), functools.partial(context.run, target))
@@ -4,7 +4,8 @@ import copy
 from datetime import datetime
 from dateutil import tz
 import dateutil
-from annotation import main, post
+import json
+from annotation import batch, main, post
 import logging
 from annotation import api_context_manager, api_context_states
 
@@ -41,7 +42,10 @@ def run_single(args):
         edit = post.Edit.new(args.post_id,  dateutil.parser.parse(args.post_time)) # type:ignore
     overrides = {k: copy.copy(args.args_global) for k in api_context_states.default_supported_annotations()}
     overrides[args.annotation].update(args.args)
-    result = main.annotate(args.annotation, [edit], no_read=args.no_read_from_cache or args.no_cache, no_write=args.no_write_to_cache or args.no_cache, only_cache=args.only_cache, cmdline_args=overrides)
+    if args.plan:
+        print(main.plan(args.annotation, [[edit]], no_read=args.no_read_from_cache or args.no_cache, only_cache=args.only_cache, cmdline_args=overrides, corpus=args.corpus).format())
+        return
+    result = main.annotate(args.annotation, [edit], no_read=args.no_read_from_cache or args.no_cache, no_write=args.no_write_to_cache or args.no_cache, only_cache=args.only_cache, cmdline_args=overrides, corpus=args.corpus)
     print("---")
     print("Question:      ", args.annotation)
     print("Post ID:       ", args.post_id)
@@ -71,7 +75,10 @@ def run_pair(args):
         edit1 = post.Edit.new(args.post1_id,  dateutil.parser.parse(args.post1_time)) # type:ignore
     overrides = {k: copy.copy(args.args_global) for k in api_context_states.default_supported_annotations()}
     overrides[args.annotation].update(args.args)
-    result = main.annotate(args.annotation, [edit0, edit1], no_read=args.no_read_from_cache or args.no_cache, no_write=args.no_write_to_cache or args.no_cache, only_cache=args.only_cache, cmdline_args=overrides)
+    if args.plan:
+        print(main.plan(args.annotation, [[edit0, edit1]], no_read=args.no_read_from_cache or args.no_cache, only_cache=args.only_cache, cmdline_args=overrides, corpus=args.corpus).format())
+        return
+    result = main.annotate(args.annotation, [edit0, edit1], no_read=args.no_read_from_cache or args.no_cache, no_write=args.no_write_to_cache or args.no_cache, only_cache=args.only_cache, cmdline_args=overrides, corpus=args.corpus)
     print("---")
     print("Question:       ", args.annotation)
     print("Post0 ID:       ", args.post0_id)
@@ -110,7 +117,10 @@ def run_triple(args):
         edit2 = post.Edit.new(args.post2_id,  dateutil.parser.parse(args.post2_time)) # type:ignore
     overrides = {k: copy.copy(args.args_global) for k in api_context_states.default_supported_annotations()}
     overrides[args.annotation].update(args.args)
-    result = main.annotate(args.annotation, [edit0, edit1, edit2], no_read=args.no_read_from_cache or args.no_cache, no_write=args.no_write_to_cache or args.no_cache, only_cache=args.only_cache, cmdline_args=overrides)
+    if args.plan:
+        print(main.plan(args.annotation, [[edit0, edit1, edit2]], no_read=args.no_read_from_cache or args.no_cache, only_cache=args.only_cache, cmdline_args=overrides, corpus=args.corpus).format())
+        return
+    result = main.annotate(args.annotation, [edit0, edit1, edit2], no_read=args.no_read_from_cache or args.no_cache, no_write=args.no_write_to_cache or args.no_cache, only_cache=args.only_cache, cmdline_args=overrides, corpus=args.corpus)
     print("---")
     print("Question:       ", args.annotation)
     print("Post0 ID:       ", args.post0_id)
@@ -127,6 +137,31 @@ def run_triple(args):
         print(f"Annotation Timestamp ({LOCAL_TIMEZONE_NAME}):", "null")
         print("Annotation Response:", "null")
 
+def run_fanout(args):
+    # the posts of one call are separated by commas, all of them are loaded together
+    calls = [ids.split(",") for ids in args.post_id or []]
+    mastodon_ids = list(dict.fromkeys(mastodon_id for ids in calls for mastodon_id in ids))
+    latest = dict(zip(mastodon_ids, post.latest_edits(mastodon_ids)))
+    edits = [[latest[mastodon_id] for mastodon_id in ids] for ids in calls]
+    for files in args.post_file or []:
+        edits.append([post.EditFromFile(file) for file in files.split(",")])
+    overrides = {k: copy.copy(args.args_global) for k in api_context_states.default_supported_annotations()}
+    result = main.fan_out(args.question, edits, no_read=args.no_read_from_cache or args.no_cache, no_write=args.no_write_to_cache or args.no_cache, only_cache=args.only_cache, cmdline_args=overrides, corpus=args.corpus, workers=args.workers)
+    if args.json:
+        for record in result.records():
+            print(json.dumps(record))
+    else:
+        print(result.format())
+
+def run_reannotate(args):
+    calls = main.reannotate(args.question, corpus=args.corpus, workers=args.workers, dry_run=args.dry_run)
+    print("---")
+    print("Invalidated calls:", len(calls))
+    for call in calls:
+        print(f"{call.name:<24}", ", ".join(f"{edit.mastodon_id}@{edit.timestamp}" for edit in call.posts), json.dumps(call.kwargs) if call.kwargs else "")
+    print("---")
+    print("Listed only (--dry_run)" if args.dry_run else "Reannotated")
+
 if __name__ == "__main__":
 
     parser  = ArgumentParser(argument_default=None)
@@ -135,6 +170,8 @@ if __name__ == "__main__":
     single = subparsers.add_parser("single", help="annotate a single post")
     pair = subparsers.add_parser("pair", help="annotate a pair of posts")
     triple = subparsers.add_parser("triple", help="annotate a triple of posts")
+    reannotate = subparsers.add_parser("reannotate", help="recompute the cached annotations invalidated by prompt changes")
+    fan = subparsers.add_parser("fanout", help="run several questions or versions on the same posts, side by side")
 
     # single post annotation arguments
     single.add_argument("annotation")
@@ -175,9 +212,31 @@ if __name__ == "__main__":
         subparser.add_argument("--no_write_to_cache", action="store_true")
         subparser.add_argument("--only_cache", action="store_true")
         subparser.add_argument("--no_cache", action="store_true")
+        subparser.add_argument("--corpus", default=api_context_states.DEFAULT_CORPUS)
+        subparser.add_argument("--plan", action="store_true", help="only report cache hits, tokens, cost and time, without calling any LLM")
         subparser.add_argument("--logging_level", choices=["info", "warning", "error", "critical", "debug"], default="warning")
         subparser.add_argument("--args", nargs="*", action=ParseKwargs, default=dict())
         subparser.add_argument("--args_global", nargs="*", action=ParseKwargs, default=dict())
+    # fanout arguments
+    fan.add_argument("--question", nargs="+", required=True, help="questions to compare, e.g. unary_1 distill_1 'rewrite_0_*'")
+    g0 = fan.add_argument_group()
+    g0.add_argument("--post_id", nargs="*", help="posts to annotate, the posts of one call of a pair question are separated by commas")
+    g0.add_argument("--post_file", nargs="*", help="files of posts to annotate, separated by commas like --post_id")
+    fan.add_argument("--json", action="store_true", help="print one json record per posts instead of a table")
+    fan.add_argument("--workers", type=int, default=batch.DEFAULT_WORKERS)
+    fan.add_argument("--no_read_from_cache", action="store_true")
+    fan.add_argument("--no_write_to_cache", action="store_true")
+    fan.add_argument("--only_cache", action="store_true")
+    fan.add_argument("--no_cache", action="store_true")
+    fan.add_argument("--corpus", default=api_context_states.DEFAULT_CORPUS)
+    fan.add_argument("--logging_level", choices=["info", "warning", "error", "critical", "debug"], default="warning")
+    fan.add_argument("--args_global", nargs="*", action=ParseKwargs, default=dict())
+    # reannotate arguments
+    reannotate.add_argument("--question", nargs="*", default=None, help="names of the questions whose annotations to check, e.g. unary_1_0, all by default")
+    reannotate.add_argument("--dry_run", action="store_true", help="only list the invalidated calls")
+    reannotate.add_argument("--workers", type=int, default=batch.DEFAULT_WORKERS)
+    reannotate.add_argument("--corpus", default=api_context_states.DEFAULT_CORPUS)
+    reannotate.add_argument("--logging_level", choices=["info", "warning", "error", "critical", "debug"], default="warning")
     args = parser.parse_args()
 
     logger = logging.getLogger(__name__)
@@ -199,10 +258,16 @@ if __name__ == "__main__":
         raise AssertionError()
 
     if args.subcommand == "single":
-        run_single(args)
+        run = run_single
     elif args.subcommand == "pair":
-        run_pair(args)
+        run = run_pair
     elif args.subcommand == "triple":
-        run_triple(args)
+        run = run_triple
+    elif args.subcommand == "fanout":
+        run = run_fanout
+    elif args.subcommand == "reannotate":
+        run = run_reannotate
     else:
-        raise ValueError(f"Unknown subcommad: {args.subcommand}")
\ No newline at end of file
+        raise ValueError(f"Unknown subcommad: {args.subcommand}")
+    # posts are loaded before entering the annotation context, so they are loaded in a default context with the corpus
+    api_context_states.RunContext.default(corpus=args.corpus).run(run, args)
\ No newline at end of file
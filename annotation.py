@@ -3,14 +3,14 @@ import functools
 import json
 import os
 import re
+import threading
 from typing import Iterable
 import uuid
 from annotation import llm_response 
 import dateutil
 import requests
-import yaml
-from jinja2 import Environment, StrictUndefined
-from annotation import llm_wrapper, utils, api_context_states, cache, post
+from jinja2 import Environment, FileSystemBytecodeCache, StrictUndefined
+from annotation import aio, llm_wrapper, utils, api_context_states, cache, post, prefetch
 import logging
 import builtins
 
@@ -19,6 +19,18 @@ logging.basicConfig(level=logging.INFO)
 
 llm_annot = llm_wrapper.LLMAnnot()
 
+def bytecode_cache():
+    # compiled templates are kept in JINJA_BYTECODE_CACHE, or a per user temp directory by default
+    directory = os.getenv("JINJA_BYTECODE_CACHE")
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+    return FileSystemBytecodeCache(directory)
+
+# one environment for all templates, python builtins are available in every template
+TEMPLATE_ENV = Environment(undefined=StrictUndefined, bytecode_cache=bytecode_cache())
+TEMPLATE_ENV.globals.update(vars(builtins))
+TEMPLATE_ENV.globals["tree_chunks"] = utils.tree_chunks # see summarize.py
+
 @functools.cache
 def indent_template(template):
     doc = []
@@ -27,6 +39,20 @@ def indent_template(template):
         doc.append(re.sub("{{([^{}]*)}}", lambda s: f"{{{{ str({s.group(1)}) | indent({ws})}}}}", line))
     return "\n".join(doc)
 
+# the cache policy only changes where results are kept, not what they are,
+# so its line is left out of the question hash and setting it keeps existing annotations valid
+CACHE_POLICY_LINE = re.compile(r"^cache:\s*\w+\s*(#.*)?$")
+
+def quest_sha256(name: str, major: int, minor: int, documents: list[str]) -> str:
+    spec = "\n".join(line for line in documents[0].splitlines() if not CACHE_POLICY_LINE.match(line))
+    return utils.sha256_hash_by_lines(name, str(major), str(minor), spec, *documents[1:])
+
+# None keys calls by the posts themselves, content by the normalized content of
+# the posts only, and thread by that of the posts and their ancestors.
+DEDUPE_MODES = (None, "content", "thread")
+# jena reads and writes every result, local computes it in process and only keeps it in memory
+CACHE_POLICIES = ("jena", "local")
+
 class Annotation:
 
     def __init__(self, config_path: str, name: str, major: int, minor: int, **cmdline_override_args):
@@ -43,13 +69,19 @@ class Annotation:
         if not len(self.documents) == 2:
             raise ValueError(f"{config_path} does not contain exactly two yaml docs.")
         
-        self.spec = yaml.safe_load(self.documents[0])
+        self.spec = utils.load_yaml(self.documents[0])
         if self.spec is None:
             self.spec = dict()
         self.default_args = self.spec.get("args", dict())
         self.alias = self.spec.get("alias", dict())
+        self.dedupe = self.spec.get("dedupe", None)
+        if self.dedupe not in DEDUPE_MODES:
+            raise ValueError(f"{config_path} declares dedupe: {self.dedupe}, should be one of {DEDUPE_MODES}")
+        self.cache_policy = self.spec.get("cache", "jena")
+        if self.cache_policy not in CACHE_POLICIES:
+            raise ValueError(f"{config_path} declares cache: {self.cache_policy}, should be one of {CACHE_POLICIES}")
         self.cmdline_override_args = cmdline_override_args
-        self._env = Environment(undefined=StrictUndefined)
+        self._env = TEMPLATE_ENV
         self.rendered_last_doc = indent_template(self.documents[-1])
         
     def _get_overidden_args(self, **caller_override_args):
@@ -62,27 +94,91 @@ class Annotation:
             raise e
         return args
 
+    def _call_args(self, caller_override_args) -> dict:
+        """
+        The args the call overrides, by the caller or on the command line, which
+        repeat the call with the same args (see invalidation.py).
+        """
+        call_args = utils.nested_copy_dict(caller_override_args)
+        utils.nested_update_dict(call_args, self.cmdline_override_args, allow_new=True)
+        return call_args
+
     def _augment_args_for_interpolation(self, *posts, **args):
         interpolation_args = utils.nested_copy_dict(args)
         for i, post in enumerate(posts):
             interpolation_args[f"post{i}"] = post
         return interpolation_args
 
+    def _post_keys(self, posts) -> tuple[str, ...]:
+        # computing them may fetch the posts, see _apost_keys
+        if self.dedupe is None:
+            return tuple(p.sha256 for p in posts)
+        return tuple(f"content:{post.content_key(p, with_ancestors=self.dedupe == 'thread')}" for p in posts)
+
+    async def _apost_keys(self, posts) -> tuple[str, ...]:
+        if all(post.is_loaded(p, with_ancestors=self.dedupe == "thread") for p in posts):
+            return self._post_keys(posts)
+        # posts that still have to be fetched are fetched off the loop
+        return await aio.to_thread(None, self._post_keys, posts)
+
+    def _hash_args(self, posts, interpolation_args, post_keys=None):
+        """
+        The args that define the call hash. Posts are stringified to their content by
+        sha256_call, for deduplicated questions they are replaced by their content keys.
+        """
+        if self.dedupe is None:
+            return interpolation_args
+        hash_args = dict(interpolation_args)
+        for i, key in enumerate(post_keys if post_keys is not None else self._post_keys(posts)):
+            hash_args[f"post{i}"] = key
+        return hash_args
+
+    def _sample_args(self, hash_args) -> tuple[str, int] | tuple[None, None]:
+        """
+        The hash of hash_args without num_answers, and num_answers, if it is an arg. Calls
+        that only differ in num_answers can share samples, see get_cached_samples.
+        """
+        if "num_answers" not in self.default_args:
+            return None, None
+        sample_args = dict(hash_args)
+        num_answers = sample_args.pop("num_answers")
+        return self.sha256_call(sample_args), num_answers
+
+    @functools.cached_property
+    def template(self):
+        # compiled once per annotation, and once per question across processes through the bytecode cache
+        return utils.compile_with_alias(self._env, self.rendered_last_doc, self.alias, name=self.sha256_quest)
+
+    @functools.cached_property
+    def references(self):
+        # the dependencies that can be read off the template, see prefetch.py
+        return prefetch.parse_references(self._env, self.rendered_last_doc, self.alias)
+
     def _render_jinja2(self, *posts, **interpolation_args):
         interpolation_args_aliased = utils.nested_copy_dict(interpolation_args)
         interpolation_args_aliased["post"] = posts[0]
         interpolation_args_aliased[f"posts"] = posts
-        for name in dir(builtins):
-            interpolation_args_aliased[name] = getattr(builtins, name)
-        s = utils.render_with_alias(self._env, self.rendered_last_doc, self.alias, **interpolation_args_aliased)
+        s = self.template.render(**interpolation_args_aliased)
         return s
 
-    def _execute_prompt(self, annotation_args, override_args):
+    def _merge_args(self, annotation_args, override_args):
         default_method = annotation_args.get("method", "openai")
         if default_method == "static" and "method" in override_args:
             # static methods cannot be overriden
             del override_args["method"]
         annotation_args.update(override_args) # override with args, which has precedence order file -> caller -> cmdline
+        return annotation_args
+
+    async def _execute_prompt(self, annotation_args, override_args, samples=None):
+        default_method = annotation_args.get("method", "openai")
+        self._merge_args(annotation_args, override_args)
+        # cached samples of the same call with fewer num_answers, only the missing ones are asked for
+        # (top logprobs of max_tokens 1 questions cannot be completed that way)
+        extend = samples is not None and default_method in {"openai", "vLLM"} and annotation_args.get("max_tokens") != 1
+        if extend:
+            response, covered = samples
+            logger.info(f"Reusing {covered} cached samples, asking for {annotation_args['num_answers'] - covered} more")
+            annotation_args["num_answers"] -= covered
         logger.info(f"Annot args: {json.dumps(annotation_args, indent=2, sort_keys=True)}")
         if default_method == "openai":
             logger.debug(f"Pretty dialogue:\n")
@@ -91,60 +187,121 @@ class Annotation:
                     msg_content = "\n\t> " + msg_content.replace('\n', '\n\t > ')
                     logger.debug(f"{role}: {msg_content}")
         method = annotation_args.pop("method", "openai")
-        response = llm_annot.get_responses(method, **annotation_args) 
+        request_hash = None
+        mode = api_context_states.get_request_cache()
+        # a request for more samples is the request of the cached samples again, which must not be
+        # answered with those same samples
+        if not extend and (mode == "always" or (mode == "deterministic" and annotation_args.get("temperature") == 0)):
+            request_hash = llm_annot.request_hash(method, **annotation_args)
+        response = None
+        if request_hash is not None and api_context_states.get_read_cache():
+            # another question, or version, may have sent the very same request
+            response = await aio.to_thread("jena", get_cached_request, request_hash)
+        if response is None:
+            response = await llm_annot.aget_responses(method, **annotation_args)
+        if extend:
+            response = samples[0].merged(response, offset=samples[1])
+        else:
+            # the merged samples answer another request than the one sent
+            response.request_hash = request_hash # type:ignore
         response.timestamp = str(datetime.now(timezone.utc)) # type:ignore
         return response
 
-    def __call__(self, *posts: post.Edit, **caller_override_args):
-        # bookkeeping for logging recursive dependencies
-        call_stack = api_context_states.get_call_stack()
-        call_stack.enter(name=self.name, major=self.major, minor=self.minor, sha256=self.sha256_quest)
-
-        # logging info
-        post_str = '\n> '.join([repr(post) for post in posts])
-        logger.info(f"\n\n> {self.name}_{self.major}{f'({self.parsed_major})' if self.major is None else ''}_{self.minor}{f'({self.parsed_minor})' if self.major is None else ''}  called on \n> {post_str}\n")
-
-        ##### Step 0: assemble arguments and see if cache hit #####
-        args = self._get_overidden_args(**caller_override_args)
-        interpolation_args = self._augment_args_for_interpolation(*posts, **args)
-
-        # we hash here
-        ##### lookup from cache ####
-        thread_cache = api_context_states.get_result_cache()
-        if (self.sha256_quest, *tuple(posts), *sorted(caller_override_args.items())) in thread_cache:
-            cached_response = thread_cache[(self.sha256_quest, *tuple(posts), *sorted(caller_override_args.items()))]
-            logger.info(f"returning memory cached response from {cached_response.timestamp}") # type:ignore
-            return cached_response
-        if api_context_states.get_read_cache():
-            cached_response, dependencies, quest = self.get_cached_annotation(interpolation_args)
-            
+    def _memory_key(self, post_keys, caller_override_args):
+        """
+        Key of the process-wide memory cache. Results are only shared between runs against
+        the same servers with the same cache flags, and not at all when the cache is not read.
+        """
+        context = api_context_states.get_run_context()
+        scope = (context.mastodon_url, context.corpus, context.rdf_uri, context.read_cache, context.write_cache, context.only_cache)
+        if not context.read_cache:
+            scope += (context.run_id,)
+        overrides = json.dumps([self.cmdline_override_args, caller_override_args], sort_keys=True, default=str)
+        return (scope, self.sha256_quest, overrides, *post_keys)
+
+    async def _resolve(self, posts, args, interpolation_args, hash_args, call_stack, caller_override_args):
+        # returns the response with the question and dependencies it was computed with
+        local = self.cache_policy == "local"
+        samples, covered = None, 0
+        if api_context_states.get_read_cache() and not local:
+            cached_response, dependencies, quest = await aio.to_thread("jena", self.get_cached_annotation, hash_args)
             if cached_response is not None:
                 logger.info(f"returning jena cached response from {cached_response.timestamp}") # type:ignore
-                call_stack.current.dependencies = dependencies
-                call_stack.current.major = quest.major # type:ignore
-                call_stack.current.minor = quest.minor # type:ignore
-                call_stack.current.sha256 = quest.sha256 # type:ignore
-                call_stack.exit()
-                thread_cache[(self.sha256_quest, *tuple(posts), *sorted(caller_override_args.items()))] = cached_response
-                return cached_response
+                return cached_response, quest, dependencies
+            samples, dependencies, quest, covered = await aio.to_thread("jena", self.get_cached_samples, hash_args)
+            if samples is not None and covered >= hash_args["num_answers"]:
+                logger.info(f"returning {hash_args['num_answers']} of {covered} jena cached samples from {samples.timestamp}") # type:ignore
+                return samples, quest, dependencies
             elif api_context_states.get_only_cache():
                 # if only cache mode and result not in cache, return None
-                thread_cache[(self.sha256_quest, *tuple(posts), *sorted(caller_override_args.items()))] = None
-                call_stack.exit()
-                return None
+                return None, None, None
 
- 
         ##### Step 1: call JINJA2 to fill in templated called to LLM  #####
-        yaml_s = self._render_jinja2(*posts, **interpolation_args)
-        annotation_args = yaml.safe_load(yaml_s) # lowest priority parameters (even compared to the args listed at the top)
+        await prefetch.prefetch(self.references, posts, interpolation_args)
+        try:
+            # rendering blocks on the dependencies that could not be resolved beforehand, so it runs off the loop
+            yaml_s = await aio.render(self._render_jinja2, *posts, **interpolation_args)
+        except Exception as e:
+            if local and api_context_states.get_only_cache():
+                # the dependencies it needs are not cached
+                logger.info(f"{self.name} cannot be computed from the cache only: {e}")
+                return None, None, None
+            raise
+        annotation_args = utils.load_yaml(yaml_s) # lowest priority parameters (even compared to the args listed at the top)
 
         ##### Step 2: call the LLM using arguments defined in the yaml file #####
-        response = self._execute_prompt(annotation_args, args)
-        if api_context_states.get_write_cache():
-            self.cache_annotation(posts, interpolation_args, response, call_stack.current.dependencies) # type: ignore
-        thread_cache[(self.sha256_quest, *tuple(posts), *sorted(caller_override_args.items()))] = response
-        call_stack.exit()
-        return response
+        response = await self._execute_prompt(annotation_args, args, samples=(samples, covered) if samples is not None else None)
+        if api_context_states.get_write_cache() and local:
+            # not cached, but annotations that depend on it refer to the question
+            await aio.to_thread("jena", cache_question, self)
+        elif api_context_states.get_write_cache():
+            await aio.to_thread("jena", self.cache_annotation, posts, hash_args, response, call_stack.current.dependencies, call_args=self._call_args(caller_override_args))
+        current = call_stack.current
+        return response, utils.Quest(name=current.name, major=current.major, minor=current.minor, sha256=current.sha256), current.dependencies
+
+    def __call__(self, *posts: post.Edit, **caller_override_args):
+        # runs acall on the annotation event loop and waits for it, see aio.py
+        return aio.run(self.acall, *posts, **caller_override_args)
+
+    async def acall(self, *posts: post.Edit, **caller_override_args):
+        if not aio.on_loop_thread():
+            return await aio.on_loop(self.acall, *posts, **caller_override_args)
+        # bookkeeping for logging recursive dependencies
+        call_stack = api_context_states.get_call_stack()
+        call_stack.enter(name=self.name, major=self.major, minor=self.minor, sha256=self.sha256_quest)
+        try:
+            # logging info
+            post_str = '\n> '.join([repr(post) for post in posts])
+            logger.info(f"\n\n> {self.name}_{self.major}{f'({self.parsed_major})' if self.major is None else ''}_{self.minor}{f'({self.parsed_minor})' if self.major is None else ''}  called on \n> {post_str}\n")
+
+            ##### Step 0: assemble arguments and see if cache hit #####
+            args = self._get_overidden_args(**caller_override_args)
+            interpolation_args = self._augment_args_for_interpolation(*posts, **args)
+
+            # we hash here
+            ##### lookup from cache ####
+            # concurrent callers of the same key wait for the first one instead of computing it again
+            post_keys = await self._apost_keys(posts)
+            hash_args = self._hash_args(posts, interpolation_args, post_keys)
+            key = self._memory_key(post_keys, caller_override_args)
+            while True:
+                (response, quest, dependencies), hit = await api_context_states.get_result_cache().aget_or_compute(
+                    key, lambda: self._resolve(posts, args, interpolation_args, hash_args, call_stack, caller_override_args))
+                if not hit or api_context_states.question_hash_set().issuperset(dep.sha256 for dep in dependencies or ()):
+                    break
+                # like the jena lookup, results that depend on questions no longer in the folder are not used
+                logger.info(f"memory cached response of {self.name} depends on questions that changed, recomputing")
+                api_context_states.get_result_cache().discard(key)
+            if hit and response is not None:
+                logger.info(f"returning memory cached response from {response.timestamp}") # type:ignore
+            if quest is not None:
+                call_stack.current.dependencies = list(dependencies)
+                call_stack.current.major = quest.major # type:ignore
+                call_stack.current.minor = quest.minor # type:ignore
+                call_stack.current.sha256 = quest.sha256 # type:ignore
+            return response
+        finally:
+            call_stack.exit()
 
     def render_parse(self, *posts, **caller_override_args):
         post_str = '\n> '.join([repr(post) for post in posts])
@@ -152,7 +309,7 @@ class Annotation:
         args = self._get_overidden_args(**caller_override_args)
         interpolation_args = self._augment_args_for_interpolation(*posts, **args)
         s = self._render_jinja2(*posts, **interpolation_args)
-        annotation_args = yaml.safe_load(s) # lowest priority parameters (even compared to the args listed at the top)
+        annotation_args = utils.load_yaml(s) # lowest priority parameters (even compared to the args listed at the top)
         return annotation_args
 
     def __repr__(self):
@@ -161,27 +318,34 @@ class Annotation:
     def sha256_call(self, args):
         return utils.sha256_hash_by_lines(json.dumps(args, sort_keys=True, default = lambda x: str(x)))
 
-    @property
+    @functools.cached_property
     def sha256_quest(self):
-        return utils.sha256_hash_by_lines(*[self.name, 
-                                            str(self.parsed_major if not self.major else self.major), 
-                                            str(self.parsed_minor if not self.minor else self.minor), 
-                                            *self.documents])
+        return quest_sha256(self.name,
+                            self.parsed_major if not self.major else self.major,
+                            self.parsed_minor if not self.minor else self.minor,
+                            self.documents)
 
-    def cache_annotation(self, edits: Iterable[post.Edit], hash_args: dict, response: llm_response.LLMOutput, dependencies: list[utils.Quest]):
+    def cache_annotation(self, edits: Iterable[post.Edit], hash_args: dict, response: llm_response.LLMOutput, dependencies: list[utils.Quest], call_args: dict | None = None):
         """
         hash_args is the args that define the hash
         annotation_args is the args that was sent to the LLM call
+        call_args is the args the call overrode, kept so that the call can be repeated (see invalidation.py)
 
         We cache by hash_args, even though multiple hash_args may result in the same annotation_args, because we want to be able to
         hit cache without assembing the LLM call, since it's expensive (has to call Jena recursively).
         """
         quest_uri = cache_question(self)
         edit_uris = [cache_edit(edit) for edit in edits]
-        response_uri = response.cache_response()
+        # a response of the same request is linked again rather than copied
+        response_uri = getattr(response, "uri", None) or response.cache_response()
 
-        id = uuid.uuid4()
         sha256 = self.sha256_call(hash_args)
+        namespace = api_context_states.get_run_context().annotation_namespace
+        if namespace is None:
+            id = uuid.uuid4()
+        else:
+            # the same call in the same job is the same annotation, whichever worker writes it
+            id = utils.sha256_hash_by_lines(namespace, sha256, self.sha256_quest)
         post_connections = [[f"annot:{id}", f"annot:post{i}", edit_uri] for i, edit_uri in enumerate(edit_uris)]
         quest_connections = [[f"annot:{id}", f"annot:quest", quest_uri]]
         timestamp_connections = [[f"annot:{id}", "annot:timestamp", utils.sparql_dumps(response.timestamp)]] # type:ignore
@@ -191,16 +355,29 @@ class Annotation:
         commit_connections = [[f"annot:{id}", "annot:git_commit",  utils.sparql_dumps(utils.get_git_revision_hash())],
                             [f"annot:{id}", "annot:git_branch",  utils.sparql_dumps(utils.get_git_branch())]]
         dependency_connections = [[f"annot:{id}", "annot:dep", f"quest:{dep.sha256}"] for dep in dependencies]
-        cache.insert_triples(
-            *(post_connections 
+        call_args_connections = [[f"annot:{id}", "annot:call_args", utils.sparql_dumps(json.dumps(call_args if call_args is not None else {}, sort_keys=True, default=str))]]
+        request_hash = getattr(response, "request_hash", None)
+        request_connections = [[f"annot:{id}", "annot:request_hash", utils.sparql_dumps(request_hash)]] if request_hash is not None else []
+        sample_hash, num_answers = self._sample_args(hash_args)
+        sample_connections = []
+        if sample_hash is not None and isinstance(response, llm_response.LLMOutput):
+            sample_connections = [[f"annot:{id}", "annot:sample_hash", utils.sparql_dumps(sample_hash)],
+                                  [f"annot:{id}", "annot:num_answers", utils.sparql_dumps(num_answers)]]
+        triples = (post_connections 
             + quest_connections 
             + timestamp_connections 
             + response_connections 
             + hash_connections 
             + user_connections
             + commit_connections
-            + dependency_connections)
-        )
+            + dependency_connections
+            + call_args_connections
+            + request_connections
+            + sample_connections)
+        if namespace is None:
+            cache.insert_triples(*triples)
+        else:
+            cache.insert_triples_once(f"annot:{id}", *triples)
         return f"annot:{id}"
 
         
@@ -217,6 +394,35 @@ class Annotation:
                 return None, None, None
         return None, None, None
 
+    def cached_call_hashes(self, sha256s: Iterable[str]) -> set[str]:
+        """
+        Which of the call hashes have a cached annotation that get_cached_annotation would return,
+        checked in bulk.
+        """
+        sha256s = sorted(set(sha256s))
+        out = set()
+        for i in range(0, len(sha256s), 500):
+            command = f"""
+            SELECT DISTINCT ?call_hash WHERE {{ 
+                ?annot annot:resp ?resp .
+                ?annot annot:call_hash ?call_hash .
+                VALUES ?call_hash {{ {" ".join(utils.sparql_dumps(h) for h in sha256s[i:i + 500])} }}
+                ?annot annot:quest ?quest .
+                ?quest quest:name "{self.name}" .
+                {("?quest quest:major " + str(self.major) + " .") if self.major is not None else ""}
+                {("?quest quest:minor " + str(self.minor) + " .") if self.minor is not None else ""}
+                ?quest quest:hash ?qhash .
+                VALUES ?qhash {{ {api_context_states.question_hashes_sparql(" ")} }}
+                FILTER NOT EXISTS {{
+                    ?annot annot:dep ?quest_dep .
+                    ?quest_dep quest:hash ?qdep_hash .
+                    FILTER (?qdep_hash NOT IN ({api_context_states.question_hashes_sparql(", ")}))
+                }}
+            }}
+            """
+            out.update(binding["call_hash"]["value"] for binding in cache.get_bindings(command))
+        return out
+
     def get_response_uri_and_timestamp_by_annotation_hash(self, hash_args:dict, method="latest") -> tuple[str, str, list[utils.Quest], utils.Quest] | tuple[None, None, None, None]:
         sha256 = self.sha256_call(hash_args)
         command = f"""
@@ -254,9 +460,15 @@ class Annotation:
                                 dateutil.parser.parse(binding["time"]["value"]))) # type:ignore
             else:
                 raise NotImplementedError(f"list resolution method not implemented: {method}")
+        return (binding["resp"]["value"], 
+                binding["time"]["value"], 
+                self._dependencies(binding["annot"]["value"]),
+                utils.Quest(name=self.name, major=int(binding["major"]["value"]), minor=int(binding["minor"]["value"]), sha256=binding["qhash"]["value"]))
+
+    def _dependencies(self, annot_uri: str) -> list[utils.Quest]:
         dependencies_command = f"""
         SELECT * WHERE {{
-            <{binding["annot"]["value"]}> annot:dep ?quest_dep .
+            <{annot_uri}> annot:dep ?quest_dep .
             ?quest_dep quest:name ?name .
             ?quest_dep quest:major ?major .
             ?quest_dep quest:minor ?minor .
@@ -264,13 +476,59 @@ class Annotation:
         }}
         """
         dependencies_bindings = cache.get_bindings(dependencies_command)
-        return (binding["resp"]["value"], 
-                binding["time"]["value"], 
-                [utils.Quest(name=b["name"]["value"],
+        return [utils.Quest(name=b["name"]["value"],
                     major=int(b["major"]["value"]), 
                     minor=int(b["minor"]["value"]),
-                    sha256=b["hash"]["value"]) for b in dependencies_bindings],
-                utils.Quest(name=self.name, major=int(binding["major"]["value"]), minor=int(binding["minor"]["value"]), sha256=binding["qhash"]["value"]))
+                    sha256=b["hash"]["value"]) for b in dependencies_bindings]
+
+    def get_cached_samples(self, hash_args: dict) -> tuple[llm_response.LLMOutput, list[utils.Quest], utils.Quest, int] | tuple[None, None, None, int]:
+        """
+        Cached samples of the same call with another num_answers: the smallest cached set that covers
+        num_answers, truncated to it, or else the largest one, with how many samples it was asked for.
+        Samples are only shared between annotations of the same question file.
+        """
+        sample_hash, num_answers = self._sample_args(hash_args)
+        if sample_hash is None:
+            return None, None, None, 0
+        command = f"""
+        SELECT ?annot ?resp ?time ?n WHERE {{ 
+            ?annot annot:resp ?resp .
+            ?annot annot:sample_hash "{sample_hash}" .
+            ?annot annot:num_answers ?n .
+            ?annot annot:timestamp ?time .
+            ?annot annot:quest ?quest .
+            ?quest quest:hash "{self.sha256_quest}" .
+            FILTER NOT EXISTS {{
+                ?annot annot:dep ?quest_dep .
+                ?quest_dep quest:hash ?qdep_hash .
+                FILTER (?qdep_hash NOT IN ({api_context_states.question_hashes_sparql(", ")}))
+            }}
+        }}
+        """
+        bindings = cache.get_bindings(command)
+        if not bindings:
+            return None, None, None, 0
+        latest = lambda b: dateutil.parser.parse(b["time"]["value"])
+        covering = [b for b in bindings if int(b["n"]["value"]) >= num_answers]
+        if covering:
+            # the fewest samples that cover the call, the latest of those
+            binding = min(covering, key=lambda b: (int(b["n"]["value"]), -latest(b).timestamp()))
+        else:
+            binding = max(bindings, key=lambda b: (int(b["n"]["value"]), latest(b)))
+        covered = int(binding["n"]["value"])
+        try:
+            response = llm_response.get_cached_response(f"<{binding['resp']['value']}>")
+        except llm_response.OutdatedCacheImplementationException:
+            return None, None, None, 0
+        if not isinstance(response, llm_response.LLMOutput):
+            return None, None, None, 0
+        if covered >= num_answers:
+            response = response.truncated(num_answers)
+            if response is None:
+                return None, None, None, 0
+        response.timestamp = binding["time"]["value"] # type:ignore
+        quest = utils.Quest(name=self.name, major=self.parsed_major, minor=self.parsed_minor, sha256=self.sha256_quest)
+        return response, self._dependencies(binding["annot"]["value"]), quest, covered
 
 class BoundAnnotation:
 
@@ -320,17 +578,49 @@ def cache_edit(edit: post.Edit):
     )
     return f"post:{sha256}"
 
+_CACHED_QUESTIONS = set()
+_CACHED_QUESTIONS_LOCK = threading.Lock()
+
 def cache_question(annot: Annotation):
     sha256 = annot.sha256_quest
+    # the triples of a question never change, so they are written once per process and store
+    key = (api_context_states.get_rdf_uri(), sha256)
+    with _CACHED_QUESTIONS_LOCK:
+        if key in _CACHED_QUESTIONS:
+            return f"quest:{sha256}"
     cache.insert_triples(
         [f"quest:{sha256}", "quest:name",  utils.sparql_dumps(annot.name)],
         [f"quest:{sha256}", "quest:major", annot.major if annot.major is not None else annot.parsed_major],
         [f"quest:{sha256}", "quest:minor", annot.minor if annot.minor is not None else annot.parsed_minor],
         [f"quest:{sha256}", "quest:hash",  utils.sparql_dumps(sha256)],
     )
+    with _CACHED_QUESTIONS_LOCK:
+        _CACHED_QUESTIONS.add(key)
     return f"quest:{sha256}"
 
 
-
-
-    
\ No newline at end of file
+def get_cached_request(request_hash: str) -> llm_response.LLMOutput | None:
+    """
+    The latest cached response of an annotation that sent the request with this hash (see
+    LLMAnnot.request_hash), whatever its question, or None.
+    """
+    command = f"""
+    SELECT ?resp ?time WHERE {{
+        ?annot annot:request_hash "{request_hash}" .
+        ?annot annot:resp ?resp .
+        ?annot annot:timestamp ?time .
+    }}
+    """
+    bindings = cache.get_bindings(command)
+    if not bindings:
+        return None
+    binding = max(bindings, key=lambda b: dateutil.parser.parse(b["time"]["value"])) # type:ignore
+    try:
+        response = llm_response.get_cached_response(f"<{binding['resp']['value']}>")
+    except llm_response.OutdatedCacheImplementationException:
+        return None
+    if not isinstance(response, llm_response.LLMOutput):
+        return None
+    logger.info(f"returning the jena cached response of the same request from {binding['time']['value']}")
+    response.uri = f"<{binding['resp']['value']}>" # type:ignore
+    return response
@@ -1,12 +1,14 @@
-# states per thread, integer is the thread native_id
-# use defaultdicts to support when calling without a context manager
-from collections import defaultdict
-import functools
+# states per run, kept in context variables so that they follow threads and asyncio tasks
+# a default context is used when calling without a context manager
+import asyncio
+import contextvars
+from dataclasses import dataclass, field, fields, replace
 import os
-import threading
 from typing import Any
+import uuid
 
 from annotation import utils
+from annotation.result_cache import RESULT_CACHE, ResultCache
 import dotenv
 import logging
 
@@ -21,86 +23,164 @@ DEFAULT_READ_CACHE = True
 DEFAULT_WRITE_CACHE = True
 DEFAULT_ONLY_CACHE = False
 DEFAULT_DUMP_JENA_REQUEST = False
-
-MASTODON_URL: dict[int, str] = defaultdict(lambda: DEFAULT_MASTODON_URL)
-RDF_URI: dict[int, str] = defaultdict(lambda: DEFAULT_RDF_URI)
-PROMPT_FOLDER: dict[int, str] = defaultdict(lambda: DEFAULT_PROMP_FOLDER)
-READ_CACHE: dict[int, bool] = defaultdict(lambda: DEFAULT_READ_CACHE)
-WRITE_CACHE: dict[int, bool] = defaultdict(lambda: DEFAULT_WRITE_CACHE)
-ONLY_CACHE: dict[int, bool] = defaultdict(lambda: DEFAULT_ONLY_CACHE)
-CALL_STACK: dict[int, Any] = defaultdict(utils.CallStack)
-RESULT_CACHE: dict[int, dict] = defaultdict(lambda: dict())
-DUMP_JENA_REQUEST: dict[int, bool] = defaultdict(lambda: DEFAULT_DUMP_JENA_REQUEST)
-
-def get_mastodon_url(thread_id=None):
-    if thread_id is None:
-        thread_id = threading.get_native_id()
-    return MASTODON_URL[thread_id]
-
-def get_prompt_folder(thread_id=None):
-    if thread_id is None:
-        thread_id = threading.get_native_id()
-    return PROMPT_FOLDER[thread_id]
-
-def get_rdf_uri(thread_id=None):
-    if thread_id is None:
-        thread_id = threading.get_native_id()
-    return RDF_URI[thread_id]
-
-def get_read_cache(thread_id=None):
-    if thread_id is None:
-        thread_id = threading.get_native_id()
-    return READ_CACHE[thread_id]
-
-def get_write_cache(thread_id=None):
-    if thread_id is None:
-        thread_id = threading.get_native_id()
-    return WRITE_CACHE[thread_id]
-
-def get_only_cache(thread_id=None):
-    if thread_id is None:
-        thread_id = threading.get_native_id()
-    return ONLY_CACHE[thread_id]
-
-def get_result_cache(thread_id=None):
-    if thread_id is None:
-        thread_id = threading.get_native_id()
-    return RESULT_CACHE[thread_id]
-
-def get_dump_jena_request(thread_id=None):
-    if thread_id is None:
-        thread_id = threading.get_native_id()
-    return DUMP_JENA_REQUEST[thread_id]
+DEFAULT_CORPUS = os.getenv("MASTODON_CORPUS") # path to an offline corpus.CorpusStore, None means live mastodon api
+DEFAULT_PREFETCH = True
+DEFAULT_SPECULATIVE_PREFETCH = False
+DEFAULT_CASSETTE = os.getenv("CASSETTE") # path to a cassette.Cassette that external requests are recorded to or replayed from
+DEFAULT_CASSETTE_MODE = os.getenv("CASSETTE_MODE", "replay")
+REQUEST_CACHE_MODES = ("deterministic", "always", "off")
+DEFAULT_REQUEST_CACHE = os.getenv("LLM_REQUEST_CACHE", "deterministic") # which LLM requests are answered from annotations of the same rendered request
+
+
+@dataclass(frozen=True)
+class RunContext:
+    """
+    The settings of a run: which servers, prompts and cache policy annotations use.
+    Immutable, so it can be handed as is to thread pool or asyncio workers with `run` or `arun`.
+    """
+    mastodon_url: str
+    rdf_uri: str
+    prompt_folder: str
+    read_cache: bool = DEFAULT_READ_CACHE
+    write_cache: bool = DEFAULT_WRITE_CACHE
+    only_cache: bool = DEFAULT_ONLY_CACHE
+    dump_jena_request: bool = DEFAULT_DUMP_JENA_REQUEST
+    corpus: str | None = None # path to an offline corpus.CorpusStore, None means live mastodon api
+    prefetch: bool = DEFAULT_PREFETCH # resolve the dependencies of a template concurrently before rendering it
+    speculative_prefetch: bool = DEFAULT_SPECULATIVE_PREFETCH # including those in branches that may not be taken
+    annotation_namespace: str | None = None # if set, annotations get ids derived from it and the call, and are written once (see distributed.py)
+    cassette: str | None = None # path to a cassette.Cassette, None means live requests
+    cassette_mode: str = DEFAULT_CASSETTE_MODE # record, replay or passthrough
+    request_cache: str = DEFAULT_REQUEST_CACHE # deterministic (temperature 0), always or off
+    cmdline_args: dict[str, Any] = field(default_factory=dict, compare=False)
+    run_id: str = field(default_factory=lambda: uuid.uuid4().hex, compare=False) # scopes memory cached results of runs that do not read the cache
+    supported_annotations: Any = field(init=False, compare=False, repr=False) # not declare type because circula dependency on annotation
+
+    def __post_init__(self):
+        if self.request_cache not in REQUEST_CACHE_MODES:
+            raise ValueError(f"Unknown request cache mode {self.request_cache}, expected one of {', '.join(REQUEST_CACHE_MODES)}")
+        from annotation.registry import get_registry, SupportedAnnotations
+        object.__setattr__(self, "supported_annotations", SupportedAnnotations(get_registry(self.prompt_folder), self.cmdline_args))
+
+    @classmethod
+    def default(cls, **changes):
+        # the settings that are not given are the module defaults
+        return cls(**{"mastodon_url": DEFAULT_MASTODON_URL,
+                      "rdf_uri": DEFAULT_RDF_URI,
+                      "prompt_folder": DEFAULT_PROMP_FOLDER,
+                      "corpus": DEFAULT_CORPUS,
+                      "cassette": DEFAULT_CASSETTE,
+                      "cassette_mode": DEFAULT_CASSETTE_MODE,
+                      "request_cache": DEFAULT_REQUEST_CACHE,
+                      **changes})
+
+    def replace(self, **changes):
+        return replace(self, **changes)
+
+    def __reduce__(self):
+        # the registry view is rebuilt where the context is unpickled, e.g. in a worker process
+        return (type(self), tuple(getattr(self, f.name) for f in fields(self) if f.init))
+
+    def run(self, f, *args, **kwargs):
+        """
+        Calls f in this context, with a call stack of its own. For workers, e.g.
+        `pool.submit(get_run_context().run, f, *args)`.
+        """
+        def g():
+            RUN_CONTEXT.set(self)
+            CALL_STACK.set(utils.CallStack())
+            return f(*args, **kwargs)
+        return contextvars.copy_context().run(g)
+
+    async def arun(self, f, *args, **kwargs):
+        """
+        run for coroutine functions: awaits f in this context, in a task of its own.
+        """
+        async def g():
+            RUN_CONTEXT.set(self)
+            CALL_STACK.set(utils.CallStack())
+            return await f(*args, **kwargs)
+        return await asyncio.create_task(g())
+
+
+# unset until a context is entered, threads and tasks without one get a default context of their own
+RUN_CONTEXT: contextvars.ContextVar[RunContext] = contextvars.ContextVar("run_context")
+# the call stack is mutable and specific to the thread or task, so it is kept apart from the run context
+CALL_STACK: contextvars.ContextVar[utils.CallStack] = contextvars.ContextVar("call_stack")
+
+def get_run_context() -> RunContext:
+    context = RUN_CONTEXT.get(None)
+    if context is None:
+        context = RunContext.default()
+        RUN_CONTEXT.set(context)
+    return context
+
+def get_mastodon_url():
+    return get_run_context().mastodon_url
+
+def get_prompt_folder():
+    return get_run_context().prompt_folder
+
+def get_rdf_uri():
+    return get_run_context().rdf_uri
+
+def get_read_cache():
+    return get_run_context().read_cache
+
+def get_write_cache():
+    return get_run_context().write_cache
+
+def get_only_cache():
+    return get_run_context().only_cache
+
+def get_result_cache() -> ResultCache:
+    return RESULT_CACHE
+
+def get_dump_jena_request():
+    return get_run_context().dump_jena_request
+
+def get_corpus():
+    """
+    The offline corpus posts are resolved against, or None to use the mastodon api.
+    """
+    path = get_run_context().corpus
+    if path is None:
+        return None
+    from annotation.corpus import open_corpus
+    return open_corpus(path)
+
+def get_request_cache():
+    return get_run_context().request_cache
 
 def default_supported_annotations():
     from annotation.api_context_manager import supported_annotations
     return supported_annotations()
 
-SUPPORTED_ANNOTATIONS: dict[int, dict[str, Any]] = defaultdict(default_supported_annotations)  # not declare type because circula dependency on annotation
+def get_supported_annotation(name):
+    return get_run_context().supported_annotations[name]
 
-def get_supported_annotation(name, thread_id=None):
-    if thread_id is None:
-        thread_id = threading.get_native_id()
-    return SUPPORTED_ANNOTATIONS[thread_id][name]
+def is_supported_annotation(name):
+    return name in get_run_context().supported_annotations
 
-def is_supported_annotation(name, thread_id=None):
-    if thread_id is None:
-        thread_id = threading.get_native_id()
-    return name in SUPPORTED_ANNOTATIONS[thread_id]
+def get_call_stack() -> utils.CallStack:
+    call_stack = CALL_STACK.get(None)
+    if call_stack is None:
+        call_stack = utils.CallStack()
+        CALL_STACK.set(call_stack)
+    return call_stack
 
-def get_call_stack(thread_id=None) -> utils.CallStack:
-    if thread_id is None:
-        thread_id = threading.get_native_id()
-    return CALL_STACK[thread_id]
+def get_registry():
+    """
+    The process-wide registry of the questions in the prompt folder.
+    """
+    from annotation.registry import get_registry
+    return get_registry(get_prompt_folder())
 
-@functools.cache
 def question_hashes():
-    hashes = []
-    for k, v in default_supported_annotations().items():
-        if v.major is not None and v.minor is not None:
-            hashes.append(v.sha256_quest)
-    return hashes
+    return get_registry().question_hashes()
+
+def question_hash_set():
+    return get_registry().question_hash_set()
 
-@functools.cache
 def question_hashes_sparql(join=", "):
-    return join.join([f'"{h}"' for h in question_hashes()])
\ No newline at end of file
+    return get_registry().question_hashes_sparql(join)
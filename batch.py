@@ -0,0 +1,244 @@
+"""
+Layer-wise execution of a question over a batch of posts.
+
+Called one post at a time, a question resolves its whole dependency tree for
+the first post before starting on the second, so the LLM provider idles while
+Jena and mastodon are waited on. Here the calls of the whole batch are expanded
+first, through the references each template makes to other questions (see
+prefetch.py), into a graph like
+
+    thread -> name -> unary/distill/rewrite -> binary -> llm_score_*
+
+which is then run one layer at a time, leaves first: the calls of a layer are
+gathered on the annotation event loop (see aio.py), at most BATCH_WORKERS (16)
+in flight, and the next layer starts once the layer is done, finding its
+dependencies in the result cache. References that are not known statically are
+still resolved while rendering, as usual.
+
+    results = main.annotate_batch("binary_1", [(reply, parent) for reply, parent in pairs])
+
+Rendering, parsing and hashing are pure python and hold the GIL, so for large
+batches that are mostly cached the event loop thread is the bottleneck. With
+processes=N (BATCH_PROCESSES) each layer is instead split over N worker
+processes, started with spawn rather than fork since this process already
+runs the event loop and its threads. Each worker gathers the calls of its
+chunks on its own event loop, at most workers in flight. The posts of the batch
+are loaded once, before the workers start, and handed to every worker as a
+read-only snapshot. Results of earlier layers are not in the memory cache of
+the workers, dependents read them from jena, or compute them again if they are
+not written to the cache (e.g. questions with `cache: local`).
+"""
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import math
+import json
+import logging
+import multiprocessing
+import os
+import time
+from typing import Any, Iterable, NamedTuple
+
+from annotation import aio, api_context_states, post, prefetch
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+DEFAULT_WORKERS = int(os.getenv("BATCH_WORKERS", 16)) # calls in flight
+DEFAULT_PROCESSES = int(os.getenv("BATCH_PROCESSES", 0)) # 0 runs the calls in this process
+CHUNKS_PER_PROCESS = 4
+
+
+class Call(NamedTuple):
+    name: str
+    posts: tuple
+    kwargs: dict[str, Any]
+
+    @property
+    def key(self):
+        return (self.name, self.posts, json.dumps(self.kwargs, sort_keys=True, default=str))
+
+
+def question_graph(names: Iterable[str]) -> dict[str, set[str]]:
+    """
+    The questions each of names (and, recursively, their dependencies) references in its template.
+    """
+    supported = api_context_states.get_run_context().supported_annotations
+    graph = {}
+    todo = list(names)
+    while todo:
+        name = todo.pop()
+        if name in graph:
+            continue
+        graph[name] = {r.name for r in supported[name].references if r.name in supported}
+        todo.extend(graph[name])
+    return graph
+
+def question_layers(graph: dict[str, set[str]]) -> list[list[str]]:
+    """
+    The questions of graph by layer, each depending only on those of earlier layers.
+    """
+    layers = []
+    done = set()
+    while len(done) < len(graph):
+        layer = sorted(name for name, deps in graph.items() if name not in done and deps <= done)
+        if not layer:
+            raise RecursionError(f"Cyclic dependency between {', '.join(sorted(set(graph) - done))}")
+        layers.append(layer)
+        done.update(layer)
+    return layers
+
+def call_layers(calls: Iterable[Call], speculative=False) -> list[list[Call]]:
+    """
+    The calls and their dependencies by layer, each depending only on calls of earlier layers.
+    """
+    supported = api_context_states.get_run_context().supported_annotations
+    depths: dict[Any, int] = {}
+    expanded: dict[Any, Call] = {}
+
+    def visit(call: Call, path: set):
+        key = call.key
+        if key in depths:
+            return depths[key]
+        if key in path:
+            raise RecursionError(f"Cyclic dependency through {call.name}")
+        path.add(key)
+        f = supported[call.name]
+        interpolation_args = f._augment_args_for_interpolation(*call.posts, **f._get_overidden_args(**call.kwargs))
+        depth = 0
+        for name, posts, kwargs in prefetch.calls(f.references, call.posts, interpolation_args, speculative=speculative):
+            try:
+                depth = max(depth, visit(Call(name, posts, kwargs), path) + 1)
+            except (KeyError, ValueError) as e:
+                logger.warning(f"Not scheduling {name} for {call.name}, it is resolved while rendering: {e}")
+        path.discard(key)
+        depths[key] = depth
+        expanded[key] = call
+        return depth
+
+    for call in calls:
+        visit(call, set())
+    layers: list[list[Call]] = [[] for _ in range(max(depths.values(), default=-1) + 1)]
+    for key, depth in depths.items():
+        layers[depth].append(expanded[key])
+    return layers
+
+async def _arun(call: Call):
+    return await api_context_states.get_supported_annotation(call.name).acall(*call.posts, **call.kwargs)
+
+def _record(i: int, layers: list[list[Call]], outcomes, start: float, results: dict, errors: dict):
+    # outcomes are the results of the calls of layer i, or the exceptions they raised
+    failed = 0
+    for call, outcome in zip(layers[i], outcomes):
+        if isinstance(outcome, Exception):
+            failed += 1
+            errors[call.key] = outcome
+            logger.warning(f"{call.name} on {call.posts} failed: {outcome}")
+        else:
+            results[call.key] = outcome
+    names = sorted(set(call.name for call in layers[i]))
+    logger.info(f"Layer {i + 1}/{len(layers)}: {len(layers[i])} calls of {', '.join(names)} in {time.time() - start:.1f}s, {failed} failed")
+
+async def arun_layers(layers: list[list[Call]], workers=DEFAULT_WORKERS) -> tuple[dict[Any, Any], dict[Any, Exception]]:
+    """
+    run_layers on the annotation event loop, with at most workers calls in flight.
+    """
+    # dependencies are already scheduled, so templates do not need to prefetch them again
+    context = api_context_states.get_run_context().replace(prefetch=False)
+    results = {}
+    errors = {}
+    for i, layer in enumerate(layers):
+        start = time.time()
+        outcomes = await _agather(context, layer, workers)
+        _record(i, layers, outcomes, start, results, errors)
+    return results, errors
+
+async def _agather(context, calls: list[Call], workers: int) -> list:
+    # the results of the calls, or the exceptions they raised, at most workers in flight
+    limit = asyncio.Semaphore(workers)
+
+    async def run(call):
+        async with limit:
+            return await context.arun(_arun, call)
+
+    return await asyncio.gather(*[run(call) for call in calls], return_exceptions=True)
+
+##### worker processes #####
+
+_CONTEXT = None
+_SHARED_POSTS = () # keeps the snapshot of the posts alive in the worker
+
+def _init_process(context, posts):
+    global _CONTEXT, _SHARED_POSTS
+    _CONTEXT = context
+    _SHARED_POSTS = posts
+
+def _run_chunk(chunk: list[Call], workers: int) -> list:
+    return aio.run(_agather, _CONTEXT, chunk, workers)
+
+def _chunks(layer: list[Call], processes: int, workers: int) -> list[list[Call]]:
+    # a process works on one chunk at a time, so chunks are large enough to keep workers calls in flight
+    size = max(1, math.ceil(len(layer) / (processes * CHUNKS_PER_PROCESS)), min(workers, math.ceil(len(layer) / processes)))
+    return [layer[i:i + size] for i in range(0, len(layer), size)]
+
+def _posts(layers: list[list[Call]]) -> list:
+    posts = list(dict.fromkeys(p for layer in layers for call in layer for p in call.posts))
+    # load them here, in batched requests, so that workers receive them loaded
+    post.prefetch(posts)
+    return posts
+
+def run_layers(layers: list[list[Call]], workers=DEFAULT_WORKERS, processes=DEFAULT_PROCESSES) -> tuple[dict[Any, Any], dict[Any, Exception]]:
+    """
+    Runs the layers one after the other, the calls of a layer concurrently, with
+    at most workers calls in flight or, if processes is set, on that many worker
+    processes with at most workers calls in flight each. Returns the results and
+    the errors by call key. Failed calls are logged, their dependents try them
+    again while rendering.
+    """
+    if processes <= 0:
+        return aio.run(arun_layers, layers, workers=workers)
+    context = api_context_states.get_run_context().replace(prefetch=False)
+    results = {}
+    errors = {}
+    # forked children would inherit the loop's threads without them, and locks they hold
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_process, initargs=(context, _posts(layers))) as pool:
+        for i, layer in enumerate(layers):
+            start = time.time()
+            chunks = _chunks(layer, processes, workers)
+            futures = [pool.submit(_run_chunk, chunk, workers) for chunk in chunks]
+            outcomes = []
+            for chunk, future in zip(chunks, futures):
+                try:
+                    outcomes.extend(future.result())
+                except Exception as e: # the worker died, or a result could not be pickled
+                    outcomes.extend([e] * len(chunk))
+            _record(i, layers, outcomes, start, results, errors)
+    return results, errors
+
+
+def _layers(name: str, batch: Iterable[Iterable], speculative: bool, kwargs: dict) -> tuple[list[Call], list[list[Call]]]:
+    calls = [Call(name, tuple(posts), kwargs) for posts in batch]
+    layers = call_layers(calls, speculative=speculative)
+    logger.info(f"Running {len(calls)} calls of {name} in {len(layers)} layers of {', '.join(str(len(layer)) for layer in layers)} calls")
+    return calls, layers
+
+def _ordered(calls: list[Call], results: dict, errors: dict) -> list:
+    for call in calls:
+        if call.key in errors:
+            raise errors[call.key]
+    return [results[call.key] for call in calls]
+
+def annotate_batch(name: str, batch: Iterable[Iterable], workers=DEFAULT_WORKERS, speculative=False, processes=DEFAULT_PROCESSES, **kwargs) -> list:
+    """
+    Answers question name for each tuple of posts in batch, layer by layer. Returns
+    the results in the order of batch. Should be called in an APIContextManager.
+    """
+    calls, layers = _layers(name, batch, speculative, kwargs)
+    return _ordered(calls, *run_layers(layers, workers=workers, processes=processes))
+
+async def aannotate_batch(name: str, batch: Iterable[Iterable], workers=DEFAULT_WORKERS, speculative=False, **kwargs) -> list:
+    """
+    annotate_batch for asyncio callers.
+    """
+    calls, layers = _layers(name, batch, speculative, kwargs)
+    return _ordered(calls, *await aio.on_loop(arun_layers, layers, workers=workers))
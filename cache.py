@@ -3,7 +3,7 @@ import json
 import os
 import random
 import uuid
-from annotation import api_context_states, utils
+from annotation import api_context_states, cassette, utils
 import logging
 import dateutil
 import requests
@@ -34,11 +34,7 @@ UPDATE_HEADER = {'Content-Type': 'application/sparql-update'}
 class JenaException(Exception):
     pass
 
-def insert_triples(*triples):
-    triples_str = "".join([f' {s} {p} {o} . \n' for  s,p,o in triples])
-    command = f"""
-    INSERT DATA {{ {triples_str} }}
-    """
+def _update(command):
     command_with_prefixes = f'{RDF_PREFIXES}\n{command}'
     if get_dump_jena_request():
         cache_name = utils.sha256_hash_by_lines(command)
@@ -47,18 +43,40 @@ def insert_triples(*triples):
             os.makedirs(cache_dir, exist_ok=True)
         with open(os.path.join(cache_dir, cache_name), "wt") as dumpfile:
             dumpfile.write(command_with_prefixes)
-    res = requests.post(f'{api_context_states.get_rdf_uri()}/{UPDATE_ENDPOINT}', headers=UPDATE_HEADER, data=command_with_prefixes)
-    if res.status_code != 204:
-        raise JenaException(f'Query: {command_with_prefixes}\n Response: {res}')
-    return res.status_code
+    def post():
+        res = requests.post(f'{api_context_states.get_rdf_uri()}/{UPDATE_ENDPOINT}', headers=UPDATE_HEADER, data=command_with_prefixes)
+        if res.status_code != 204:
+            raise JenaException(f'Query: {command_with_prefixes}\n Response: {res}')
+        return res.status_code
+    # updates hold fresh ids and timestamps, so replays acknowledge them without sending them
+    return cassette.exchange("jena-update", command_with_prefixes, post, default=204)
+
+def insert_triples(*triples):
+    triples_str = "".join([f' {s} {p} {o} . \n' for  s,p,o in triples])
+    command = f"""
+    INSERT DATA {{ {triples_str} }}
+    """
+    return _update(command)
+
+def insert_triples_once(subject, *triples):
+    """
+    insert_triples, unless subject already has triples. It is a single update, which
+    jena applies atomically, so of concurrent writers of the same subject only one writes.
+    """
+    triples_str = "".join([f' {s} {p} {o} . \n' for  s,p,o in triples])
+    command = f"""
+    INSERT {{ {triples_str} }} WHERE {{ FILTER NOT EXISTS {{ {subject} ?p ?o }} }}
+    """
+    return _update(command)
 
 def get_bindings(command):
     command_with_prefixes = f'{RDF_PREFIXES}\n{command}'
-    res = requests.post(f'{api_context_states.get_rdf_uri()}/{QUERY_ENDPOINT}', headers=QUERY_HEADER, data=command_with_prefixes)
-    if res.status_code != 200:
-        raise JenaException(f'Query: {command_with_prefixes}\n Response: {res}')
-    bindings = res.json()["results"]["bindings"]
-    return bindings
+    def post():
+        res = requests.post(f'{api_context_states.get_rdf_uri()}/{QUERY_ENDPOINT}', headers=QUERY_HEADER, data=command_with_prefixes)
+        if res.status_code != 200:
+            raise JenaException(f'Query: {command_with_prefixes}\n Response: {res}')
+        return res.json()["results"]["bindings"]
+    return cassette.exchange("jena-query", command_with_prefixes, post)
 
 def batch_retrieve(annot_type, post_ids):
     post_list = " "
@@ -0,0 +1,195 @@
+"""
+Record and replay of the external I/O of a run: mastodon requests
+(`post.request_json`), jena queries and updates (`cache.get_bindings`,
+`cache.insert_triples`) and LLM requests (`LLMAnnot.get_responses`, sync and async).
+
+With `APIContextManager(cassette="run.sqlite", cassette_mode=...)`, or the CASSETTE
+and CASSETTE_MODE environment variables, every exchange goes through a cassette,
+an indexed sqlite file of zlib compressed json requests and responses keyed by
+the hash of the request:
+
+    record       every request goes to the live service, and the exchange is stored
+    replay       exchanges are served from the cassette, a request that was not
+                 recorded raises CassetteMiss; jena updates are not sent
+    passthrough  like replay, but requests that were not recorded go to the live
+                 service and are recorded
+
+The cassette is read into memory when it is opened, so replayed exchanges take
+microseconds, which leaves the engine's own overhead to measure. Mastodon's
+"Record not found" answers are recorded and raised again on replay, other errors
+are not recorded. Replays are deterministic as long as the requests are: LLM
+requests with sampling are answered with the recorded samples.
+
+    python3 -m annotation.cassette stats run.sqlite
+"""
+from argparse import ArgumentParser
+from collections import Counter
+import functools
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import zlib
+
+from annotation import aio, api_context_states
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+MODES = ("record", "replay", "passthrough")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS exchanges (kind TEXT NOT NULL, key TEXT NOT NULL, request BLOB NOT NULL, response BLOB NOT NULL, PRIMARY KEY (kind, key)) WITHOUT ROWID;
+"""
+
+
+class CassetteMiss(Exception):
+    pass
+
+
+def _dumps(x) -> bytes:
+    return zlib.compress(json.dumps(x, sort_keys=True, default=str).encode("utf-8"))
+
+def _loads(b: bytes):
+    return json.loads(zlib.decompress(b).decode("utf-8"))
+
+def request_key(request) -> str:
+    return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class Cassette:
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self.counts = Counter()
+        self._counts_lock = threading.Lock()
+        self.connection.executescript(SCHEMA)
+        self._index = {(kind, key): response for kind, key, response in self.connection.execute("SELECT kind, key, response FROM exchanges")}
+        logger.info(f"Loaded {len(self._index)} exchanges from {path}")
+
+    def __repr__(self):
+        return f"Cassette({self.path})"
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # sqlite connections cannot be shared across threads, nor across a fork
+        if getattr(self._local, "pid", None) != os.getpid():
+            self._local.connection = sqlite3.connect(self.path, timeout=60)
+            self._local.connection.execute("PRAGMA journal_mode=WAL")
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def _count(self, name: str):
+        with self._counts_lock:
+            self.counts[name] += 1
+
+    def _record(self, kind: str, key: str, request, response: dict):
+        data = _dumps(response)
+        with self.connection as conn:
+            conn.execute("INSERT OR REPLACE INTO exchanges (kind, key, request, response) VALUES (?, ?, ?, ?)",
+                         (kind, key, _dumps(request), data))
+        self._index[(kind, key)] = data
+        self._count(f"{kind} recorded")
+
+    def _lookup(self, kind: str, request, mode: str, errors: tuple, default):
+        """
+        (key, whether the request is answered from the cassette, the response)
+        """
+        if mode not in MODES:
+            raise ValueError(f"Unknown cassette mode {mode}, expected one of {', '.join(MODES)}")
+        key = request_key(request)
+        if mode == "record":
+            return key, False, None
+        data = self._index.get((kind, key))
+        if data is None:
+            if mode == "replay" and default is not None:
+                self._count(f"{kind} skipped")
+                return key, True, default
+            if mode == "replay":
+                raise CassetteMiss(f"No {kind} exchange recorded in {self.path} for {json.dumps(request, default=str)[:500]}")
+            return key, False, None
+        self._count(f"{kind} replayed")
+        stored = _loads(data)
+        if "error" in stored:
+            for error in errors:
+                if error.__name__ == stored["error"]:
+                    raise error(stored["message"])
+        return key, True, stored.get("response")
+
+    def exchange(self, kind: str, request, f, mode="replay", errors: tuple = (), default=None):
+        """
+        f(), the response to request, through the cassette in mode. Exceptions of the types in
+        errors are recorded and raised again on replay. If default is given, it answers
+        requests that were not recorded when replaying, instead of raising CassetteMiss.
+        """
+        key, found, response = self._lookup(kind, request, mode, errors, default)
+        if found:
+            return response
+        try:
+            response = f()
+        except errors as e:
+            self._record(kind, key, request, {"error": type(e).__name__, "message": str(e)})
+            raise
+        self._record(kind, key, request, {"response": response})
+        return response
+
+    async def aexchange(self, kind: str, request, f, mode="replay", errors: tuple = (), default=None):
+        """
+        exchange for a coroutine function f, awaited on the annotation loop, which the
+        sqlite writes are kept off.
+        """
+        key, found, response = self._lookup(kind, request, mode, errors, default)
+        if found:
+            return response
+        try:
+            response = await f()
+        except errors as e:
+            await aio.to_thread(None, self._record, kind, key, request, {"error": type(e).__name__, "message": str(e)})
+            raise
+        await aio.to_thread(None, self._record, kind, key, request, {"response": response})
+        return response
+
+    def stats(self) -> dict[str, int]:
+        return dict(self.connection.execute("SELECT kind, COUNT(*) FROM exchanges GROUP BY kind").fetchall())
+
+
+@functools.cache
+def _open_cassette(path: str) -> Cassette:
+    return Cassette(path)
+
+def open_cassette(path: str, mode: str) -> Cassette:
+    # one instance per file, whatever the mode of the runs using it, so that it sees their recordings
+    if mode == "replay" and not os.path.exists(path):
+        raise FileNotFoundError(f"No cassette at {path} to replay")
+    return _open_cassette(path)
+
+def exchange(kind: str, request, f, errors: tuple = (), default=None):
+    """
+    f() through the cassette of the run, or just f() if the run has none.
+    """
+    context = api_context_states.get_run_context()
+    if context.cassette is None:
+        return f()
+    return open_cassette(context.cassette, context.cassette_mode).exchange(kind, request, f, context.cassette_mode, errors=errors, default=default)
+
+async def aexchange(kind: str, request, f, errors: tuple = (), default=None):
+    context = api_context_states.get_run_context()
+    if context.cassette is None:
+        return await f()
+    return await open_cassette(context.cassette, context.cassette_mode).aexchange(kind, request, f, context.cassette_mode, errors=errors, default=default)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(required=True, dest="subcommand")
+    stats = subparsers.add_parser("stats", help="count the recorded exchanges by kind")
+    stats.add_argument("cassette")
+    args = parser.parse_args()
+
+    if args.subcommand == "stats":
+        print(json.dumps(open_cassette(args.cassette, "replay").stats()))
+    else:
+        raise ValueError(f"Unknown subcommad: {args.subcommand}")
@@ -0,0 +1,187 @@
+"""
+Offline corpus of mastodon posts, stored in an indexed sqlite file.
+
+Posts are resolved against the corpus instead of the live mastodon api when a
+corpus path is given to `APIContextManager(corpus=...)` (or through the
+MASTODON_CORPUS environment variable), so runs over a fixed crawl never touch
+the network.
+
+Dumps are ingested with
+
+    python3 -m annotation.corpus ingest corpus.sqlite dumps/*.jsonl
+
+Each dump is a json or jsonl file holding (lists of) records that are either a
+status, a context (`{"ancestors": [...], "descendants": [...]}`), or a dict with
+any of the keys `status`, `history` and `context` (plus `id` if there is no
+`status`). Statuses found inside contexts are ingested as well.
+"""
+from argparse import ArgumentParser
+import functools
+import json
+import logging
+import sqlite3
+import threading
+
+from annotation import post
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS statuses (id TEXT PRIMARY KEY, in_reply_to_id TEXT, json TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS statuses_in_reply_to_id ON statuses (in_reply_to_id);
+CREATE TABLE IF NOT EXISTS histories (id TEXT PRIMARY KEY, json TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS contexts (id TEXT PRIMARY KEY, json TEXT NOT NULL);
+"""
+
+
+class CorpusStore:
+
+    def __init__(self, path: str, readonly=True):
+        self.path = path
+        self.readonly = readonly
+        self._local = threading.local()
+        if not readonly:
+            with self.connection as conn:
+                conn.executescript(SCHEMA)
+
+    def __repr__(self):
+        return f"CorpusStore({self.path})"
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # sqlite connections cannot be shared across threads
+        if not hasattr(self._local, "connection"):
+            if self.readonly:
+                self._local.connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            else:
+                self._local.connection = sqlite3.connect(self.path)
+        return self._local.connection
+
+    def _get(self, table, mastodon_id):
+        row = self.connection.execute(f"SELECT json FROM {table} WHERE id = ?", (mastodon_id,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def status(self, mastodon_id: str) -> dict:
+        status = self._get("statuses", mastodon_id)
+        if status is None:
+            raise post.RecordNotFoundError(f"Record not found in {self.path} for status {mastodon_id}")
+        return status
+
+    def statuses(self, mastodon_ids) -> dict[str, dict]:
+        mastodon_ids = list(mastodon_ids)
+        out = {}
+        for i in range(0, len(mastodon_ids), 500):
+            chunk = mastodon_ids[i:i + 500]
+            rows = self.connection.execute(f"SELECT id, json FROM statuses WHERE id IN ({', '.join('?' * len(chunk))})", chunk)
+            for mastodon_id, s in rows:
+                out[mastodon_id] = json.loads(s)
+        return out
+
+    def history(self, mastodon_id: str) -> list[dict]:
+        history = self._get("histories", mastodon_id)
+        if history is None:
+            history = post.history_from_status(self.status(mastodon_id))
+        if history is None:
+            raise post.RecordNotFoundError(f"Record not found in {self.path} for history of edited status {mastodon_id}")
+        return history
+
+    def context(self, mastodon_id: str) -> dict:
+        context = self._get("contexts", mastodon_id)
+        if context is not None:
+            return context
+        # derive the context from the reply tree of the statuses we have
+        ancestors = []
+        parent_id = self.status(mastodon_id).get("in_reply_to_id")
+        while parent_id is not None:
+            parent = self._get("statuses", parent_id)
+            if parent is None:
+                break
+            ancestors.append(parent)
+            parent_id = parent.get("in_reply_to_id")
+        descendants = []
+        stack = self._children(mastodon_id)
+        while stack:
+            child = stack.pop()
+            descendants.append(child)
+            stack.extend(self._children(child["id"]))
+        return {"ancestors": ancestors[::-1], "descendants": descendants}
+
+    def _children(self, mastodon_id):
+        # reversed so that popping from the end visits replies in order
+        rows = self.connection.execute("SELECT json FROM statuses WHERE in_reply_to_id = ? ORDER BY CAST(id AS INTEGER) DESC", (mastodon_id,))
+        return [json.loads(s) for (s,) in rows]
+
+    ##### ingestion #####
+
+    def insert_status(self, status: dict):
+        self.connection.execute("INSERT OR REPLACE INTO statuses VALUES (?, ?, ?)",
+                                (status["id"], status.get("in_reply_to_id"), json.dumps(status)))
+
+    def insert_history(self, mastodon_id: str, history: list[dict]):
+        self.connection.execute("INSERT OR REPLACE INTO histories VALUES (?, ?)", (mastodon_id, json.dumps(history)))
+
+    def insert_context(self, mastodon_id: str | None, context: dict):
+        for status in context.get("ancestors", []) + context.get("descendants", []):
+            self.insert_status(status)
+        if mastodon_id is not None:
+            self.connection.execute("INSERT OR REPLACE INTO contexts VALUES (?, ?)", (mastodon_id, json.dumps(context)))
+
+    def insert_record(self, record):
+        if isinstance(record, list):
+            for r in record:
+                self.insert_record(r)
+            return
+        if "ancestors" in record and "descendants" in record:
+            self.insert_context(record.get("id"), record)
+            return
+        if "content" in record and "created_at" in record and "id" in record:
+            self.insert_status(record)
+            return
+        status = record.get("status")
+        mastodon_id = status["id"] if status is not None else record.get("id")
+        if status is not None:
+            self.insert_status(status)
+        if record.get("history") is not None:
+            if mastodon_id is None:
+                raise ValueError(f"History record without a status id: {str(record)[:200]}")
+            self.insert_history(mastodon_id, record["history"])
+        if record.get("context") is not None:
+            self.insert_context(mastodon_id, record["context"])
+
+    def ingest(self, file: str) -> int:
+        count = 0
+        with open(file, "rt") as f, self.connection:
+            text = f.read()
+            try:
+                records = [json.loads(text)]
+            except json.JSONDecodeError:
+                records = [json.loads(line) for line in text.splitlines() if line.strip()]
+            for record in records:
+                self.insert_record(record)
+                count += len(record) if isinstance(record, list) else 1
+        return count
+
+
+@functools.cache
+def open_corpus(path: str) -> CorpusStore:
+    return CorpusStore(path, readonly=True)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(required=True, dest="subcommand")
+    ingest = subparsers.add_parser("ingest", help="load status, history and context json dumps into a corpus file")
+    ingest.add_argument("corpus")
+    ingest.add_argument("dumps", nargs="+")
+    args = parser.parse_args()
+
+    if args.subcommand == "ingest":
+        store = CorpusStore(args.corpus, readonly=False)
+        for dump in args.dumps:
+            n = store.ingest(dump)
+            logger.info(f"Ingested {n} records from {dump}")
+    else:
+        raise ValueError(f"Unknown subcommad: {args.subcommand}")
@@ -0,0 +1,459 @@
+"""
+Batches spread over worker processes on several hosts.
+
+A job is a manifest of work items, one json object per line:
+
+    {"question": "binary_1", "posts": [{"id": "112794058427962391", "timestamp": "2024-07-02T17:59:29.036000+00:00"}, {"content": "some text"}], "args": {}}
+
+Posts are given by mastodon id and edit timestamp, or by content. Posts given
+by id alone are pinned to their latest edit when the items are submitted, so
+that a worker taking an item over annotates the same edit. Items are identified by the hash of their json,
+which also assigns each item to one of N shards. Workers coordinate through a
+lease table in a sqlite file all hosts can reach (`LeaseStore`): a worker leases
+up to LEASE_BATCH (32) items of its shard at a time, renews its leases with
+heartbeats while it works on them, and records their completion. A lease that
+is not renewed for LEASE_SECONDS (60) expires. Once its own shard is done, a
+worker takes over expired leases and unclaimed items of the other shards, so the
+items of a worker that died are redone. Failed items are retried up to
+LEASE_MAX_ATTEMPTS (3) times, then recorded as failed.
+
+Exactly-once cache writes: every lease carries a fencing token, increased on
+each acquisition, and only the current holder can record a completion. A worker
+whose lease was taken over may still be finishing the item, so the cache writes
+are made idempotent too. Annotations of a job get ids derived from the job and
+the call (see `RunContext.annotation_namespace`), and are inserted in a single
+jena update only if no annotation with that id exists. Each call of a job is
+therefore written to the cache once, whichever workers computed it.
+
+    python3 -m annotation.distributed submit jobs.sqlite manifest.jsonl --job crawl-0702
+    python3 -m annotation.distributed work jobs.sqlite --job crawl-0702 --shards 8 --shard 0 --processes 4   # shards 0-3, on host a
+    python3 -m annotation.distributed work jobs.sqlite --job crawl-0702 --shards 8 --shard 4 --processes 4   # shards 4-7, on host b
+    python3 -m annotation.distributed status jobs.sqlite --job crawl-0702
+
+On one machine, a local file and a stand-in jena (jena_stub.py) exercise the same protocol.
+"""
+from argparse import ArgumentParser
+import contextlib
+from dataclasses import dataclass, field
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+from typing import Any, Iterable
+import uuid
+
+import dateutil.parser
+
+from annotation import api_context_manager, api_context_states, batch, post
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+LEASE_SECONDS = float(os.getenv("LEASE_SECONDS", 60))
+LEASE_BATCH = int(os.getenv("LEASE_BATCH", 32))
+MAX_ATTEMPTS = int(os.getenv("LEASE_MAX_ATTEMPTS", 3))
+POLL_SECONDS = float(os.getenv("LEASE_POLL_SECONDS", 5))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (job TEXT NOT NULL, item TEXT NOT NULL, hash INTEGER NOT NULL, payload TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (job, item));
+CREATE TABLE IF NOT EXISTS leases (job TEXT NOT NULL, item TEXT NOT NULL, owner TEXT NOT NULL, token INTEGER NOT NULL, expires REAL NOT NULL, PRIMARY KEY (job, item));
+CREATE TABLE IF NOT EXISTS completions (job TEXT NOT NULL, item TEXT NOT NULL, owner TEXT NOT NULL, token INTEGER NOT NULL, finished REAL NOT NULL, error TEXT, PRIMARY KEY (job, item));
+"""
+
+
+def post_spec(edit) -> dict:
+    """
+    How a post is written in a manifest.
+    """
+    if isinstance(edit, post.Edit):
+        return {"id": edit.mastodon_id, "timestamp": str(edit.timestamp)}
+    return {"content": edit.content}
+
+def _unpinned(spec: dict) -> bool:
+    return "content" not in spec and spec.get("timestamp") is None
+
+def edit_from_spec(spec: dict):
+    if "content" in spec:
+        return post.EditFromStr(spec["content"])
+    if _unpinned(spec):
+        raise ValueError(f"Post {spec['id']} has no timestamp, items are pinned to an edit when they are submitted")
+    return post.Edit.new(spec["id"], dateutil.parser.parse(spec["timestamp"]))
+
+def pin_edits(items: Iterable["WorkItem"]) -> list["WorkItem"]:
+    """
+    The items, with the posts given by id alone pinned to their latest edit.
+    """
+    items = list(items)
+    unpinned = list(dict.fromkeys(spec["id"] for item in items for spec in item.posts if _unpinned(spec)))
+    if not unpinned:
+        return items
+    latest = {edit.mastodon_id: edit for edit in post.latest_edits(unpinned)}
+    return [WorkItem(item.question, tuple(post_spec(latest[spec["id"]]) if _unpinned(spec) else spec for spec in item.posts), item.args)
+            for item in items]
+
+
+@dataclass(frozen=True)
+class WorkItem:
+    question: str
+    posts: tuple[dict, ...]
+    args: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_json(cls, s: str):
+        record = json.loads(s)
+        return cls(record["question"], tuple(record["posts"]), record.get("args", {}))
+
+    @classmethod
+    def of(cls, question: str, edits: Iterable, **args):
+        return cls(question, tuple(post_spec(edit) for edit in edits), args)
+
+    def to_json(self) -> str:
+        return json.dumps({"question": self.question, "posts": list(self.posts), "args": self.args}, sort_keys=True)
+
+    @property
+    def id(self) -> str:
+        return hashlib.sha256(self.to_json().encode("utf-8")).hexdigest()
+
+    @property
+    def hash(self) -> int:
+        # stable across hosts and python versions, unlike hash()
+        return int(self.id[:15], 16)
+
+    def call(self) -> batch.Call:
+        return batch.Call(self.question, tuple(edit_from_spec(spec) for spec in self.posts), self.args)
+
+
+@dataclass(frozen=True)
+class Lease:
+    item_id: str
+    item: WorkItem
+    token: int
+
+
+class LeaseStore:
+    """
+    Work items, leases and completions of jobs, in a sqlite file shared by all workers.
+    """
+
+    def __init__(self, path: str, timeout=60.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        # executescript commits on its own, outside of a transaction
+        self.connection.executescript(SCHEMA)
+
+    def __repr__(self):
+        return f"LeaseStore({self.path})"
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # sqlite connections cannot be shared across threads
+        if not hasattr(self._local, "connection"):
+            self._local.connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        return self._local.connection
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # taking the write lock up front keeps concurrent read-then-write transactions from interleaving
+        conn = self.connection
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def submit(self, job: str, items: Iterable[WorkItem]) -> int:
+        """
+        Adds the items to job, returns how many were not in it yet. Posts given by id alone
+        are pinned to their latest edit first, see pin_edits.
+        """
+        items = pin_edits(items)
+        with self.transaction() as conn:
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO items (job, item, hash, payload) VALUES (?, ?, ?, ?)",
+                             [(job, item.id, item.hash, item.to_json()) for item in items])
+            return conn.total_changes - before
+
+    def acquire(self, job: str, owner: str, limit=LEASE_BATCH, shard: int | None = None, shards=1, lease_seconds=LEASE_SECONDS) -> list[Lease]:
+        """
+        Leases up to limit items of job that are neither completed nor leased (or whose lease
+        expired), of the shard if given, otherwise of any shard.
+        """
+        now = time.time()
+        shard_filter = "AND i.hash % ? = ?" if shard is not None else ""
+        params: list[Any] = [job, now] + ([shards, shard] if shard is not None else []) + [limit]
+        with self.transaction() as conn:
+            rows = conn.execute(f"""
+                SELECT i.item, i.payload, l.token, l.owner, l.expires FROM items i
+                LEFT JOIN leases l ON l.job = i.job AND l.item = i.item
+                LEFT JOIN completions c ON c.job = i.job AND c.item = i.item
+                WHERE i.job = ? AND c.item IS NULL AND (l.item IS NULL OR l.expires < ?) {shard_filter}
+                ORDER BY i.hash LIMIT ?
+                """, params).fetchall()
+            leases = []
+            for item_id, payload, token, previous_owner, expires in rows:
+                token = (token or 0) + 1
+                if previous_owner is not None and expires > 0 and previous_owner != owner:
+                    logger.warning(f"Taking over {item_id} from {previous_owner}, whose lease expired")
+                conn.execute("""
+                    INSERT INTO leases (job, item, owner, token, expires) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (job, item) DO UPDATE SET owner = excluded.owner, token = excluded.token, expires = excluded.expires
+                    """, (job, item_id, owner, token, now + lease_seconds))
+                leases.append(Lease(item_id, WorkItem.from_json(payload), token))
+            return leases
+
+    def _holds(self, conn, job: str, lease: Lease, owner: str) -> bool:
+        row = conn.execute("SELECT owner, token FROM leases WHERE job = ? AND item = ?", (job, lease.item_id)).fetchone()
+        return row is not None and row[0] == owner and row[1] == lease.token
+
+    def heartbeat(self, job: str, owner: str, leases: Iterable[Lease], lease_seconds=LEASE_SECONDS) -> list[Lease]:
+        """
+        Extends the leases still held by owner, returns those it lost.
+        """
+        lost = []
+        with self.transaction() as conn:
+            for lease in leases:
+                cursor = conn.execute("UPDATE leases SET expires = ? WHERE job = ? AND item = ? AND owner = ? AND token = ?",
+                                      (time.time() + lease_seconds, job, lease.item_id, owner, lease.token))
+                if cursor.rowcount == 0:
+                    lost.append(lease)
+        return lost
+
+    def complete(self, job: str, lease: Lease, owner: str) -> bool:
+        """
+        Records the item as done, if owner still holds the lease with this token.
+        """
+        with self.transaction() as conn:
+            if not self._holds(conn, job, lease, owner):
+                return False
+            conn.execute("INSERT OR IGNORE INTO completions (job, item, owner, token, finished) VALUES (?, ?, ?, ?, ?)",
+                         (job, lease.item_id, owner, lease.token, time.time()))
+            return True
+
+    def fail(self, job: str, lease: Lease, owner: str, error: str, max_attempts=MAX_ATTEMPTS) -> bool:
+        """
+        Releases the item for another attempt, or records it as failed after max_attempts.
+        Returns whether owner still held the lease.
+        """
+        with self.transaction() as conn:
+            if not self._holds(conn, job, lease, owner):
+                return False
+            conn.execute("UPDATE items SET attempts = attempts + 1 WHERE job = ? AND item = ?", (job, lease.item_id))
+            attempts = conn.execute("SELECT attempts FROM items WHERE job = ? AND item = ?", (job, lease.item_id)).fetchone()[0]
+            if attempts >= max_attempts:
+                conn.execute("INSERT OR IGNORE INTO completions (job, item, owner, token, finished, error) VALUES (?, ?, ?, ?, ?, ?)",
+                             (job, lease.item_id, owner, lease.token, time.time(), error))
+            else:
+                conn.execute("UPDATE leases SET expires = 0 WHERE job = ? AND item = ?", (job, lease.item_id))
+            return True
+
+    def pending(self, job: str) -> int:
+        return self.connection.execute("""
+            SELECT COUNT(*) FROM items i LEFT JOIN completions c ON c.job = i.job AND c.item = i.item
+            WHERE i.job = ? AND c.item IS NULL
+            """, (job,)).fetchone()[0]
+
+    def status(self, job: str) -> dict[str, int]:
+        conn = self.connection
+        total = conn.execute("SELECT COUNT(*) FROM items WHERE job = ?", (job,)).fetchone()[0]
+        done, failed = conn.execute("SELECT COUNT(*), COUNT(error) FROM completions WHERE job = ?", (job,)).fetchone()
+        leased = conn.execute("""
+            SELECT COUNT(*) FROM leases l LEFT JOIN completions c ON c.job = l.job AND c.item = l.item
+            WHERE l.job = ? AND c.item IS NULL AND l.expires >= ?
+            """, (job, time.time())).fetchone()[0]
+        return {"items": total, "done": done - failed, "failed": failed, "leased": leased, "pending": total - done - leased}
+
+    def errors(self, job: str) -> list[tuple[str, str]]:
+        return self.connection.execute("SELECT item, error FROM completions WHERE job = ? AND error IS NOT NULL", (job,)).fetchall()
+
+
+class Heartbeat(threading.Thread):
+    # renews the leases a worker holds until they are completed, and notes those it lost
+
+    def __init__(self, store: LeaseStore, job: str, owner: str, lease_seconds: float):
+        super().__init__(name="lease-heartbeat", daemon=True)
+        self.store = store
+        self.job = job
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.held: dict[str, Lease] = {}
+        self.lost: set[str] = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def hold(self, leases: Iterable[Lease]):
+        with self.lock:
+            self.held.update((lease.item_id, lease) for lease in leases)
+
+    def drop(self, lease: Lease):
+        with self.lock:
+            self.held.pop(lease.item_id, None)
+            self.lost.discard(lease.item_id)
+
+    def run(self):
+        while not self.stopped.wait(self.lease_seconds / 3):
+            with self.lock:
+                leases = list(self.held.values())
+            try:
+                lost = self.store.heartbeat(self.job, self.owner, leases, lease_seconds=self.lease_seconds)
+            except sqlite3.Error as e:
+                logger.warning(f"Heartbeat failed, retrying: {e}")
+                continue
+            with self.lock:
+                for lease in lost:
+                    if lease.item_id in self.held and lease.item_id not in self.lost:
+                        logger.warning(f"Lost the lease of {lease.item_id}, another worker took it over")
+                        self.lost.add(lease.item_id)
+
+    def stop(self):
+        self.stopped.set()
+
+
+class Worker:
+    """
+    Works on the items of one shard of a job, then on expired and unclaimed items of the others.
+    Should be run in an APIContextManager.
+    """
+
+    def __init__(self, store: LeaseStore, job: str, shard: int | None = None, shards=1, workers=batch.DEFAULT_WORKERS,
+                 owner: str | None = None, lease_seconds=LEASE_SECONDS, lease_batch=LEASE_BATCH, steal=True):
+        self.store = store
+        self.job = job
+        self.shard = shard
+        self.shards = shards
+        self.workers = workers
+        self.owner = owner if owner is not None else f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.lease_seconds = lease_seconds
+        self.lease_batch = lease_batch
+        self.steal = steal
+        self.counts = {"done": 0, "failed": 0, "lost": 0}
+
+    def __repr__(self):
+        return f"Worker({self.owner}, {self.job}, shard {self.shard}/{self.shards})"
+
+    def _acquire(self) -> list[Lease]:
+        leases = self.store.acquire(self.job, self.owner, limit=self.lease_batch, shard=self.shard, shards=self.shards, lease_seconds=self.lease_seconds)
+        if not leases and self.steal and self.shard is not None:
+            leases = self.store.acquire(self.job, self.owner, limit=self.lease_batch, lease_seconds=self.lease_seconds)
+        return leases
+
+    def _work(self, leases: list[Lease]) -> dict[str, Exception | None]:
+        calls = {}
+        errors: dict[str, Exception | None] = {}
+        for lease in leases:
+            try:
+                if not api_context_states.is_supported_annotation(lease.item.question):
+                    raise KeyError(f"{lease.item.question} is not a question of {api_context_states.get_prompt_folder()}")
+                calls[lease.item_id] = lease.item.call()
+            except Exception as e:
+                errors[lease.item_id] = e
+        post.prefetch(p for call in calls.values() for p in call.posts)
+        _, call_errors = batch.run_layers(batch.call_layers(calls.values()), workers=self.workers)
+        for item_id, call in calls.items():
+            errors[item_id] = call_errors.get(call.key)
+        return errors
+
+    def _record(self, heartbeat: Heartbeat, lease: Lease, error: Exception | None):
+        if error is None:
+            held = self.store.complete(self.job, lease, self.owner)
+        else:
+            held = self.store.fail(self.job, lease, self.owner, f"{type(error).__name__}: {error}")
+        heartbeat.drop(lease)
+        if not held:
+            # the cache writes are idempotent, only the completion is left to the new holder
+            logger.warning(f"Not recording {lease.item_id}, its lease was taken over")
+            self.counts["lost"] += 1
+        else:
+            self.counts["done" if error is None else "failed"] += 1
+
+    def run(self) -> dict[str, int]:
+        # annotations of the job get deterministic ids, so that each call is written once
+        context = api_context_states.get_run_context().replace(annotation_namespace=f"job:{self.job}", prefetch=False)
+        heartbeat = Heartbeat(self.store, self.job, self.owner, self.lease_seconds)
+        heartbeat.start()
+        try:
+            while True:
+                leases = self._acquire()
+                if not leases:
+                    if self.store.pending(self.job) == 0:
+                        break
+                    # the remaining items are leased by others, wait for them to finish or expire
+                    time.sleep(POLL_SECONDS)
+                    continue
+                heartbeat.hold(leases)
+                logger.info(f"{self} leased {len(leases)} items")
+                errors = context.run(self._work, leases)
+                for lease in leases:
+                    self._record(heartbeat, lease, errors.get(lease.item_id))
+        finally:
+            heartbeat.stop()
+        logger.info(f"{self} finished: {self.counts}")
+        return self.counts
+
+
+def read_manifest(path: str) -> list[WorkItem]:
+    with open(path, "rt") as f:
+        return [WorkItem.from_json(line) for line in f if line.strip()]
+
+def work(path: str, job: str, shard: int | None = None, shards=1, workers=batch.DEFAULT_WORKERS, **context_args) -> dict[str, int]:
+    with api_context_manager.APIContextManager(**context_args):
+        return Worker(LeaseStore(path), job, shard=shard, shards=shards, workers=workers).run()
+
+def work_processes(path: str, job: str, first_shard: int, processes: int, shards: int, workers=batch.DEFAULT_WORKERS, **context_args):
+    """
+    Runs a worker process for each of the shards first_shard to first_shard + processes - 1.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    children = [ctx.Process(target=work, args=(path, job, shard, shards, workers), kwargs=context_args, name=f"shard-{shard}")
+                for shard in range(first_shard, first_shard + processes)]
+    for child in children:
+        child.start()
+    for child in children:
+        child.join()
+    return [child.exitcode for child in children]
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(required=True, dest="subcommand")
+    submit = subparsers.add_parser("submit", help="add the work items of a manifest to a job")
+    submit.add_argument("store")
+    submit.add_argument("manifest")
+    submit.add_argument("--job", required=True)
+    worker = subparsers.add_parser("work", help="work on a job until all of its items are done")
+    worker.add_argument("store")
+    worker.add_argument("--job", required=True)
+    worker.add_argument("--shards", type=int, default=1)
+    worker.add_argument("--shard", type=int, default=0, help="first shard of this host")
+    worker.add_argument("--processes", type=int, default=1, help="worker processes on this host, one per shard")
+    worker.add_argument("--workers", type=int, default=batch.DEFAULT_WORKERS, help="calls in flight per process")
+    worker.add_argument("--corpus", default=api_context_states.DEFAULT_CORPUS)
+    worker.add_argument("--rdf_uri", default=api_context_states.DEFAULT_RDF_URI)
+    status = subparsers.add_parser("status", help="count the items of a job by state")
+    status.add_argument("store")
+    status.add_argument("--job", required=True)
+    args = parser.parse_args()
+
+    if args.subcommand == "submit":
+        n = LeaseStore(args.store).submit(args.job, read_manifest(args.manifest))
+        logger.info(f"Added {n} items to {args.job}")
+    elif args.subcommand == "work":
+        context_args = {"corpus": args.corpus, "rdf_uri": args.rdf_uri}
+        if args.processes > 1:
+            work_processes(args.store, args.job, args.shard, args.processes, args.shards, workers=args.workers, **context_args)
+        else:
+            work(args.store, args.job, shard=args.shard, shards=args.shards, workers=args.workers, **context_args)
+    elif args.subcommand == "status":
+        store = LeaseStore(args.store)
+        print(json.dumps(store.status(args.job)))
+        for item_id, error in store.errors(args.job):
+            print(item_id, error)
+    else:
+        raise ValueError(f"Unknown subcommad: {args.subcommand}")
@@ -0,0 +1,104 @@
+"""
+Several questions, or versions of a question, over one set of posts.
+
+Comparing `rewrite_0_1` through `rewrite_0_6`, or running unary, distill and
+rewrite on the same posts, as separate runs loads the posts and resolves their
+shared dependencies once per run. Here the posts are loaded once, the calls of
+every question are expanded into one dependency graph (see batch.py), so that a
+dependency shared by several questions is scheduled once, and all of them run
+together. The results are laid out side by side, one row per posts, one column
+per question:
+
+    with APIContextManager():
+        print(fanout.fan_out(["rewrite_0_*", "unary_1"], [[edit] for edit in edits]).format())
+
+Names may be globs over the full names of the question files, e.g. `rewrite_0_*`
+for every minor version of `rewrite_0`. Failed calls are reported in their cell
+instead of failing the whole comparison.
+"""
+from dataclasses import dataclass
+import fnmatch
+import logging
+import os
+from typing import Iterable
+
+from annotation import api_context_states, batch, post
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+COLUMN_WIDTH = int(os.getenv("FANOUT_COLUMN_WIDTH", 32))
+
+
+def _post_label(edit) -> str:
+    if isinstance(edit, post.Edit):
+        return edit.mastodon_id
+    return repr(edit)
+
+def _cell(result) -> str | None:
+    if isinstance(result, Exception):
+        return f"error: {result}"
+    return None if result is None else str(result)
+
+def _truncate(s: str, width: int) -> str:
+    s = " ".join(s.split())
+    return s if len(s) <= width else s[:width - 1] + "…"
+
+
+@dataclass
+class FanOut:
+    questions: list[str]
+    posts: list[tuple]
+    results: dict[str, list] # question -> result for each posts, or the exception it raised
+
+    def records(self) -> list[dict]:
+        """
+        One dict per posts, with the posts and the result of each question as strings.
+        """
+        return [{"posts": [_post_label(p) for p in posts], **{q: _cell(self.results[q][i]) for q in self.questions}}
+                for i, posts in enumerate(self.posts)]
+
+    def format(self, width=COLUMN_WIDTH) -> str:
+        columns = ["posts", *self.questions]
+        rows = [[", ".join(record["posts"]), *[str(record[q]) for q in self.questions]] for record in self.records()]
+        lines = [" | ".join(_truncate(c, width).ljust(width) for c in columns).rstrip()]
+        lines.append("-" * len(lines[0]))
+        lines.extend(" | ".join(_truncate(c, width).ljust(width) for c in row).rstrip() for row in rows)
+        return "\n".join(lines)
+
+
+def expand(names: Iterable[str]) -> list[str]:
+    """
+    The questions named, with globs expanded to the matching question files in version order.
+    """
+    registry = api_context_states.get_registry()
+    supported = api_context_states.get_run_context().supported_annotations
+    out = []
+    for name in names:
+        if any(c in name for c in "*?["):
+            matches = fnmatch.filter(registry.fullnames(), name)
+            if not matches:
+                raise KeyError(f"No question file matches {name}")
+            out.extend(matches)
+        elif name not in supported:
+            raise KeyError(f"{name} is not a question of {registry.folder}")
+        else:
+            out.append(name)
+    return list(dict.fromkeys(out))
+
+def fan_out(names: Iterable[str], edits: Iterable[Iterable], workers=batch.DEFAULT_WORKERS, speculative=False, **kwargs) -> FanOut:
+    """
+    Answers every question of names for each tuple of posts in edits, all scheduled
+    together. kwargs are passed to every question, per question overrides go in the
+    cmdline_args of the context. Should be called in an APIContextManager.
+    """
+    questions = expand(names)
+    posts = [tuple(p) for p in edits]
+    # one batched load for all questions, instead of one per question
+    post.prefetch(p for ps in posts for p in ps)
+    calls = {q: [batch.Call(q, ps, kwargs) for ps in posts] for q in questions}
+    layers = batch.call_layers([call for question_calls in calls.values() for call in question_calls], speculative=speculative)
+    logger.info(f"Running {len(questions)} questions on {len(posts)} posts in {len(layers)} layers of {', '.join(str(len(layer)) for layer in layers)} calls")
+    results, errors = batch.run_layers(layers, workers=workers)
+    return FanOut(questions, posts, {q: [errors[call.key] if call.key in errors else results.get(call.key) for call in question_calls]
+                                     for q, question_calls in calls.items()})
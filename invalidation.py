@@ -0,0 +1,184 @@
+"""
+Finding and recomputing the cached annotations a prompt change invalidated.
+
+A cached annotation is only returned while its question, and every question it
+depends on (its `annot:dep` triples), still has the hash of a question file in
+the prompt folder. Editing `thread_1_0.yaml` or removing `distill_1_0.yaml`
+therefore invalidates its own annotations and those of every question that
+used it. `DependencyIndex` loads the annotations and their dependencies from
+Jena and indexes them by question hash, and `reannotate` recomputes only the
+invalidated (question, posts, args) combinations, layer by layer in dependency
+order, reusing every result that is still valid.
+
+    python3 -m annotation.annotate reannotate --question unary_1_0 binary_1_0 --dry_run
+
+The args of a call are read from `annot:call_args`, annotations cached before
+it was recorded are repeated with the default args.
+"""
+from collections import defaultdict
+from dataclasses import dataclass, field
+import json
+import logging
+from typing import Iterable
+
+import dateutil.parser
+
+from annotation import api_context_states, batch, cache, post, utils
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+@dataclass
+class CachedAnnotation:
+    uri: str
+    name: str
+    major: int
+    minor: int
+    quest_hash: str
+    call_hash: str
+    timestamp: str
+    call_args: dict | None = None
+    dependencies: set[str] = field(default_factory=set) # question hashes
+    posts: dict[int, tuple[str, str, str]] = field(default_factory=dict) # index -> (mastodon id, timestamp, content)
+
+    @property
+    def fullname(self):
+        return f"{self.name}_{self.major}_{self.minor}"
+
+    def is_valid(self, question_hashes: set[str]) -> bool:
+        return self.quest_hash in question_hashes and self.dependencies <= question_hashes
+
+    def edits(self) -> tuple:
+        out = []
+        for i in sorted(self.posts):
+            mastodon_id, timestamp, content = self.posts[i]
+            if mastodon_id == "0": # EditFromStr and EditFromFile
+                out.append(post.EditFromStr(content))
+            else:
+                out.append(post.Edit.new(mastodon_id, dateutil.parser.parse(timestamp)))
+        return tuple(out)
+
+    def call(self) -> batch.Call:
+        return batch.Call(self.fullname, self.edits(), self.call_args if self.call_args is not None else {})
+
+
+def _values(variable, values):
+    if values is None:
+        return ""
+    return f"VALUES ?{variable} {{ {' '.join(utils.sparql_dumps(v) for v in values)} }}"
+
+class DependencyIndex:
+    """
+    The cached annotations of some questions (all by default), indexed by the
+    hashes of the questions they were computed with and depend on.
+    """
+
+    def __init__(self, names: Iterable[str] | None = None):
+        self.names = sorted(set(names)) if names is not None else None
+        self.annotations: dict[str, CachedAnnotation] = {}
+        self.by_question: dict[str, set[str]] = defaultdict(set) # question hash -> uris of its annotations and of those depending on it
+        self.load()
+
+    def load(self):
+        names = _values("name", self.names)
+        for b in cache.get_bindings(f"""
+            SELECT ?annot ?name ?major ?minor ?qhash ?call_hash ?time ?call_args WHERE {{
+                ?annot annot:quest ?quest .
+                ?quest quest:name ?name .
+                {names}
+                ?quest quest:major ?major .
+                ?quest quest:minor ?minor .
+                ?quest quest:hash ?qhash .
+                ?annot annot:call_hash ?call_hash .
+                ?annot annot:timestamp ?time .
+                OPTIONAL {{ ?annot annot:call_args ?call_args . }}
+            }}
+            """):
+            uri = b["annot"]["value"]
+            self.annotations[uri] = CachedAnnotation(uri, b["name"]["value"], int(b["major"]["value"]), int(b["minor"]["value"]),
+                                                     b["qhash"]["value"], b["call_hash"]["value"], b["time"]["value"],
+                                                     json.loads(b["call_args"]["value"]) if "call_args" in b else None)
+            self.by_question[b["qhash"]["value"]].add(uri)
+        for b in cache.get_bindings(f"""
+            SELECT ?annot ?dep_hash WHERE {{
+                ?annot annot:quest ?quest .
+                ?quest quest:name ?name .
+                {names}
+                ?annot annot:dep ?dep .
+                ?dep quest:hash ?dep_hash .
+            }}
+            """):
+            annotation = self.annotations.get(b["annot"]["value"])
+            if annotation is not None:
+                annotation.dependencies.add(b["dep_hash"]["value"])
+                self.by_question[b["dep_hash"]["value"]].add(annotation.uri)
+        logger.info(f"Indexed {len(self.annotations)} cached annotations of {len(self.by_question)} questions")
+
+    def load_posts(self, annotations: Iterable[CachedAnnotation]):
+        annotations = {a.uri: a for a in annotations}
+        uris = list(annotations)
+        for i in range(0, len(uris), 500):
+            for b in cache.get_bindings(f"""
+                SELECT ?annot ?p ?id ?time ?content WHERE {{
+                    VALUES ?annot {{ {' '.join(f'<{uri}>' for uri in uris[i:i + 500])} }}
+                    ?annot ?p ?post .
+                    FILTER (STRSTARTS(STR(?p), STR(annot:post)))
+                    ?post post:id ?id .
+                    ?post post:timestamp ?time .
+                    ?post post:content ?content .
+                }}
+                """):
+                index = int(b["p"]["value"].rsplit("post", 1)[1])
+                annotations[b["annot"]["value"]].posts[index] = (b["id"]["value"], b["time"]["value"], b["content"]["value"])
+
+    def dependents(self, quest_hash: str) -> list[CachedAnnotation]:
+        """
+        The annotations of the question with this hash and those that depend on it.
+        """
+        return [self.annotations[uri] for uri in self.by_question.get(quest_hash, ())]
+
+    def invalidated(self, question_hashes: Iterable[str] | None = None) -> list[CachedAnnotation]:
+        """
+        The latest annotation of every (question version, call) that has no valid
+        cached annotation for the current question files.
+        """
+        question_hashes = set(question_hashes if question_hashes is not None else api_context_states.question_hashes())
+        calls: dict[tuple, list[CachedAnnotation]] = defaultdict(list)
+        for annotation in self.annotations.values():
+            calls[(annotation.fullname, annotation.call_hash)].append(annotation)
+        out = []
+        for annotations in calls.values():
+            if any(a.is_valid(question_hashes) for a in annotations):
+                continue
+            out.append(max(annotations, key=lambda a: dateutil.parser.parse(a.timestamp)))
+        return out
+
+
+def reannotate(names: Iterable[str] | None = None, workers=batch.DEFAULT_WORKERS, dry_run=False) -> list[batch.Call]:
+    """
+    Recomputes the invalidated annotations of the questions names (all by default)
+    in dependency order. Returns the calls that were (or with dry_run, would be) made.
+    Should be called in an APIContextManager that reads and writes the cache.
+    """
+    index = DependencyIndex(names)
+    supported = api_context_states.get_run_context().supported_annotations
+    stale = []
+    for annotation in index.invalidated():
+        if annotation.fullname not in supported:
+            logger.warning(f"Not reannotating {annotation.uri}, {annotation.fullname} is no longer in the prompt folder")
+            continue
+        stale.append(annotation)
+    index.load_posts(stale)
+    calls = list({call.key: call for call in (a.call() for a in stale)}.values())
+    counts = defaultdict(int)
+    for call in calls:
+        counts[call.name] += 1
+    logger.info(f"{len(calls)} invalidated calls: {dict(counts)}")
+    if dry_run or not calls:
+        return calls
+    layers = batch.call_layers(calls)
+    _, errors = batch.run_layers(layers, workers=workers)
+    if errors:
+        logger.warning(f"{len(errors)} calls failed, run reannotate again to retry them")
+    return calls
@@ -0,0 +1,124 @@
+"""
+A local stand-in for the jena (fuseki) endpoints that `cache.py` uses, for
+exercising cache writes, e.g. of several distributed workers, without a server.
+
+    with JenaStub() as stub:
+        with APIContextManager(rdf_uri=stub.url):
+            ...
+        print(stub.subjects("annot:"))
+
+Updates (`INSERT DATA`, and the guarded inserts of `cache.insert_triples_once`)
+are applied to an in-memory list of triples, one at a time like jena does. The
+stub does not evaluate queries: every query answers with no bindings, so reads
+always miss the cache, unless `answer(query, triples)` is given, which returns
+the bindings of the queries a test needs answered.
+"""
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import threading
+from typing import Callable
+
+from annotation import cache
+
+INSERT_DATA_RE = re.compile(r"^\s*INSERT DATA \{(.*)\}\s*$", re.DOTALL)
+INSERT_ONCE_RE = re.compile(r"^\s*INSERT \{(.*)\} WHERE \{ FILTER NOT EXISTS \{ (\S+) \?p \?o \} \}\s*$", re.DOTALL)
+
+
+def parse_triples(body: str) -> list[tuple[str, str, str]]:
+    # as written by cache.insert_triples, one " s p o . " per line
+    triples = []
+    for line in body.split(" . \n"):
+        line = line.strip()
+        if line:
+            s, p, o = line.split(" ", 2)
+            triples.append((s, p, o))
+    return triples
+
+
+class JenaStub:
+
+    def __init__(self, answer: Callable[[str, list[tuple[str, str, str]]], list[dict]] | None = None, host="127.0.0.1", port=0):
+        self.triples: list[tuple[str, str, str]] = []
+        self.answer = answer
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+                status, payload = stub.handle(self.path, body)
+                data = json.dumps(payload).encode("utf-8") if payload is not None else b""
+                self.send_response(status)
+                if payload is not None:
+                    self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def subjects(self, prefix="") -> Counter:
+        """
+        How many triples each subject starting with prefix has.
+        """
+        with self.lock:
+            return Counter(s for s, _, _ in self.triples if s.startswith(prefix))
+
+    def update(self, command: str) -> bool:
+        command = "\n".join(line for line in command.splitlines() if not line.startswith("PREFIX "))
+        match = INSERT_DATA_RE.match(command)
+        if match is not None:
+            with self.lock:
+                self.triples.extend(parse_triples(match.group(1)))
+            return True
+        match = INSERT_ONCE_RE.match(command)
+        if match is not None:
+            subject = match.group(2)
+            with self.lock:
+                if any(s == subject for s, _, _ in self.triples):
+                    self.requests["skipped"] += 1
+                else:
+                    self.triples.extend(parse_triples(match.group(1)))
+            return True
+        return False
+
+    def handle(self, path, body):
+        if path == f"/{cache.UPDATE_ENDPOINT}":
+            self.requests["update"] += 1
+            return (204, None) if self.update(body) else (400, {"error": "unsupported update"})
+        if path == f"/{cache.QUERY_ENDPOINT}":
+            self.requests["query"] += 1
+            if self.answer is None:
+                return 200, {"head": {"vars": []}, "results": {"bindings": []}}
+            with self.lock:
+                triples = list(self.triples)
+            return 200, {"head": {"vars": []}, "results": {"bindings": self.answer(body, triples)}}
+        return 404, {"error": "not found"}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -49,6 +49,10 @@ class LLMResponse:
 
 
 class LLMOutput:
+    # declared, so that they are not looked up on the annotation by __getattr__
+    uri: str | None = None # of the cached response it was read from, see annotation.get_cached_request
+    request_hash: str | None = None # of the request it answers, see LLMAnnot.request_hash
+
     def __init__(
         self,
         responses: List[LLMResponse] | None = None,
@@ -80,6 +84,24 @@ class LLMOutput:
             raise TypeError("The input must be a dictionary")
         self.additional_info.update(info)
 
+    def truncated(self, num_answers: int) -> "LLMOutput | None":
+        """
+        The responses of the first num_answers samples (or top logprobs), as if only those had
+        been asked for. None if none of them is a legal response.
+        """
+        responses = sorted((r for r in self.responses if int(r.rank) < num_answers), key=lambda r: int(r.rank))
+        if not responses:
+            return None
+        return LLMOutput(responses=responses, additional_info=dict(self.additional_info))
+
+    def merged(self, other: "LLMOutput", offset: int) -> "LLMOutput":
+        """
+        The responses of both, the samples of other ranked after the offset samples of this one.
+        """
+        shifted = [LLMResponse(r.annotation, int(r.rank) + offset, r.logprobs, r.text) for r in sorted(other.responses, key=lambda r: int(r.rank))]
+        own = [LLMResponse(r.annotation, int(r.rank), r.logprobs, r.text) for r in sorted(self.responses, key=lambda r: int(r.rank))]
+        return LLMOutput(responses=own + shifted, additional_info=dict(self.additional_info))
+
     @property
     def distribution(self) -> Dict[Any, float]:
         assert (
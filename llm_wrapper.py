@@ -1,8 +1,8 @@
 from typing import List, Dict, Any
-from annotation import utils
+from annotation import cassette, utils
 from dotenv import load_dotenv
 import os
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 import paramiko
 import json
 import requests
@@ -15,11 +15,23 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
+def _canonical(x):
+    # 0 and 0.0 are the same parameter to the api, but not the same json
+    if isinstance(x, float) and x.is_integer():
+        return int(x)
+    if isinstance(x, dict):
+        return {str(k): _canonical(v) for k, v in x.items()}
+    if isinstance(x, (list, tuple)):
+        return [_canonical(v) for v in x]
+    return x
+
+
 class LLMAnnot:
     def __init__(self):
         load_dotenv()
         api_key = os.getenv("OPENAI_API_KEY")
         self.client = OpenAI(api_key=api_key)
+        self.aclient = AsyncOpenAI(api_key=api_key) # used from the annotation event loop, see aio.py
         self.allowed_openai_params = set(
             signature(self.client.chat.completions.create).parameters.keys()
         )
@@ -149,20 +161,7 @@ class LLMAnnot:
         finally:
             ssh_client.close()
 
-    def get_top_n_responses(
-        self,
-        prompt: List[Dict],
-        legal_answer_type,
-        num_answers: int = 1,
-        legal_answers: List[Any] = None,
-        method="openai",
-        **parameter_dict,
-    ):
-        """
-        Get the top-n responses from the OpenAI API, filtering out any response that cannot be converted to the specified type or is not within legal values.
-        paremeter_dict must be available OpenAI API parameters.
-        """
-        messages = self._convert_to_openai_format(prompt)
+    def _result_dict(self, method, messages, num_answers, parameter_dict) -> Dict[int, Dict]:
         if method in {"openai", "vLLM"}:
             if (
                 parameter_dict.get("max_tokens") is None
@@ -207,8 +206,38 @@ class LLMAnnot:
             result_dict = {0: {"text": annotation, "logprob": "dummy"}}
         else:
             raise NotImplementedError(f"{method} not implemented")
+        return result_dict
+
+    async def _aresult_dict(self, method, messages, num_answers, parameter_dict) -> Dict[int, Dict]:
+        from annotation import aio
+        if method != "openai":
+            # vLLM goes through ssh and human through the terminal, both blocking
+            return await aio.to_thread(method, self._result_dict, method, messages, num_answers, parameter_dict)
+        async with aio.semaphore("openai"):
+            if parameter_dict.get("max_tokens") != 1:
+                completion = await self.aclient.chat.completions.create(
+                    messages=messages,
+                    n=num_answers,
+                    logprobs=True,
+                    **parameter_dict,
+                )
+                return self._convert_response(completion.choices)
+            completion = await self.aclient.chat.completions.create(
+                messages=messages,
+                logprobs=True,
+                top_logprobs=num_answers,
+                **parameter_dict,
+            )
+            return self._convert_response_single(completion.choices[0].logprobs.content[0].top_logprobs)
+
+    def _request(self, method, messages, num_answers, parameter_dict) -> dict:
+        # what identifies an LLM request, e.g. to record and replay it (see cassette.py)
+        return {"method": method, "messages": messages, "num_answers": num_answers, "parameters": parameter_dict}
 
+    def _output(self, result_dict, legal_answer_type, legal_answers, method, parameter_dict):
         legal_answer_type_orig = legal_answer_type
+        # ranks come back as strings from a cassette
+        result_dict = {int(index): result for index, result in result_dict.items()}
         legal_answer_type = self._convert_type(legal_answer_type)
 
         output = []
@@ -252,35 +281,92 @@ class LLMAnnot:
         else:
             raise ValueError(f"No legal annotations are output! {result_dict}")
 
+    def get_top_n_responses(
+        self,
+        prompt: List[Dict],
+        legal_answer_type,
+        num_answers: int = 1,
+        legal_answers: List[Any] = None,
+        method="openai",
+        **parameter_dict,
+    ):
+        """
+        Get the top-n responses from the OpenAI API, filtering out any response that cannot be converted to the specified type or is not within legal values.
+        paremeter_dict must be available OpenAI API parameters.
+        """
+        messages = self._convert_to_openai_format(prompt)
+        result_dict = cassette.exchange("llm", self._request(method, messages, num_answers, parameter_dict),
+                                        lambda: self._result_dict(method, messages, num_answers, parameter_dict))
+        return self._output(result_dict, legal_answer_type, legal_answers, method, parameter_dict)
+
+    async def aget_top_n_responses(
+        self,
+        prompt: List[Dict],
+        legal_answer_type,
+        num_answers: int = 1,
+        legal_answers: List[Any] = None,
+        method="openai",
+        **parameter_dict,
+    ):
+        """
+        get_top_n_responses with AsyncOpenAI, awaited on the annotation event loop.
+        """
+        messages = self._convert_to_openai_format(prompt)
+        result_dict = await cassette.aexchange("llm", self._request(method, messages, num_answers, parameter_dict),
+                                               lambda: self._aresult_dict(method, messages, num_answers, parameter_dict))
+        return self._output(result_dict, legal_answer_type, legal_answers, method, parameter_dict)
+
+    def _llm_kwargs(self, method, kwargs, warn=True):
+        prompt = kwargs.pop("prompt")
+        legal_answer_type = kwargs.pop("legal_answer_type")
+        num_answers = kwargs.pop("num_answers", 1)
+        legal_answers = kwargs.pop("legal_answers", None)
+        if method == "openai":
+            parameter_dict = {}
+            for k, v in kwargs.items():
+                if k not in self.allowed_openai_params:
+                    if warn:
+                        logger.warning(f"{k} not used in openai create api, ignoring")
+                    continue
+                parameter_dict[k] = v
+        else:
+            parameter_dict = kwargs
+        return dict(
+            prompt=prompt,
+            legal_answer_type=legal_answer_type,
+            num_answers=num_answers,
+            legal_answers=legal_answers,
+            method=method,
+            **parameter_dict,
+        )
+
+    def request_hash(self, method, **kwargs) -> str | None:
+        """
+        Canonical hash of the request get_responses sends for kwargs, and of how its answers are
+        parsed, so that calls of different questions that render the same request share responses.
+        None for methods that do not call an LLM.
+        """
+        if method not in {"openai", "vLLM"}:
+            return None
+        kwargs = self._llm_kwargs(method, dict(kwargs), warn=False)
+        messages = self._convert_to_openai_format(kwargs.pop("prompt"))
+        parsing = {"legal_answer_type": kwargs.pop("legal_answer_type"), "legal_answers": kwargs.pop("legal_answers")}
+        request = self._request(kwargs.pop("method"), messages, kwargs.pop("num_answers"), kwargs)
+        return cassette.request_key(_canonical({**request, **parsing}))
+
     def get_responses(self, method, **kwargs):
         if method in {"openai", "vLLM", "human"}:
-            prompt = kwargs.pop("prompt")
-            legal_answer_type = kwargs.pop("legal_answer_type")
-            num_answers = kwargs.pop("num_answers", 1)
-            legal_answers = kwargs.pop("legal_answers", None)
-            if method == "openai":
-                parameter_dict = {}
-                for k, v in kwargs.items():
-                    if k not in self.allowed_openai_params:
-                        logger.warning(f"{k} not used in openai create api, ignoring")
-                        continue
-                    parameter_dict[k] = v
-            else:
-                parameter_dict = kwargs
-
-            return self.get_top_n_responses(
-                prompt=prompt,
-                legal_answer_type=legal_answer_type,
-                num_answers=num_answers,
-                legal_answers=legal_answers,
-                method=method,
-                **parameter_dict,
-            )
+            return self.get_top_n_responses(**self._llm_kwargs(method, kwargs))
         elif method == "static":
             return StaticOutput(kwargs["value"])
         elif method == "python":
             return PythonOutput(kwargs["expr"])
 
+    async def aget_responses(self, method, **kwargs):
+        if method in {"openai", "vLLM", "human"}:
+            return await self.aget_top_n_responses(**self._llm_kwargs(method, kwargs))
+        return self.get_responses(method, **kwargs)
+
 
 if __name__ == "__main__":
     # Test final output codes
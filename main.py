@@ -1,10 +1,10 @@
-from annotation import api_context_manager, api_context_states
+from annotation import api_context_manager, api_context_states, batch, fanout, invalidation, planner, summarize
 import logging
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-def annotate(name, edits, cmdline_args=None, no_read=not api_context_states.DEFAULT_READ_CACHE, no_write=not api_context_states.DEFAULT_WRITE_CACHE, only_cache= api_context_states.DEFAULT_ONLY_CACHE, dump_jena=api_context_states.DEFAULT_DUMP_JENA_REQUEST):
+def annotate(name, edits, cmdline_args=None, no_read=not api_context_states.DEFAULT_READ_CACHE, no_write=not api_context_states.DEFAULT_WRITE_CACHE, only_cache= api_context_states.DEFAULT_ONLY_CACHE, dump_jena=api_context_states.DEFAULT_DUMP_JENA_REQUEST, corpus=api_context_states.DEFAULT_CORPUS):
     """
     cmdline_args maps names like `evidence_0_0` to a dictionary containing 
     argument overrides (another dict) for that particular annotation.
@@ -14,13 +14,84 @@ def annotate(name, edits, cmdline_args=None, no_read=not api_context_states.DEFA
     if cmdline_args is None:
         cmdline_args = {}
     logger.info(f"cmdline_args={cmdline_args}")
-    with api_context_manager.APIContextManager(cmdline_args=cmdline_args,read_cache=not no_read, write_cache=not no_write, only_cache=only_cache, dump_jena_request=dump_jena):
+    with api_context_manager.APIContextManager(cmdline_args=cmdline_args,read_cache=not no_read, write_cache=not no_write, only_cache=only_cache, dump_jena_request=dump_jena, corpus=corpus):
         f = api_context_states.get_supported_annotation(name)
         logger.info(f"default args: {f.default_args}")
         logger.info(f"override args: {f.cmdline_override_args}")
         result = f(*edits)
     return result
 
+async def annotate_async(name, edits, cmdline_args=None, no_read=not api_context_states.DEFAULT_READ_CACHE, no_write=not api_context_states.DEFAULT_WRITE_CACHE, only_cache= api_context_states.DEFAULT_ONLY_CACHE, dump_jena=api_context_states.DEFAULT_DUMP_JENA_REQUEST, corpus=api_context_states.DEFAULT_CORPUS):
+    """
+    annotate for asyncio callers, e.g. `await asyncio.gather(*[annotate_async(name, [edit]) for edit in edits])`.
+    LLM requests are awaited with AsyncOpenAI instead of holding a thread (see aio.py).
+    """
+    if cmdline_args is None:
+        cmdline_args = {}
+    with api_context_manager.APIContextManager(cmdline_args=cmdline_args,read_cache=not no_read, write_cache=not no_write, only_cache=only_cache, dump_jena_request=dump_jena, corpus=corpus):
+        return await api_context_states.get_supported_annotation(name).acall(*edits)
+
+def annotate_batch(name, edits, cmdline_args=None, no_read=not api_context_states.DEFAULT_READ_CACHE, no_write=not api_context_states.DEFAULT_WRITE_CACHE, only_cache= api_context_states.DEFAULT_ONLY_CACHE, dump_jena=api_context_states.DEFAULT_DUMP_JENA_REQUEST, corpus=api_context_states.DEFAULT_CORPUS, workers=batch.DEFAULT_WORKERS, processes=batch.DEFAULT_PROCESSES):
+    """
+    Like annotate, for each list of edits in edits, running the dependencies of
+    all of them layer by layer (see batch.py), on processes worker processes if
+    set. Returns the results in order.
+    """
+    if cmdline_args is None:
+        cmdline_args = {}
+    with api_context_manager.APIContextManager(cmdline_args=cmdline_args,read_cache=not no_read, write_cache=not no_write, only_cache=only_cache, dump_jena_request=dump_jena, corpus=corpus):
+        return batch.annotate_batch(name, edits, workers=workers, processes=processes)
+
+async def annotate_batch_async(name, edits, cmdline_args=None, no_read=not api_context_states.DEFAULT_READ_CACHE, no_write=not api_context_states.DEFAULT_WRITE_CACHE, only_cache= api_context_states.DEFAULT_ONLY_CACHE, dump_jena=api_context_states.DEFAULT_DUMP_JENA_REQUEST, corpus=api_context_states.DEFAULT_CORPUS, workers=batch.DEFAULT_WORKERS):
+    """
+    annotate_batch for asyncio callers, workers is the number of calls in flight.
+    """
+    if cmdline_args is None:
+        cmdline_args = {}
+    with api_context_manager.APIContextManager(cmdline_args=cmdline_args,read_cache=not no_read, write_cache=not no_write, only_cache=only_cache, dump_jena_request=dump_jena, corpus=corpus):
+        return await batch.aannotate_batch(name, edits, workers=workers)
+
+def fan_out(names, edits, cmdline_args=None, no_read=not api_context_states.DEFAULT_READ_CACHE, no_write=not api_context_states.DEFAULT_WRITE_CACHE, only_cache= api_context_states.DEFAULT_ONLY_CACHE, dump_jena=api_context_states.DEFAULT_DUMP_JENA_REQUEST, corpus=api_context_states.DEFAULT_CORPUS, workers=batch.DEFAULT_WORKERS):
+    """
+    Answers each question of names (globs like `rewrite_0_*` allowed) for each list of
+    edits in edits, in one run that shares the posts and dependencies (see fanout.py).
+    Returns a fanout.FanOut, whose format() lays the results out side by side.
+    """
+    if cmdline_args is None:
+        cmdline_args = {}
+    with api_context_manager.APIContextManager(cmdline_args=cmdline_args,read_cache=not no_read, write_cache=not no_write, only_cache=only_cache, dump_jena_request=dump_jena, corpus=corpus):
+        return fanout.fan_out(names, edits, workers=workers)
+
+def summarize_posts(edits, cmdline_args=None, no_read=not api_context_states.DEFAULT_READ_CACHE, no_write=not api_context_states.DEFAULT_WRITE_CACHE, only_cache= api_context_states.DEFAULT_ONLY_CACHE, dump_jena=api_context_states.DEFAULT_DUMP_JENA_REQUEST, corpus=api_context_states.DEFAULT_CORPUS, workers=batch.DEFAULT_WORKERS, **kwargs):
+    """
+    Summary of a post set of any size, merged from the summaries of its chunks in a
+    tree (see summarize.py). kwargs override the args of summary_tree_1, e.g. chunk_size.
+    """
+    if cmdline_args is None:
+        cmdline_args = {}
+    with api_context_manager.APIContextManager(cmdline_args=cmdline_args,read_cache=not no_read, write_cache=not no_write, only_cache=only_cache, dump_jena_request=dump_jena, corpus=corpus):
+        return summarize.summarize(edits, workers=workers, **kwargs)
+
+def plan(name, edits, cmdline_args=None, no_read=not api_context_states.DEFAULT_READ_CACHE, only_cache= api_context_states.DEFAULT_ONLY_CACHE, corpus=api_context_states.DEFAULT_CORPUS, workers=batch.DEFAULT_WORKERS):
+    """
+    Dry run of annotate_batch: cache hits and misses, tokens, cost and wall time
+    per question (see planner.py), without calling any LLM or writing to the cache.
+    """
+    if cmdline_args is None:
+        cmdline_args = {}
+    with api_context_manager.APIContextManager(cmdline_args=cmdline_args,read_cache=not no_read, write_cache=False, only_cache=only_cache, corpus=corpus):
+        return planner.plan(name, edits, workers=workers)
+
+def reannotate(names=None, cmdline_args=None, corpus=api_context_states.DEFAULT_CORPUS, workers=batch.DEFAULT_WORKERS, dry_run=False):
+    """
+    Recomputes the cached annotations of names (all questions by default) that prompt
+    changes invalidated, in dependency order (see invalidation.py). Returns the calls.
+    """
+    if cmdline_args is None:
+        cmdline_args = {}
+    with api_context_manager.APIContextManager(cmdline_args=cmdline_args, corpus=corpus):
+        return invalidation.reannotate(names, workers=workers, dry_run=dry_run)
+
 if __name__ == "__main__":
     from annotation import post
     annotate('unary_0_5', [post.Post("112794058427962391").latest()], dump_jena=True, no_read=True)
\ No newline at end of file
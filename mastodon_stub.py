@@ -0,0 +1,152 @@
+"""
+A local stand-in for the parts of the mastodon api that `post.py` uses, for
+exercising post loading without a real server.
+
+    with MastodonStub(statuses, histories) as stub:
+        with APIContextManager(mastodon_url=stub.url):
+            ...
+        print(stub.requests)
+
+`statuses` maps ids to status json and `histories` maps ids to history json
+(statuses without a history are treated as never edited). Contexts are derived
+from `in_reply_to_id`. Set `batch=False` to behave like an older server that
+does not support GET /v1/statuses?id[]=..., and `rate_limit=(requests, seconds)`
+to send X-RateLimit headers of windows of that many requests and to throttle
+(429) the requests over the budget, counted as `requests["throttled"]`.
+"""
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+from annotation import post
+
+
+class MastodonStub:
+
+    def __init__(self, statuses: dict[str, dict], histories: dict[str, list[dict]] | None = None, batch=True,
+                 rate_limit: tuple[int, float] | None = None, host="127.0.0.1", port=0):
+        self.statuses = statuses
+        self.histories = histories if histories is not None else {}
+        self.batch = batch
+        self.rate_limit = rate_limit
+        self.window_reset = 0.0
+        self.window_requests = 0
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                throttled, headers = stub.take_rate_limit()
+                if throttled:
+                    status, body = 429, {"error": "Too many requests"}
+                else:
+                    status, body = stub.handle(url.path, parse_qs(url.query))
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/api"
+
+    def count(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] += 1
+
+    def take_rate_limit(self) -> tuple[bool, dict[str, str]]:
+        # whether the request is over the budget, and the rate limit headers of its response
+        if self.rate_limit is None:
+            return False, {}
+        limit, seconds = self.rate_limit
+        with self.lock:
+            now = time.time()
+            if now >= self.window_reset:
+                # windows start with their first request
+                self.window_reset = now + seconds
+                self.window_requests = 0
+            self.window_requests += 1
+            throttled = self.window_requests > limit
+            if throttled:
+                self.requests["throttled"] += 1
+            reset = datetime.fromtimestamp(self.window_reset, timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+            return throttled, {"X-RateLimit-Limit": str(limit),
+                               "X-RateLimit-Remaining": str(max(0, limit - self.window_requests)),
+                               "X-RateLimit-Reset": reset}
+
+    def ancestors(self, mastodon_id):
+        out = []
+        parent_id = self.statuses[mastodon_id].get("in_reply_to_id")
+        while parent_id in self.statuses:
+            out.append(self.statuses[parent_id])
+            parent_id = self.statuses[parent_id].get("in_reply_to_id")
+        return out[::-1]
+
+    def descendants(self, mastodon_id):
+        children = {}
+        for status in self.statuses.values():
+            children.setdefault(status.get("in_reply_to_id"), []).append(status)
+        out = []
+        stack = list(reversed(children.get(mastodon_id, [])))
+        while stack:
+            status = stack.pop()
+            out.append(status)
+            stack.extend(reversed(children.get(status["id"], [])))
+        return out
+
+    def handle(self, path, query):
+        not_found = (404, {"error": "Record not found"})
+        if path == "/api/v1/statuses":
+            self.count("statuses")
+            if not self.batch:
+                return not_found
+            ids = query.get("id[]", [])[:post.STATUSES_BATCH_SIZE]
+            return 200, [self.statuses[id] for id in ids if id in self.statuses]
+        match = re.match(r"^/api/v1/statuses/([^/]+)(?:/(history|context))?$", path)
+        if match is None:
+            return not_found
+        mastodon_id, endpoint = match.group(1), match.group(2) or "status"
+        self.count(endpoint)
+        if mastodon_id not in self.statuses:
+            return not_found
+        if endpoint == "status":
+            return 200, self.statuses[mastodon_id]
+        if endpoint == "history":
+            if mastodon_id in self.histories:
+                return 200, self.histories[mastodon_id]
+            return 200, post.history_from_status(self.statuses[mastodon_id])
+        return 200, {"ancestors": self.ancestors(mastodon_id), "descendants": self.descendants(mastodon_id)}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -0,0 +1,154 @@
+"""
+Dry runs of a batch: what a run would cost, without calling any LLM.
+
+The plan walks the dependency closure of the batch (see batch.py), checks the
+Jena cache in bulk for each question, and renders the prompts of the calls that
+are not cached, with their own uncached dependencies left as None. From these
+it estimates prompt and completion tokens, dollar cost, and the wall time of a
+layer-wise run with a given number of workers.
+
+    with APIContextManager():
+        print(planner.plan("binary_1", [(reply, parent) for reply, parent in pairs]).format())
+
+Completion tokens are not known before the call, they are estimated as
+max_tokens if the question sets it, PLAN_COMPLETION_TOKENS (300) otherwise.
+Wall time assumes PLAN_LLM_LATENCY seconds (2) per LLM call plus
+PLAN_OUTPUT_TOKENS_PER_SECOND (60) for the completion, and PLAN_LOOKUP_LATENCY
+seconds (0.05) per cache lookup.
+"""
+from dataclasses import dataclass, field
+import logging
+import os
+from typing import Iterable
+
+from annotation import api_context_states, batch, tokens
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+COMPLETION_TOKENS = int(os.getenv("PLAN_COMPLETION_TOKENS", 300))
+LLM_LATENCY = float(os.getenv("PLAN_LLM_LATENCY", 2.0))
+OUTPUT_TOKENS_PER_SECOND = float(os.getenv("PLAN_OUTPUT_TOKENS_PER_SECOND", 60.0))
+LOOKUP_LATENCY = float(os.getenv("PLAN_LOOKUP_LATENCY", 0.05))
+LLM_METHODS = ("openai", "vLLM")
+
+
+@dataclass
+class QuestionPlan:
+    name: str
+    calls: int = 0
+    hits: int = 0
+    misses: int = 0
+    llm_calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cost: float = 0.0
+    unpriced_calls: int = 0 # llm calls of models without a known price
+    unrendered: int = 0 # misses whose prompt could not be rendered without their dependencies, estimated from the template
+    models: set[str] = field(default_factory=set)
+
+
+@dataclass
+class Plan:
+    name: str
+    posts: int
+    layers: list[list[str]]
+    questions: dict[str, QuestionPlan]
+    wall_seconds: float
+    workers: int
+
+    @property
+    def total(self) -> QuestionPlan:
+        total = QuestionPlan("total")
+        for q in self.questions.values():
+            for key in ("calls", "hits", "misses", "llm_calls", "prompt_tokens", "completion_tokens", "cost", "unpriced_calls", "unrendered"):
+                setattr(total, key, getattr(total, key) + getattr(q, key))
+            total.models |= q.models
+        return total
+
+    def format(self) -> str:
+        header = f"{'question':<24} {'calls':>7} {'hits':>7} {'misses':>7} {'llm':>7} {'prompt tok':>11} {'compl tok':>10} {'cost $':>9}  models"
+        lines = [f"Plan for {self.name} on {self.posts} posts, {len(self.layers)} layers, {self.workers} workers", header, "-" * len(header)]
+        for q in [*self.questions.values(), self.total]:
+            unpriced = f" (+{q.unpriced_calls} unpriced)" if q.unpriced_calls else ""
+            unpriced += f" ({q.unrendered} estimated from the template)" if q.unrendered else ""
+            lines.append(f"{q.name:<24} {q.calls:>7} {q.hits:>7} {q.misses:>7} {q.llm_calls:>7} {q.prompt_tokens:>11} {q.completion_tokens:>10} {q.cost:>9.2f}  {', '.join(sorted(q.models))}{unpriced}")
+        lines.append(f"Expected wall time: {self.wall_seconds / 60:.1f} min")
+        return "\n".join(lines)
+
+
+def _completion_tokens(annotation_args: dict) -> int:
+    max_tokens = annotation_args.get("max_tokens")
+    if max_tokens == 1:
+        return 1 # top logprobs of a single token
+    return (max_tokens or COMPLETION_TOKENS) * annotation_args.get("num_answers", 1)
+
+def _render(call: batch.Call):
+    f = api_context_states.get_supported_annotation(call.name)
+    args = f._get_overidden_args(**call.kwargs)
+    return f._merge_args(f.render_parse(*call.posts, **call.kwargs), args)
+
+def _unrendered(call: batch.Call):
+    # the template itself stands in for the prompt
+    f = api_context_states.get_supported_annotation(call.name)
+    args = f._get_overidden_args(**call.kwargs)
+    annotation_args = {"method": "openai" if "prompt:" in f.rendered_last_doc else "static", "prompt": [{"user": f.documents[-1]}]}
+    return f._merge_args(annotation_args, args)
+
+def plan(name: str, edits: Iterable[Iterable], workers=batch.DEFAULT_WORKERS, speculative=False, **kwargs) -> Plan:
+    """
+    Plans answering question name for each tuple of posts in edits, as batch.annotate_batch would.
+    Should be called in an APIContextManager, whose cache flags are those of the planned run.
+    """
+    context = api_context_states.get_run_context()
+    # uncached dependencies render as None instead of calling the LLM, and nothing is written
+    render_context = context.replace(read_cache=True, only_cache=True, write_cache=False, prefetch=False)
+    calls = [batch.Call(name, tuple(posts), kwargs) for posts in edits]
+    layers = batch.call_layers(calls, speculative=speculative)
+    questions: dict[str, QuestionPlan] = {}
+    wall_seconds = 0.0
+    for layer in layers:
+        by_question: dict[str, list[batch.Call]] = {}
+        for call in layer:
+            by_question.setdefault(call.name, []).append(call)
+        call_seconds = []
+        for question, question_calls in by_question.items():
+            f = api_context_states.get_supported_annotation(question)
+            q = questions.setdefault(question, QuestionPlan(question))
+            hashes = []
+            for call in question_calls:
+                interpolation_args = f._augment_args_for_interpolation(*call.posts, **f._get_overidden_args(**call.kwargs))
+                hashes.append(f.sha256_call(f._hash_args(call.posts, interpolation_args)))
+            cached = f.cached_call_hashes(hashes) if context.read_cache and f.cache_policy != "local" else set()
+            q.calls += len(question_calls)
+            for call, sha256 in zip(question_calls, hashes):
+                call_seconds.append(LOOKUP_LATENCY if f.cache_policy != "local" else 0.0)
+                if sha256 in cached:
+                    q.hits += 1
+                    continue
+                q.misses += 1
+                try:
+                    annotation_args = render_context.run(_render, call)
+                except Exception as e:
+                    logger.info(f"Could not render {call.name} without its uncached dependencies: {e}")
+                    annotation_args = _unrendered(call)
+                    q.unrendered += 1
+                if annotation_args.get("method", "openai") not in LLM_METHODS:
+                    continue
+                model = str(annotation_args.get("model"))
+                prompt_tokens = tokens.count_prompt_tokens(annotation_args.get("prompt", []), model)
+                completion_tokens = _completion_tokens(annotation_args)
+                q.llm_calls += 1
+                q.models.add(model)
+                q.prompt_tokens += prompt_tokens
+                q.completion_tokens += completion_tokens
+                cost = tokens.cost(model, prompt_tokens, completion_tokens)
+                if cost is None:
+                    q.unpriced_calls += 1
+                else:
+                    q.cost += cost
+                call_seconds[-1] += LLM_LATENCY + completion_tokens / OUTPUT_TOKENS_PER_SECOND
+        # the layer takes as long as its longest call, or its share of the workers' time
+        wall_seconds += max(max(call_seconds, default=0.0), sum(call_seconds) / workers)
+    layer_names = [sorted(set(call.name for call in layer)) for layer in layers]
+    return Plan(name, len(calls), layer_names, questions, wall_seconds, workers)
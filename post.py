@@ -1,9 +1,9 @@
 import datetime
-import functools
+import os
+import weakref
 import dateutil
 import dateutil.parser
-import requests
-from annotation import api_context_states, utils
+from annotation import api_context_states, cassette, ratelimit, tokens, utils
 import threading
 import logging
 
@@ -15,8 +15,17 @@ class RecordNotFoundError(Exception):
         self.message = message
         super().__init__(self.message)
 
-def request_json(url):
-    r = requests.get(url)
+# mastodon caps the number of ids per multi-id statuses request
+STATUSES_BATCH_SIZE = 20
+
+# tokens of the text a template puts around each post of a thread, e.g. "REPLY:" and the backticks
+POST_OVERHEAD_TOKENS = 8
+
+# whether GET /v1/statuses?id[]=... is available, per mastodon url
+BATCH_STATUSES_SUPPORTED: dict[str, bool] = {}
+
+def _request_json(url, params=None):
+    r = ratelimit.get(url, params=params)
     
     json_data = r.json()
     
@@ -26,22 +35,140 @@ def request_json(url):
     r.raise_for_status()
     return r.json()
 
+def request_json(url, params=None):
+    # recorded or replayed if the run has a cassette, see cassette.py
+    return cassette.exchange("mastodon", {"url": url, "params": params}, lambda: _request_json(url, params), errors=(RecordNotFoundError,))
+
+def supports_batch_statuses(mastodon_url: str | None = None) -> bool:
+    """
+    Newer mastodon servers return many statuses from one GET /v1/statuses?id[]=...
+    call. We probe once per server, older servers answer the route with an error.
+    """
+    if mastodon_url is None:
+        mastodon_url = api_context_states.get_mastodon_url()
+    if mastodon_url not in BATCH_STATUSES_SUPPORTED:
+        def probe():
+            r = ratelimit.get(Post.statuses_url_format.format(mastodon_url), params=[("id[]", "0")])
+            try:
+                return r.status_code == 200 and isinstance(r.json(), list)
+            except ValueError:
+                return False
+        supported = cassette.exchange("mastodon", {"probe": mastodon_url}, probe)
+        logger.info(f"Multi-id statuses endpoint {'' if supported else 'not '}supported by {mastodon_url}")
+        BATCH_STATUSES_SUPPORTED[mastodon_url] = supported
+    return BATCH_STATUSES_SUPPORTED[mastodon_url]
+
+def fetch_statuses(mastodon_ids) -> dict[str, dict]:
+    """
+    Fetches many statuses at once, in chunks of STATUSES_BATCH_SIZE per request
+    if the server supports it and one request per status otherwise.
+    Statuses that do not exist are left out of the returned dict.
+    """
+    mastodon_ids = list(dict.fromkeys(mastodon_ids))
+    corpus = api_context_states.get_corpus()
+    if corpus is not None:
+        return corpus.statuses(mastodon_ids)
+    mastodon_url = api_context_states.get_mastodon_url()
+    statuses = {}
+    if len(mastodon_ids) > 1 and supports_batch_statuses(mastodon_url):
+        for i in range(0, len(mastodon_ids), STATUSES_BATCH_SIZE):
+            chunk = mastodon_ids[i:i + STATUSES_BATCH_SIZE]
+            for status in request_json(Post.statuses_url_format.format(mastodon_url), params=[("id[]", id) for id in chunk]):
+                statuses[status["id"]] = status
+    else:
+        for mastodon_id in mastodon_ids:
+            try:
+                statuses[mastodon_id] = Post(mastodon_id).status()
+            except RecordNotFoundError:
+                continue
+    return statuses
+
 class PostList(list):
+    omitted = () # the posts within_budget left out
 
     def __str__(self):
         return self.content
+
+    def within_budget(self, max_tokens: int, keep_first=1, keep_last=2, model="gpt-4o", tokenizer="chars") -> "PostList":
+        """
+        The posts that fit in max_tokens, for templates of deep threads: the first keep_first
+        (the root) and the last keep_last (the latest replies) are always kept, then as many of
+        the latest posts in between as fit. The posts left out, a contiguous run after the
+        first ones, are in `omitted` of the result, e.g. to mention or summarize them.
+        Tokens are counted by tokenizer (see tokens.py), which templates should take as an arg,
+        so that the posts kept are the same wherever the call hash is.
+        """
+        costs = [tokens.count_tokens(str(p), model, tokenizer) + POST_OVERHEAD_TOKENS for p in self]
+        first = min(keep_first, len(self))
+        last = max(first, len(self) - keep_last)
+        budget = max_tokens - sum(costs[:first]) - sum(costs[last:])
+        start = last
+        while start > first and costs[start - 1] <= budget:
+            start -= 1
+            budget -= costs[start]
+        kept = PostList(self[:first] + self[start:])
+        kept.omitted = PostList(self[first:start])
+        if budget < 0:
+            logger.debug(f"The {first + len(self) - last} posts kept are {-budget} tokens over the budget of {max_tokens}")
+        return kept
     
     def __getattr__(self, name):
         return "\\n\\n".join([str(getattr(p, name)) for p in self])
 
+def history_from_status(status: dict) -> list[dict] | None:
+    """
+    A status that was never edited has exactly one version, so its history can
+    be read off the status itself instead of calling the history api.
+    Returns None if the status has been edited.
+    """
+    if status.get("edited_at") is not None:
+        return None
+    return [{"content": status["content"],
+             "spoiler_text": status.get("spoiler_text", ""),
+             "sensitive": status.get("sensitive", False),
+             "created_at": status["created_at"],
+             "account": status.get("account"),
+             "poll": status.get("poll"),
+             "media_attachments": status.get("media_attachments", []),
+             "emojis": status.get("emojis", [])}]
+
+def merge_edit(status: dict, history: list[dict], mastodon_id: str, timestamp: datetime.datetime) -> dict:
+    """
+    Combines the status metadata with the version in history written at timestamp.
+    """
+    match = None
+    for edit in history:
+        edit_timestamp = dateutil.parser.parse(edit["created_at"])
+        if edit_timestamp == timestamp:
+            match = dict(edit)
+            break
+    if match is None:
+        raise ValueError(f"No post found with id {mastodon_id} at timestamp {timestamp}")
+    data = dict(status)
+    match["timestamp"] = match.pop("created_at")
+    data.update(match)
+    return data
+
+def latest_timestamp(mastodon_id: str, history: list[dict], cutoff: datetime.datetime | None = None) -> datetime.datetime:
+    edits = history
+    if cutoff is not None:
+        edits = list(filter(lambda x: dateutil.parser.parse(x["created_at"]) <= cutoff, edits))
+        if len(edits) == 0:
+            raise ValueError(f"No edits of {mastodon_id} before {cutoff}")
+    latest_edit = edits[-1] # assumes mastodon history returns in ascending order of time
+    return dateutil.parser.parse(latest_edit["created_at"])
+
 class Post:
     """
     This is the class for a mastodon post, without a timestamp.
     """
+
+    __slots__ = ("_mastodon_id",)
     
     history_url_format = "{0}/v1/statuses/{1}/history"
     context_url_format = "{0}/v1/statuses/{1}/context"
     status_url_format = "{0}/v1/statuses/{1}"
+    statuses_url_format = "{0}/v1/statuses"
 
     def __init__(self, mastodon_id: str):
         self._mastodon_id = mastodon_id
@@ -50,36 +177,43 @@ class Post:
         return f"Post({self._mastodon_id})"
 
     def status(self) -> dict:
+        corpus = api_context_states.get_corpus()
+        if corpus is not None:
+            return corpus.status(self._mastodon_id)
         return request_json(self.status_url_format.format(api_context_states.get_mastodon_url(),
                                                           self._mastodon_id))
 
     def history(self) -> dict:
+        corpus = api_context_states.get_corpus()
+        if corpus is not None:
+            return corpus.history(self._mastodon_id) # type:ignore
         return request_json(self.history_url_format.format(api_context_states.get_mastodon_url(),
                                                            self._mastodon_id))
         
     def context(self) -> dict:
+        corpus = api_context_states.get_corpus()
+        if corpus is not None:
+            return corpus.context(self._mastodon_id)
         return request_json(self.context_url_format.format(api_context_states.get_mastodon_url(),
                                                            self._mastodon_id))
 
     def latest(self, cutoff: datetime.datetime | None = None):
         # find the latest edit before cutoff
-        edits = self.history()
-        if cutoff is not None:
-            edits = list(filter(lambda x: dateutil.parser.parse(x["created_at"]) <= cutoff, edits))
-            if len(edits) == 0:
-                raise ValueError(f"No edits of {self._mastodon_id} before {cutoff}")
-        latest_edit = edits[-1] # assumes mastodon history returns in ascending order of time         
-        latest_timestamp =  dateutil.parser.parse(latest_edit["created_at"])
+        timestamp = latest_timestamp(self._mastodon_id, self.history(), cutoff=cutoff)
 
         # construct the python object for that edit
-        return Edit.new(self._mastodon_id, latest_timestamp) # this could be a cached object
+        return Edit.new(self._mastodon_id, timestamp) # this could be a cached object
 
 class EditFromStr:
     
     def __init__(self, str) -> None:
         self.str = str
+        self._sha256 = None
+        self._content_sha256 = None
 
     def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(f"{name}")
         if api_context_states.is_supported_annotation(name):
             from annotation import annotation
             bound_f =  annotation.BoundAnnotation(api_context_states.get_supported_annotation(name), self)
@@ -87,6 +221,9 @@ class EditFromStr:
             return bound_f
         raise AttributeError(f"{name}")
 
+    def __reduce__(self):
+        return (EditFromStr, (self.str,))
+
     def __repr__(self):
         return f"EditFromStr({self.str})"
 
@@ -108,7 +245,15 @@ class EditFromStr:
     
     @property
     def sha256(self):
-        return utils.sha256_hash_by_lines(self.content) # type:ignore
+        if self._sha256 is None:
+            self._sha256 = utils.sha256_hash_by_lines(self.content) # type:ignore
+        return self._sha256
+
+    @property
+    def content_sha256(self):
+        if self._content_sha256 is None:
+            self._content_sha256 = utils.sha256_hash_by_lines(utils.normalize_content(self.content)) # type:ignore
+        return self._content_sha256
 
     def __hash__(self) -> int:
         return hash(self.sha256)
@@ -123,14 +268,39 @@ class EditFromFile(EditFromStr):
             super().__init__(f.read())
         self.file = file
 
+    def __reduce__(self):
+        # the content read in this process, the file need not exist where it is unpickled
+        return (_edit_from_file, (self.file, self.str))
+
     def __repr__(self):
         return f"EditFromFile({self.file})"
 
     def __str__(self):
         return self.content
 
+# fields of the mastodon json kept on each Edit, everything else is read through Edit.data
+PROJECTED_FIELDS = ("id", "in_reply_to_id", "created_at", "edited_at", "timestamp", "content",
+                    "spoiler_text", "sensitive", "language", "url", "uri")
+_PROJECTED_INDEX = {field: i for i, field in enumerate(PROJECTED_FIELDS)}
+
+# Edits share a fixed pool of locks instead of holding one each
+EDIT_LOCK_STRIPES = 64
+_EDIT_LOCKS = [threading.RLock() for _ in range(EDIT_LOCK_STRIPES)]
+
+# Edit.new interns edits that are alive anywhere, and keeps the most recently created ones alive
+EDIT_CACHE_SIZE = int(os.getenv("EDIT_CACHE_SIZE", 10000))
+_EDITS: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+_EDITS_LOCK = threading.Lock()
+_RECENT_EDITS = utils.LRUCache(maxsize=EDIT_CACHE_SIZE)
+
+# the full mastodon json of the most recently used Edit.data, by (id, timestamp)
+EDIT_DATA_CACHE_SIZE = int(os.getenv("EDIT_DATA_CACHE_SIZE", 1000))
+_EDIT_DATA = utils.LRUCache(maxsize=EDIT_DATA_CACHE_SIZE)
+
 class Edit(Post):
 
+    __slots__ = ("_timestamp", "_fields", "_parent", "_parent_is_set", "_ancestors", "_cleaned_content", "_sha256", "_content_sha256", "__weakref__")
+
     def __init__(self, mastodon_id: str, timestamp: datetime.datetime):
         """
         If you want Edit objects to be cached so that you don't keep calling
@@ -142,18 +312,43 @@ class Edit(Post):
         # id and timestamp uniquely identify a post
         super().__init__(mastodon_id)
         self._timestamp = timestamp
-        self.lock = threading.RLock()
 
         # lazily load self
-        self._data = None
+        self._fields = None
         self._parent = None
         self._parent_is_set = False
         self._ancestors = None
         self._cleaned_content = None
+        self._sha256 = None
+        self._content_sha256 = None
+
+    @property
+    def lock(self):
+        return _EDIT_LOCKS[hash((self._mastodon_id, self._timestamp)) % EDIT_LOCK_STRIPES]
 
     @property
     def is_loaded(self):
-        return self._data is not None
+        return self._fields is not None
+
+    def _load(self, data: dict):
+        self._fields = tuple(data.get(field) for field in PROJECTED_FIELDS)
+
+    def _field(self, name):
+        if not self.is_loaded:
+            with self.lock:
+                if not self.is_loaded:
+                    self._load(self._fetch())
+        return self._fields[_PROJECTED_INDEX[name]] # type:ignore
+
+    def _projection(self) -> dict:
+        return {field: self._field(field) for field in PROJECTED_FIELDS}
+
+    def _fetch(self) -> dict:
+        # fetch metadata (including content of latest edit)
+        status = self.status()
+        # fetch history and find edit matching timestamp
+        history = history_from_status(status) or self.history()
+        return merge_edit(status, history, self._mastodon_id, self._timestamp)
 
     @property
     @utils.escape_double_quotes_decorator
@@ -164,14 +359,14 @@ class Edit(Post):
 
     @property
     def content_raw(self):
-        return self.data["content"] # type:ignore
+        return self._field("content")
 
     @property
     def parent(self):
         with self.lock:
             if not self._parent_is_set:
-                if self.data["in_reply_to_id"] is not None: # type:ignore
-                    self._parent = Post(self.data["in_reply_to_id"]).latest(cutoff=self._timestamp) # type:ignore
+                if self._field("in_reply_to_id") is not None:
+                    self._parent = Post(self._field("in_reply_to_id")).latest(cutoff=self._timestamp)
                 self._parent_is_set = True
             return self._parent
 
@@ -179,55 +374,70 @@ class Edit(Post):
     def ancestors(self):
         with self.lock:
             if self._ancestors is None:
-                self._ancestors = PostList()
-                for ancestor in self.context()["ancestors"]:
-                    self._ancestors.append(Post(ancestor["id"]).latest(cutoff=self._timestamp))
+                # one context call resolves the ancestors of every post in the thread
+                thread = Thread(self._mastodon_id, status=self._projection(), context=self.context())
+                thread.attach(self)
+                if self._ancestors is None:
+                    self._ancestors = PostList()
+                    for ancestor in thread.context_ancestors:
+                        self._ancestors.append(thread.latest(ancestor["id"], cutoff=self._timestamp))
             return self._ancestors
 
-    @functools.cache
     @staticmethod
     def new(mastodon_id: str, timestamp: datetime.datetime):
         """
         This guarantees within each process, every id+time combination (an edit)
-        is only represented once, and thus only loaded once.
+        is only represented once while it is in use, and thus only loaded once.
         """
-        edit = Edit(mastodon_id, timestamp)
+        key = (mastodon_id, timestamp)
+        with _EDITS_LOCK:
+            edit = _EDITS.get(key)
+            if edit is None:
+                edit = Edit(mastodon_id, timestamp)
+                _EDITS[key] = edit
+        _RECENT_EDITS.put(key, edit)
         return edit
 
     @property
     def data(self) -> dict:
-        with self.lock:
-            if not self.is_loaded:
-                # fetch metadata (including content of latest edit)
-                self._data = self.status()
-                # fetch history and find edit matching timestamp
-                history = self.history()
-                match = None
-                for edit in history:
-                    edit_timestamp = dateutil.parser.parse(edit["created_at"])
-                    if edit_timestamp == self._timestamp:
-                        match = edit
-                        break
-                if match is None:
-                    raise ValueError(f"No post found with id {self._mastodon_id} at timestamp {self._timestamp}")
-                timestamp = match["created_at"]
-                del match["created_at"]
-                match["timestamp"] = timestamp
-                self._data.update(match)
-            return self._data # type:ignore
+        """
+        The full mastodon json of this edit. Only the projected fields are kept on
+        the edit, the json of the EDIT_DATA_CACHE_SIZE edits whose data was used
+        last is kept aside, the others are fetched again.
+        """
+        key = (self._mastodon_id, self._timestamp)
+        data = _EDIT_DATA.get(key)
+        if data is None:
+            with self.lock:
+                data = _EDIT_DATA.get(key)
+                if data is None:
+                    data = self._fetch()
+                    _EDIT_DATA.put(key, data)
+                    if not self.is_loaded:
+                        self._load(data)
+        return data
     
     def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(f"{name}")
         if api_context_states.is_supported_annotation(name):
             from annotation import annotation
             bound_f =  annotation.BoundAnnotation(api_context_states.get_supported_annotation(name), self)
             logger.info(f"Resolved .{name} to {repr(bound_f)}")
             return bound_f
-        if name in self.data:
-            s = self.data[name] # type:ignore
-            if isinstance(s, str):
-                return utils.escape_double_quotes(s)
+        if name in _PROJECTED_INDEX:
+            s = self._field(name)
+        else:
+            s = self.data.get(name)
+        if isinstance(s, str):
+            return utils.escape_double_quotes(s)
         raise AttributeError(f"{name}")
 
+    def __reduce__(self):
+        # a snapshot of what is loaded, so worker processes do not fetch it again
+        return (_restore_edit, (self._mastodon_id, self._timestamp, self._fields,
+                                self._parent_is_set, self._parent, self._ancestors))
+
     def __repr__(self):
         return f"Edit({self._mastodon_id}, {self._timestamp.__repr__()})"
 
@@ -241,7 +451,16 @@ class Edit(Post):
     @property
     def sha256(self):
         # TODO: this can result in uri collisions even though chances are low
-        return utils.sha256_hash_by_lines(self.mastodon_id, self.timestamp, self.content) # type:ignore
+        if self._sha256 is None:
+            self._sha256 = utils.sha256_hash_by_lines(self.mastodon_id, self.timestamp, self.content) # type:ignore
+        return self._sha256
+
+    @property
+    def content_sha256(self):
+        # identifies the post by what it says, regardless of id, time or media
+        if self._content_sha256 is None:
+            self._content_sha256 = utils.sha256_hash_by_lines(utils.normalize_content(self.content)) # type:ignore
+        return self._content_sha256
 
     def __hash__(self) -> int:
         return hash(self.sha256)
@@ -249,6 +468,203 @@ class Edit(Post):
     def __eq__(self, o) -> bool:
         return isinstance(o, Edit) and self.mastodon_id == o.mastodon_id and self.timestamp == o.timestamp and self.content == o.content
 
+def _restore_edit(mastodon_id, timestamp, fields, parent_is_set, parent, ancestors) -> Edit:
+    # unpickled edits are interned like any other, what is already loaded in this process is kept
+    edit = Edit.new(mastodon_id, timestamp)
+    with edit.lock:
+        if fields is not None and not edit.is_loaded:
+            edit._fields = fields
+        if parent_is_set and not edit._parent_is_set:
+            edit._parent = parent
+            edit._parent_is_set = True
+        if ancestors is not None and edit._ancestors is None:
+            edit._ancestors = ancestors
+    return edit
+
+def is_loaded(edit: "Edit | EditFromStr", with_ancestors=False) -> bool:
+    """
+    Whether the content of edit, and if with_ancestors is set that of its ancestors,
+    is in memory, so that its keys can be computed without requests.
+    """
+    if not isinstance(edit, Edit):
+        return True
+    if not edit.is_loaded:
+        return False
+    return not with_ancestors or (edit._ancestors is not None and all(ancestor.is_loaded for ancestor in edit._ancestors))
+
+def content_key(edit: "Edit | EditFromStr", with_ancestors=False) -> str:
+    """
+    Key under which annotations of duplicate posts are shared: the normalized
+    content of the post, and if with_ancestors is set also that of its ancestors.
+    """
+    if not with_ancestors or not isinstance(edit, Edit):
+        return edit.content_sha256
+    return utils.sha256_hash_by_lines(*[ancestor.content_sha256 for ancestor in edit.ancestors], edit.content_sha256)
+
+class Thread:
+    """
+    All posts of the thread containing a mastodon post, loaded from a single
+    context call (which returns both ancestors and descendants).
+
+    The reply tree is built once, and every Edit handed out by the thread has
+    its data, parent and ancestors (each resolved to the latest edit before the
+    Edit's timestamp) attached, so templates that walk ancestors of many replies
+    do not call mastodon again. Edits are created with Edit.new, so ancestors
+    are shared across all replies of the thread.
+    """
+
+    def __init__(self, mastodon_id: str, status: dict | None = None, context: dict | None = None):
+        self._mastodon_id = mastodon_id
+        if status is None:
+            status = Post(mastodon_id).status()
+        if context is None:
+            context = Post(mastodon_id).context()
+        self.context_ancestors = context["ancestors"]
+        self.statuses: dict[str, dict] = {}
+        for s in [*context["ancestors"], status, *context["descendants"]]:
+            self.statuses[s["id"]] = s
+        self.children: dict[str, list[str]] = {}
+        for s in self.statuses.values():
+            if s.get("in_reply_to_id") in self.statuses:
+                self.children.setdefault(s["in_reply_to_id"], []).append(s["id"])
+        self._histories: dict[str, list[dict]] = {}
+
+    def __repr__(self):
+        return f"Thread({self._mastodon_id}, {len(self.statuses)} posts)"
+
+    @property
+    def root_id(self) -> str:
+        mastodon_id = self._mastodon_id
+        while self.statuses[mastodon_id].get("in_reply_to_id") in self.statuses:
+            mastodon_id = self.statuses[mastodon_id]["in_reply_to_id"]
+        return mastodon_id
+
+    def history(self, mastodon_id: str) -> list[dict]:
+        if mastodon_id not in self._histories:
+            history = history_from_status(self.statuses[mastodon_id])
+            if history is None:
+                history = Post(mastodon_id).history()
+            self._histories[mastodon_id] = history
+        return self._histories[mastodon_id]
+
+    def ancestor_ids(self, mastodon_id: str) -> list[str] | None:
+        """
+        Ids of the ancestors of a post from the root down, or None if some
+        ancestor is not visible in this thread.
+        """
+        ids = []
+        parent_id = self.statuses[mastodon_id].get("in_reply_to_id")
+        while parent_id is not None:
+            if parent_id not in self.statuses:
+                return None
+            ids.append(parent_id)
+            parent_id = self.statuses[parent_id].get("in_reply_to_id")
+        return ids[::-1]
+
+    def latest(self, mastodon_id: str, cutoff: datetime.datetime | None = None) -> "Edit":
+        timestamp = latest_timestamp(mastodon_id, self.history(mastodon_id), cutoff=cutoff)
+        edit = Edit.new(mastodon_id, timestamp)
+        self.attach(edit)
+        return edit
+
+    def attach(self, edit: "Edit"):
+        """
+        Fills in data, parent and ancestors of an edit of a post in this thread.
+        """
+        mastodon_id = edit.mastodon_id
+        if not edit.is_loaded:
+            edit._load(merge_edit(self.statuses[mastodon_id], self.history(mastodon_id), mastodon_id, edit._timestamp))
+        if edit._ancestors is None:
+            ancestor_ids = self.ancestor_ids(mastodon_id)
+            if ancestor_ids is None:
+                return edit
+            ancestors = PostList()
+            for ancestor_id in ancestor_ids:
+                ancestors.append(self.latest(ancestor_id, cutoff=edit._timestamp))
+            edit._ancestors = ancestors
+            if not edit._parent_is_set:
+                edit._parent = ancestors[-1] if len(ancestors) > 0 else None
+                edit._parent_is_set = True
+        return edit
+
+    def edits(self) -> list["Edit"]:
+        """
+        The latest edit of every post in the thread, in reply tree order.
+        """
+        out = []
+        stack = [self.root_id]
+        while stack:
+            mastodon_id = stack.pop()
+            out.append(self.latest(mastodon_id))
+            stack.extend(reversed(self.children.get(mastodon_id, [])))
+        return out
+
+def latest_edits(mastodon_ids, cutoff: datetime.datetime | None = None) -> list[Edit]:
+    """
+    Batched Post(mastodon_id).latest() for many posts: statuses are fetched with
+    multi-id requests and the history api is only called for edited posts.
+    The returned edits are already loaded.
+    """
+    mastodon_ids = list(mastodon_ids)
+    statuses = fetch_statuses(mastodon_ids)
+    edits = []
+    for mastodon_id in mastodon_ids:
+        if mastodon_id not in statuses:
+            raise RecordNotFoundError(f"Record not found for status {mastodon_id}")
+        history = history_from_status(statuses[mastodon_id]) or Post(mastodon_id).history()
+        edit = Edit.new(mastodon_id, latest_timestamp(mastodon_id, history, cutoff=cutoff))
+        if not edit.is_loaded:
+            edit._load(merge_edit(statuses[mastodon_id], history, mastodon_id, edit._timestamp))
+        edits.append(edit)
+    return edits
+
+def prefetch(edits, parents: bool = True) -> list[Edit]:
+    """
+    Loads the data of many edits (and, if parents is set, resolves and loads their
+    parents) with batched status lookups instead of one status request per edit.
+    """
+    edits = [edit for edit in edits if isinstance(edit, Edit)]
+    unloaded = [edit for edit in edits if not edit.is_loaded]
+    statuses = fetch_statuses([edit.mastodon_id for edit in unloaded])
+    for edit in unloaded:
+        if edit.mastodon_id not in statuses:
+            raise RecordNotFoundError(f"Record not found for status {edit.mastodon_id}")
+        status = statuses[edit.mastodon_id]
+        history = history_from_status(status) or edit.history()
+        edit._load(merge_edit(status, history, edit.mastodon_id, edit._timestamp))
+    if parents:
+        orphans = [edit for edit in edits if not edit._parent_is_set and edit._field("in_reply_to_id") is not None]
+        statuses = fetch_statuses([edit._field("in_reply_to_id") for edit in orphans])
+        for edit in orphans:
+            parent_id = edit._field("in_reply_to_id")
+            if parent_id not in statuses:
+                continue # leave it to Edit.parent to report
+            history = history_from_status(statuses[parent_id]) or Post(parent_id).history()
+            parent = Edit.new(parent_id, latest_timestamp(parent_id, history, cutoff=edit._timestamp))
+            if not parent.is_loaded:
+                parent._load(merge_edit(statuses[parent_id], history, parent_id, parent._timestamp))
+            edit._parent = parent
+            edit._parent_is_set = True
+    return edits
+
+def load_thread(mastodon_id: str) -> list[Edit]:
+    """
+    Loads the latest edit of every post in the thread of mastodon_id with one
+    status and one context call on the root (plus a history call for each edited
+    post). Mastodon only returns descendants of the post the context is asked for,
+    so for a reply we first look up the root of its thread.
+    """
+    thread = Thread(mastodon_id)
+    if thread.root_id != mastodon_id:
+        thread = Thread(thread.root_id, status=thread.statuses[thread.root_id])
+    return thread.edits()
+
+def _edit_from_file(file, content) -> EditFromFile:
+    edit = EditFromFile.__new__(EditFromFile)
+    EditFromStr.__init__(edit, content)
+    edit.file = file
+    return edit
+
 if __name__ == "__main__":
     from jinja2 import Environment
     post = Post("112718194195663750")
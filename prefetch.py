@@ -0,0 +1,181 @@
+"""
+Concurrent resolution of the annotations a template depends on.
+
+Templates resolve their dependencies one at a time while rendering, each
+`{{ post.unary }}` or `{{ post0.binary(post1) }}` blocking the next. Before
+rendering, the references that can be read off the template (with aliases
+substituted) are resolved together with asyncio.gather on the annotation event
+loop (see aio.py); their results land in the shared result cache, where
+rendering then collects them.
+
+Statically known references are annotations of `post`, `postN` or of the loop
+variable of `{% for post in posts %}`, called without arguments or with posts
+and constant or template argument keywords. References under `{% if %}` (or
+inline if) branches are only prefetched if `speculative_prefetch` is set,
+since the branch may not be taken and its annotation may cost an LLM call.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import re
+from typing import Any, NamedTuple
+
+import jinja2
+from jinja2 import nodes
+
+from annotation import api_context_states, utils
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+POST_VARIABLE_RE = re.compile(r"^post\d*$")
+LOOP = "posts" # marks a variable bound by a loop over posts
+
+
+class Reference(NamedTuple):
+    name: str # attribute, possibly an annotation
+    posts: tuple[str, ...] # variables holding the posts
+    kwargs: tuple[tuple[str, str, Any], ...] # (key, "const" or "name", value)
+    speculative: bool
+
+
+def _post_argument(node, scope):
+    # loop variables are recorded as LOOP, since they stand for each of the posts
+    if isinstance(node, nodes.Name) and scope.get(node.name) is not None:
+        return LOOP if scope[node.name] == LOOP else node.name
+    return None
+
+def _reference(node, scope, speculative) -> Reference | None:
+    call = None
+    if isinstance(node, nodes.Call):
+        call, node = node, node.node
+    if not isinstance(node, nodes.Getattr) or _post_argument(node.node, scope) is None:
+        return None
+    posts = [_post_argument(node.node, scope)]
+    kwargs = []
+    if call is not None:
+        if call.dyn_args is not None or call.dyn_kwargs is not None:
+            return None
+        for arg in call.args:
+            posts.append(_post_argument(arg, scope))
+        for keyword in call.kwargs:
+            if isinstance(keyword.value, nodes.Const):
+                kwargs.append((keyword.key, "const", keyword.value.value))
+            elif isinstance(keyword.value, nodes.Name) and keyword.value.name not in scope:
+                kwargs.append((keyword.key, "name", keyword.value.name))
+            else:
+                return None
+        if None in posts:
+            return None
+    return Reference(node.attr, tuple(posts), tuple(kwargs), speculative) # type:ignore
+
+def _walk(node, scope: dict[str, str | None], speculative: bool, out: list[Reference]):
+    # scope maps post variables to None if unbound, LOOP for loop variables, or "" for top level posts
+    if isinstance(node, nodes.For):
+        _walk(node.iter, scope, speculative, out)
+        inner = dict(scope)
+        for target in node.target.find_all(nodes.Name) if not isinstance(node.target, nodes.Name) else [node.target]:
+            inner[target.name] = None # shadowed
+        if isinstance(node.target, nodes.Name) and isinstance(node.iter, nodes.Name) and node.iter.name == "posts":
+            inner[node.target.name] = LOOP
+        if node.test is not None:
+            _walk(node.test, inner, speculative, out)
+        for child in node.body:
+            _walk(child, inner, speculative, out)
+        for child in node.else_:
+            _walk(child, scope, True, out)
+        return
+    if isinstance(node, nodes.If):
+        _walk(node.test, scope, speculative, out)
+        for child in node.body + node.elif_ + node.else_:
+            _walk(child, scope, True, out)
+        return
+    if isinstance(node, nodes.CondExpr):
+        _walk(node.test, scope, speculative, out)
+        _walk(node.expr1, scope, True, out)
+        if node.expr2 is not None:
+            _walk(node.expr2, scope, True, out)
+        return
+    reference = _reference(node, scope, speculative)
+    if reference is not None:
+        out.append(reference)
+        if isinstance(node, nodes.Call):
+            return
+    for child in node.iter_child_nodes():
+        _walk(child, scope, speculative, out)
+
+def extract_references(ast: nodes.Template) -> list[Reference]:
+    """
+    The attribute references on posts that can be read off the template, in order.
+    """
+    names = set(n.name for n in ast.find_all(nodes.Name))
+    # variables that are reassigned anywhere do not reliably hold the posts
+    rebound = set()
+    for binding in ast.find_all((nodes.Assign, nodes.AssignBlock, nodes.With, nodes.Macro, nodes.CallBlock)):
+        rebound.update(n.name for n in binding.find_all(nodes.Name) if n.ctx in ("store", "param"))
+    scope: dict[str, str | None] = {name: "" for name in names | {"post"} if POST_VARIABLE_RE.match(name) and name not in rebound}
+    out = []
+    _walk(ast, scope, False, out) # type:ignore
+    certain = set(r._replace(speculative=True) for r in out if not r.speculative)
+    return list(dict.fromkeys(r for r in out if r not in certain))
+
+def parse_references(env: jinja2.Environment, template: str, alias: dict) -> list[Reference]:
+    return extract_references(utils.substitute_aliases(env.parse(template), alias))
+
+
+##### prefetching #####
+
+def calls(references: list[Reference], posts, interpolation_args: dict, speculative=False):
+    """
+    The (annotation name, posts, kwargs) calls the references resolve to for these arguments.
+    """
+    variables = {**interpolation_args, "post": posts[0], "posts": posts}
+    out = {}
+    for reference in references:
+        if reference.speculative and not speculative:
+            continue
+        if not api_context_states.is_supported_annotation(reference.name):
+            continue
+        kwargs = {}
+        for key, kind, value in reference.kwargs:
+            if kind == "name":
+                if value not in variables:
+                    break
+                value = variables[value]
+            kwargs[key] = value
+        else:
+            if any(name != LOOP and name not in variables for name in reference.posts):
+                continue
+            loops = [variables["posts"] if name == LOOP else [variables[name]] for name in reference.posts]
+            for call_posts in itertools.product(*loops):
+                # attributes of the post classes take precedence over annotations of the same name
+                if hasattr(type(call_posts[0]), reference.name):
+                    continue
+                # by identity, hashing an edit may fetch it
+                key = (reference.name, tuple(map(id, call_posts)), json.dumps(kwargs, sort_keys=True, default=str))
+                out.setdefault(key, (reference.name, call_posts, kwargs))
+    return list(out.values())
+
+async def _resolve(name, posts, kwargs):
+    # with a call stack of its own, the dependency is recorded when rendering collects it
+    api_context_states.CALL_STACK.set(utils.CallStack())
+    try:
+        await api_context_states.get_supported_annotation(name).acall(*posts, **kwargs)
+    except Exception as e:
+        # rendering calls it again and raises
+        logger.debug(f"Prefetching {name} on {posts} failed: {e}")
+
+async def prefetch(references: list[Reference], posts, interpolation_args: dict):
+    """
+    Resolves the references together. Returns the number of calls made.
+    """
+    context = api_context_states.get_run_context()
+    if not context.prefetch:
+        return 0
+    todo = calls(references, posts, interpolation_args, speculative=context.speculative_prefetch)
+    if not todo:
+        return 0
+    logger.info(f"Prefetching {len(todo)} dependencies")
+    await asyncio.gather(*[_resolve(name, call_posts, kwargs) for name, call_posts, kwargs in todo])
+    return len(todo)
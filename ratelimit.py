@@ -0,0 +1,284 @@
+"""
+Scheduling of mastodon api requests against the server's rate limit.
+
+Mastodon reports the remaining budget of the current window with the
+X-RateLimit-Remaining and X-RateLimit-Reset headers. The scheduler spreads
+the remaining budget evenly over the time left in the window, so a batch runs
+as fast as the budget allows without going over, and requests that are
+throttled anyway (429) are retried after the window resets, with jitter.
+When a window is over, requests wait for the reset (again with jitter), and a
+single one probes the new window: the others wait for its response, so that
+they are paced by the budget it reports instead of all going out at once.
+
+One scheduler is shared per mastodon host by every thread of the process, and
+processes on the same machine coordinate through a small json file (under
+MASTODON_RATELIMIT_DIR, or the temp dir) guarded by a file lock.
+"""
+from datetime import timezone
+import hashlib
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from typing import Any, Callable
+from urllib.parse import urlparse
+
+import dateutil.parser
+import requests
+
+try:
+    import fcntl
+except ImportError: # not available on windows, we then only coordinate threads
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+DEFAULT_MAX_RETRIES = 8
+DEFAULT_BACKOFF = 1.0 # seconds, doubled with every retry of the same request
+DEFAULT_MAX_BACKOFF = 300.0
+DEFAULT_JITTER = 0.5 # fraction of the backoff waited at random on top of the reset
+PROBE_SECONDS = 30.0 # the longest other requests wait for the probe of a new window
+PROBE_POLL_SECONDS = 0.05
+
+
+def parse_reset(value: str | None) -> float | None:
+    """
+    X-RateLimit-Reset is an ISO 8601 timestamp on mastodon, but also accept unix time.
+    """
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        reset = dateutil.parser.parse(value)
+    except (ValueError, OverflowError):
+        return None
+    if reset.tzinfo is None:
+        reset = reset.replace(tzinfo=timezone.utc)
+    return reset.timestamp()
+
+
+class RateLimitScheduler:
+
+    def __init__(self, name: str, coordination_file: str | None = None,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF,
+                 max_backoff=DEFAULT_MAX_BACKOFF, jitter=DEFAULT_JITTER):
+        self.name = name
+        self.coordination_file = coordination_file
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self._lock = threading.Lock()
+        # a window that is over, so that the first request probes the budget
+        self._state = {"remaining": None, "reset": 0.0, "next_slot": 0.0, "probe": None}
+        self._metrics = {"requests": 0, "throttled": 0, "retries": 0, "waits": 0,
+                         "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+
+    def __repr__(self):
+        return f"RateLimitScheduler({self.name})"
+
+    ##### shared state #####
+
+    def _with_state(self, f: Callable[[dict], Any]) -> Any:
+        """
+        Runs f on the shared state while holding the thread lock and the
+        coordination file lock, and saves the state f leaves behind.
+        """
+        with self._lock:
+            if self.coordination_file is None or fcntl is None:
+                return f(self._state)
+            with open(self.coordination_file, "a+") as file:
+                fcntl.flock(file, fcntl.LOCK_EX)
+                try:
+                    file.seek(0)
+                    try:
+                        self._state = json.loads(file.read())
+                    except ValueError:
+                        pass # first user of the file
+                    out = f(self._state)
+                    file.seek(0)
+                    file.truncate()
+                    file.write(json.dumps(self._state))
+                    file.flush()
+                    return out
+                finally:
+                    fcntl.flock(file, fcntl.LOCK_UN)
+
+    def _reserve(self, state: dict) -> tuple[float, bool, str | None]:
+        # reserve the next slot: the time at which it starts, whether the request is sent then
+        # rather than reserving again, and an id if the request probes a new window
+        now = time.time()
+        start = max(now, state["next_slot"])
+        reset, remaining, probe = state["reset"], state["remaining"], state.get("probe")
+        if probe is not None and probe["until"] > now:
+            # the budget of the window is not known until the probe comes back
+            return min(probe["until"], now + PROBE_POLL_SECONDS), False, None
+        if reset is not None and reset <= now:
+            probe_id = os.urandom(8).hex()
+            state["probe"] = {"id": probe_id, "until": now + PROBE_SECONDS}
+            state["remaining"] = None
+            state["next_slot"] = now
+            return now, True, probe_id
+        if reset is None or remaining is None:
+            # the server does not report its budget
+            state["next_slot"] = start
+            return start, True, None
+        if remaining <= 0:
+            # the jitter spreads the probes of hosts that do not share the state
+            return reset + random.uniform(0, self.jitter) * self.backoff, False, None
+        # spread what is left of the budget over what is left of the window
+        state["next_slot"] = start + (reset - start) / remaining
+        state["remaining"] = remaining - 1
+        return start, True, None
+
+    def _end_probe(self, state: dict, probe: str | None) -> bool:
+        if probe is None or (state.get("probe") or {}).get("id") != probe:
+            return False
+        state["probe"] = None
+        return True
+
+    def _update(self, response: requests.Response, probe: str | None = None) -> float | None:
+        # returns the reset time of the window if the server told us
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        reset = parse_reset(response.headers.get("X-RateLimit-Reset"))
+        if response.status_code == 429:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after is not None:
+                try:
+                    reset = time.time() + float(retry_after)
+                except ValueError:
+                    reset = parse_reset(retry_after)
+            remaining = 0
+
+        def update(state):
+            if self._end_probe(state, probe) and remaining is None and reset is None:
+                # no budget to pace by, requests are no longer held back
+                state["remaining"] = None
+                state["reset"] = None
+            if reset is not None and state["reset"] is not None and reset < state["reset"]:
+                return # answered in an earlier window
+            if remaining is not None and reset is not None and reset == state["reset"] and state["remaining"] is not None:
+                # the requests reserved since this one was answered are not counted by the server yet
+                state["remaining"] = min(state["remaining"], int(remaining))
+            elif remaining is not None:
+                state["remaining"] = int(remaining)
+            if reset is not None:
+                state["reset"] = reset
+        self._with_state(update)
+        return reset
+
+    ##### requests #####
+
+    def _wait(self, seconds: float, record=True):
+        if seconds <= 0:
+            return
+        if seconds > 1:
+            logger.info(f"Waiting {seconds:.1f}s for the rate limit of {self.name}")
+        if record:
+            self._record_wait(seconds)
+        time.sleep(seconds)
+
+    def _record_wait(self, seconds: float):
+        with self._lock:
+            self._metrics["waits"] += 1
+            self._metrics["wait_seconds"] += seconds
+            self._metrics["max_wait_seconds"] = max(self._metrics["max_wait_seconds"], seconds)
+
+    def acquire(self) -> str | None:
+        """
+        Blocks until the next request fits in the budget. Returns an id if the request probes
+        a new window, which its response has to be passed to _update with.
+        """
+        waited = 0.0
+        while True:
+            start, ready, probe = self._with_state(self._reserve)
+            seconds = max(0.0, start - time.time())
+            # polls for the probe are one wait
+            self._wait(seconds, record=False)
+            waited += seconds
+            if ready:
+                break
+        if waited > 0:
+            self._record_wait(waited)
+        return probe
+
+    def request(self, send: Callable[[], requests.Response]) -> requests.Response:
+        """
+        Sends a request through the scheduler, retrying it while it is throttled.
+        Returns the last response, which is still a 429 if all retries were throttled.
+        """
+        backoff = self.backoff
+        for attempt in range(self.max_retries + 1):
+            probe = self.acquire()
+            try:
+                response = send()
+            except BaseException:
+                # the requests waiting on the probe need not wait for it to time out
+                self._with_state(lambda state: self._end_probe(state, probe))
+                raise
+            reset = self._update(response, probe)
+            with self._lock:
+                self._metrics["requests"] += 1
+                if response.status_code == 429:
+                    self._metrics["throttled"] += 1
+            if response.status_code != 429 or attempt == self.max_retries:
+                return response
+            logger.warning(f"Throttled by {self.name}, retrying ({attempt + 1}/{self.max_retries})")
+            with self._lock:
+                self._metrics["retries"] += 1
+            if reset is not None:
+                # the next acquire waits for the reset, the jitter keeps retries from arriving all at once
+                self._wait(min(backoff, self.max_backoff) * random.uniform(0, self.jitter))
+            else:
+                self._wait(min(backoff, self.max_backoff) * (1 + random.uniform(0, self.jitter)))
+            backoff *= 2
+        raise AssertionError()
+
+    def metrics(self) -> dict:
+        """
+        Counts of requests, throttled requests and retries, and time spent waiting.
+        """
+        with self._lock:
+            out = dict(self._metrics)
+        out["mean_wait_seconds"] = out["wait_seconds"] / out["waits"] if out["waits"] else 0.0
+        return out
+
+
+def coordination_file(host: str) -> str:
+    directory = os.getenv("MASTODON_RATELIMIT_DIR", tempfile.gettempdir())
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"annotation-ratelimit-{hashlib.sha256(host.encode('utf-8')).hexdigest()[:16]}.json")
+
+
+SCHEDULERS: dict[str, RateLimitScheduler] = {}
+_SCHEDULERS_LOCK = threading.Lock()
+
+def get_scheduler(host: str) -> RateLimitScheduler:
+    with _SCHEDULERS_LOCK:
+        if host not in SCHEDULERS:
+            SCHEDULERS[host] = RateLimitScheduler(host, coordination_file=coordination_file(host))
+        return SCHEDULERS[host]
+
+
+def get(url: str, params=None) -> requests.Response:
+    """
+    requests.get through the scheduler of the url's host.
+    """
+    scheduler = get_scheduler(urlparse(url).netloc)
+    return scheduler.request(lambda: requests.get(url, params=params))
+
+
+def metrics() -> dict[str, dict]:
+    """
+    Metrics of every scheduler used in this process, by host.
+    """
+    with _SCHEDULERS_LOCK:
+        schedulers = list(SCHEDULERS.values())
+    return {scheduler.name: scheduler.metrics() for scheduler in schedulers}
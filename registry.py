@@ -0,0 +1,257 @@
+"""
+Process-wide registry of the questions in a prompt folder.
+
+The folder is indexed by file name only, a question's yaml is read and parsed
+the first time the question is used, and the resulting `Annotation` objects and
+question hashes are shared by every context of the process. `refresh()` picks
+up edits to the folder: files whose mtime or size changed are reloaded if their
+content hash changed, and it rescans the folder at most every
+PROMPT_REFRESH_INTERVAL seconds (2 by default), so long running workers see
+prompt edits without restarting.
+"""
+from collections.abc import Mapping
+from dataclasses import dataclass
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Any
+
+from annotation import annotation, utils
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+DEFAULT_REFRESH_INTERVAL = float(os.getenv("PROMPT_REFRESH_INTERVAL", 2.0))
+QUESTION_FILE_RE = re.compile(r'^(((.*)_(\d+))_(\d+)).yaml$')
+
+
+@dataclass
+class QuestionFile:
+    path: str
+    name: str
+    major: int
+    minor: int
+    stat: tuple[int, int] # mtime_ns, size
+    content_sha256: str | None = None # set once the file has been read
+    quest_sha256: str | None = None
+
+
+def read_text(path):
+    with open(path, "rt") as f:
+        return f.read()
+
+
+class PromptRegistry:
+
+    def __init__(self, folder: str, refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        self.folder = folder
+        self.refresh_interval = refresh_interval
+        self.generation = 0 # bumped whenever the set or content of the questions changes
+        self._lock = threading.RLock()
+        self._files: dict[str, QuestionFile] = {} # by full name, e.g. binary_0_1
+        self._resolution: dict[str, tuple[str, int | None, int | None]] = {} # name -> (full name, major, minor)
+        self._annotations: dict[tuple, Any] = {}
+        self._hashes: dict[Any, Any] = {}
+        self._ignored: set[str] = set()
+        self._refreshed = 0.0
+        self.refresh(force=True)
+
+    def __repr__(self):
+        return f"PromptRegistry({self.folder})"
+
+    def _scan(self) -> dict[str, QuestionFile]:
+        files = {}
+        for path in utils.get_all_files(self.folder):
+            match = QUESTION_FILE_RE.match(os.path.basename(path))
+            if match is None:
+                if path not in self._ignored:
+                    logger.warning(f'Ignoring {path} because its filename is not properly formatted as "name_majorver_minorver.yaml"')
+                    self._ignored.add(path)
+                continue
+            fullname = match.group(1)
+            if fullname in files:
+                raise AssertionError(f"Two copies of {fullname} detected. {path} and {files[fullname].path}")
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError: # removed while scanning
+                continue
+            files[fullname] = QuestionFile(path, match.group(3), int(match.group(4)), int(match.group(5)),
+                                           (stat.st_mtime_ns, stat.st_size))
+        return files
+
+    def _unchanged(self, old: QuestionFile | None, new: QuestionFile) -> bool:
+        if old is None or old.path != new.path:
+            return False
+        if old.stat == new.stat:
+            return True
+        if old.content_sha256 is None:
+            return False # never read, nothing to keep
+        try:
+            return old.content_sha256 == hashlib.sha256(read_text(new.path).encode("utf-8")).hexdigest()
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def _resolve(files: dict[str, QuestionFile]):
+        # name and name_latest resolve to the highest version, name_major to its highest minor version
+        resolution = {}
+        latest: dict[str, QuestionFile] = {}
+        latest_minor: dict[str, QuestionFile] = {}
+        for f in files.values():
+            if f.name not in latest or (latest[f.name].major, latest[f.name].minor) < (f.major, f.minor):
+                latest[f.name] = f
+            major_name = f"{f.name}_{f.major}"
+            if major_name not in latest_minor or latest_minor[major_name].minor < f.minor:
+                latest_minor[major_name] = f
+        for name, f in latest.items():
+            resolution[name] = (f"{name}_{f.major}_{f.minor}", None, None)
+            resolution[f"{name}_latest"] = (f"{name}_{f.major}_{f.minor}", f.major, f.minor)
+        for major_name, f in latest_minor.items():
+            resolution[major_name] = (f"{major_name}_{f.minor}", f.major, None)
+        for fullname, f in files.items():
+            resolution[fullname] = (fullname, f.major, f.minor)
+        return resolution
+
+    def refresh(self, force=False) -> bool:
+        """
+        Rescans the folder if the last scan is older than the refresh interval.
+        Returns whether any question was added, removed or changed.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._refreshed < self.refresh_interval:
+                return False
+            self._refreshed = now
+            scanned = self._scan()
+            changed = set(self._files) ^ set(scanned)
+            for fullname, f in scanned.items():
+                old = self._files.get(fullname)
+                if self._unchanged(old, f):
+                    old.stat = f.stat # type:ignore
+                    scanned[fullname] = old # type:ignore
+                else:
+                    changed.add(fullname)
+            if not changed and self._files:
+                return False
+            if self.generation > 0:
+                logger.info(f"Reloading questions in {self.folder}: {', '.join(sorted(changed))}")
+            resolution = self._resolve(scanned)
+            self._annotations = {key: annot for key, annot in self._annotations.items()
+                                 if resolution.get(key[0]) == self._resolution.get(key[0]) and resolution[key[0]][0] not in changed}
+            self._files = scanned
+            self._resolution = resolution
+            self._hashes = {}
+            self.generation += 1
+            return True
+
+    def maybe_refresh(self):
+        # cheap enough to call on every context entry
+        if time.monotonic() - self._refreshed >= self.refresh_interval:
+            self.refresh()
+
+    ##### lookups #####
+
+    def __contains__(self, name):
+        return name in self._resolution
+
+    def names(self) -> list[str]:
+        return list(self._resolution)
+
+    def fullnames(self) -> list[str]:
+        """
+        The full names of the question files, e.g. rewrite_0_1, by name and version.
+        """
+        with self._lock:
+            files = list(self._files.values())
+        return [f"{f.name}_{f.major}_{f.minor}" for f in sorted(files, key=lambda f: (f.name, f.major, f.minor))]
+
+    def get(self, name: str, overrides: dict[str, Any] | None = None):
+        """
+        The Annotation answering to name (e.g. binary, binary_0, binary_0_1 or binary_latest),
+        built on first use and shared afterwards.
+        """
+        overrides = overrides if overrides is not None else {}
+        key = (name, json.dumps(overrides, sort_keys=True, default=str))
+        annot = self._annotations.get(key)
+        if annot is not None:
+            return annot
+        with self._lock:
+            annot = self._annotations.get(key)
+            if annot is not None:
+                return annot
+            fullname, major, minor = self._resolution[name]
+            f = self._files[fullname]
+            if f.content_sha256 is None:
+                f.content_sha256 = hashlib.sha256(read_text(f.path).encode("utf-8")).hexdigest()
+            annot = annotation.Annotation(f.path, f.name, major, minor, **overrides)
+            self._annotations[key] = annot
+            return annot
+
+    def quest_sha256(self, fullname: str) -> str:
+        f = self._files[fullname]
+        if f.quest_sha256 is None:
+            documents = utils.split_yaml_docs(read_text(f.path))
+            f.quest_sha256 = annotation.quest_sha256(f.name, f.major, f.minor, documents)
+        return f.quest_sha256
+
+    def question_hashes(self) -> list[str]:
+        """
+        Hashes of every version of every question in the folder, sorted.
+        """
+        hashes = self._hashes.get("list")
+        if hashes is None:
+            with self._lock:
+                hashes = sorted(self.quest_sha256(fullname) for fullname in self._files)
+                self._hashes["list"] = hashes
+        return hashes
+
+    def question_hash_set(self) -> frozenset[str]:
+        hashes = self._hashes.get("set")
+        if hashes is None:
+            hashes = frozenset(self.question_hashes())
+            self._hashes["set"] = hashes
+        return hashes
+
+    def question_hashes_sparql(self, join=", ") -> str:
+        out = self._hashes.get(join)
+        if out is None:
+            out = join.join([f'"{h}"' for h in self.question_hashes()])
+            self._hashes[join] = out
+        return out
+
+
+class SupportedAnnotations(Mapping):
+    """
+    Read-only view of a registry with the command line overrides of one context applied.
+    """
+
+    def __init__(self, registry: PromptRegistry, cmdline_args: dict[str, Any] | None = None):
+        self.registry = registry
+        self.cmdline_args = cmdline_args if cmdline_args is not None else {}
+
+    def __getitem__(self, name):
+        return self.registry.get(name, self.cmdline_args.get(name))
+
+    def __contains__(self, name):
+        return name in self.registry
+
+    def __iter__(self):
+        return iter(self.registry.names())
+
+    def __len__(self):
+        return len(self.registry.names())
+
+
+REGISTRIES: dict[str, PromptRegistry] = {}
+_REGISTRIES_LOCK = threading.Lock()
+
+def get_registry(folder: str) -> PromptRegistry:
+    folder = os.path.abspath(folder)
+    with _REGISTRIES_LOCK:
+        if folder not in REGISTRIES:
+            REGISTRIES[folder] = PromptRegistry(folder)
+        return REGISTRIES[folder]
@@ -0,0 +1,180 @@
+"""
+Process-wide cache of annotation results.
+
+Every thread and task of the process shares one cache, bounded both by number of
+entries (RESULT_CACHE_SIZE, 10000 by default) and by the approximate size of the
+cached results (RESULT_CACHE_BYTES, 256MiB by default), evicting the least
+recently used entries first. Lookups are single-flight: a caller asking for a
+key that another thread or task is computing waits for that result instead of
+computing it again (`aget_or_compute` waits without blocking the event loop).
+"""
+import asyncio
+from collections import OrderedDict
+import contextvars
+import logging
+import os
+import threading
+from typing import Any, Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+DEFAULT_MAXSIZE = int(os.getenv("RESULT_CACHE_SIZE", 10000))
+DEFAULT_MAXBYTES = int(os.getenv("RESULT_CACHE_BYTES", 256 * 2**20))
+
+
+def approximate_size(value) -> int:
+    return len(repr(value))
+
+
+# keys being computed by the caller and the callers it was called from
+_COMPUTING: contextvars.ContextVar[frozenset] = contextvars.ContextVar("computing", default=frozenset())
+
+
+class _Flight:
+    # a computation in progress, waited on by the other callers of the same key
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.failed = False
+        self.waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = [] # of async callers
+
+    def finish(self, failed: bool):
+        self.failed = failed
+        self.done.set()
+        for loop, future in self.waiters:
+            loop.call_soon_threadsafe(_set_done, future)
+
+
+def _set_done(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class ResultCache:
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, maxbytes=DEFAULT_MAXBYTES, sizeof: Callable[[Any], int] = approximate_size):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self._data: OrderedDict[Any, tuple[Any, int]] = OrderedDict()
+        self._flights: dict[Any, _Flight] = {}
+        self._lock = threading.Lock()
+        self._metrics = {"hits": 0, "misses": 0, "waits": 0, "evictions": 0}
+
+    def __repr__(self):
+        return f"ResultCache({len(self._data)} entries, {self.nbytes} bytes)"
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def _evict(self):
+        while self._data and (len(self._data) > self.maxsize or (self.maxbytes is not None and self.nbytes > self.maxbytes)):
+            _, (_, nbytes) = self._data.popitem(last=False)
+            self.nbytes -= nbytes
+            self._metrics["evictions"] += 1
+
+    def put(self, key, value):
+        nbytes = self.sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._data.pop(key)[1]
+            self._data[key] = (value, nbytes)
+            self.nbytes += nbytes
+            self._evict()
+
+    def _lookup(self, key) -> tuple[bool, Any, _Flight | None]:
+        # (hit, value, flight), with flight None if the caller now owns the computation
+        if key in _COMPUTING.get():
+            raise RecursionError(f"Result of {key} depends on itself")
+        if key in self._data:
+            self._data.move_to_end(key)
+            self._metrics["hits"] += 1
+            return True, self._data[key][0], None
+        flight = self._flights.get(key)
+        if flight is None:
+            self._flights[key] = _Flight()
+            self._metrics["misses"] += 1
+            return False, None, None
+        self._metrics["waits"] += 1
+        return False, None, flight
+
+    def _finish(self, key, failed: bool):
+        with self._lock:
+            flight = self._flights.pop(key)
+        flight.finish(failed)
+
+    def get_or_compute(self, key, compute: Callable[[], Any]) -> tuple[Any, bool]:
+        """
+        Returns the cached value of key, computing it with compute() if no other
+        caller is already doing so, and whether the value came from the cache.
+        If the computation fails in another thread, the waiting callers retry it.
+        """
+        while True:
+            with self._lock:
+                hit, value, flight = self._lookup(key)
+            if hit:
+                return value, True
+            if flight is None:
+                break
+            flight.done.wait()
+            # if it failed it is tried again, the result may also already be evicted
+        token = _COMPUTING.set(_COMPUTING.get() | {key})
+        failed = True
+        try:
+            value = compute()
+            self.put(key, value)
+            failed = False
+            return value, False
+        finally:
+            _COMPUTING.reset(token)
+            self._finish(key, failed)
+
+    async def aget_or_compute(self, key, compute: Callable[[], Awaitable[Any]]) -> tuple[Any, bool]:
+        """
+        get_or_compute for coroutines: await compute() on a miss, and wait for
+        the computations of other callers without blocking the event loop.
+        """
+        while True:
+            with self._lock:
+                hit, value, flight = self._lookup(key)
+                if flight is not None:
+                    loop = asyncio.get_running_loop()
+                    future = loop.create_future()
+                    flight.waiters.append((loop, future))
+            if hit:
+                return value, True
+            if flight is None:
+                break
+            await future
+        token = _COMPUTING.set(_COMPUTING.get() | {key})
+        failed = True
+        try:
+            value = await compute()
+            self.put(key, value)
+            failed = False
+            return value, False
+        finally:
+            _COMPUTING.reset(token)
+            self._finish(key, failed)
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._data.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {**self._metrics, "entries": len(self._data), "bytes": self.nbytes}
+
+
+RESULT_CACHE = ResultCache()
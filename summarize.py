@@ -0,0 +1,191 @@
+"""
+Summaries of post sets too large for one prompt.
+
+`summary_1` puts the distill of every post into one chat call, which stops
+working once the posts no longer fit in the context window. `summary_tree_1`
+instead splits the posts into consecutive chunks of `chunk_size` posts,
+summarizes each chunk with `summary_1`, and merges the partial summaries
+`fan_in` at a time, in a tree (see `utils.tree_chunks`):
+
+    posts 0-159                summary_tree (merges 8)
+    ├── posts 0-19             summary
+    ├── posts 20-39            summary
+    ...
+    └── posts 140-159          summary
+
+Every node is an annotation of its own posts, cached like any other, and the
+chunks only depend on the position of the posts, so changing a post recomputes
+the path from its chunk to the root, and appending posts recomputes the last
+chunks and the root. Keep the posts in a stable order, e.g. by timestamp.
+
+Rendering a node resolves its children one by one, so `summarize` schedules the
+tree as a batch instead: the distills of all posts, then all chunks, then each
+level of merges, every level concurrently (see batch.py). The wall time grows
+with the depth of the tree, log(len(posts) / chunk_size) / log(fan_in) levels,
+not with the number of posts.
+
+    with APIContextManager():
+        print(summarize.summarize(edits))
+
+For a post set that keeps growing, e.g. a live topic, `IncrementalSummary`
+keeps the summary and the posts it covers in a state file. When it is given the
+set again, `summary_update_1` revises the previous summary with the distills of
+the new posts only, at most UPDATE_MAX_POSTS (20) per call. The summary is
+rebuilt from all posts with `summarize` when the policy says the updates may
+have drifted too far: after SUMMARY_MAX_UPDATES (10) updates, or once the set
+grew by SUMMARY_MAX_GROWTH (1.0, i.e. doubled) since the last rebuild. Posts
+that left the set, or a change of the questions, also trigger a rebuild.
+
+    with APIContextManager():
+        print(summarize.IncrementalSummary("topic.json").update(edits))
+"""
+from dataclasses import asdict, dataclass, field
+import json
+import logging
+import math
+import os
+from typing import Iterable
+
+from annotation import api_context_states, batch, post, utils
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+SUMMARY = "summary_1"
+SUMMARY_TREE = "summary_tree_1"
+SUMMARY_UPDATE = "summary_update_1"
+UPDATE_MAX_POSTS = int(os.getenv("SUMMARY_UPDATE_MAX_POSTS", 20))
+MAX_UPDATES = int(os.getenv("SUMMARY_MAX_UPDATES", 10))
+MAX_GROWTH = float(os.getenv("SUMMARY_MAX_GROWTH", 1.0))
+TREE_ARGS = ("model", "temperature", "chunk_size", "fan_in") # passed down the tree by summary_tree_1
+
+
+def tree_layers(edits: Iterable, chunk_size: int, fan_in: int, kwargs: dict) -> tuple[batch.Call, list[list[batch.Call]]]:
+    """
+    The call at the root of the tree, and the calls of the tree by height, chunks first.
+    """
+    levels: list[list[batch.Call]] = []
+
+    def visit(posts: tuple) -> tuple[batch.Call, int]:
+        if len(posts) <= chunk_size:
+            call, height = batch.Call(SUMMARY, posts, {}), 0
+        else:
+            height = 1 + max(visit(part)[1] for part in utils.tree_chunks(posts, chunk_size, fan_in))
+            call = batch.Call(SUMMARY_TREE, posts, kwargs)
+        while len(levels) <= height:
+            levels.append([])
+        levels[height].append(call)
+        return call, height
+
+    root, _ = visit(tuple(edits))
+    return root, levels
+
+def summarize(edits: Iterable, workers=batch.DEFAULT_WORKERS, **kwargs):
+    """
+    The summary of edits, a summary_1 call if there are at most chunk_size of them, and a
+    summary_tree_1 call otherwise. kwargs override the args of summary_tree_1, those of
+    the summary_1 chunks are set through cmdline_args. Should be called in an APIContextManager.
+    """
+    edits = list(edits)
+    f = api_context_states.get_supported_annotation(SUMMARY_TREE)
+    args = f._get_overidden_args(**kwargs)
+    # the same args the template passes to its children, so that they are the same calls
+    tree_kwargs = {key: args[key] for key in TREE_ARGS}
+    root, levels = tree_layers(edits, args["chunk_size"], args["fan_in"], tree_kwargs)
+    post.prefetch(edits)
+    # the chunks with their dependencies (the distills), then one layer per level of merges
+    layers = batch.call_layers(levels[0]) + levels[1:]
+    logger.info(f"Summarizing {len(edits)} posts in {len(levels[0])} chunks and {sum(len(level) for level in levels[1:])} merges over {len(layers)} layers")
+    results, errors = batch.run_layers(layers, workers=workers)
+    if root.key in errors:
+        raise errors[root.key]
+    return results[root.key]
+
+
+@dataclass
+class SummaryState:
+    summary: str = ""
+    posts: list[str] = field(default_factory=list) # sha256 of the posts covered, in order
+    rebuilt_with: int = 0 # posts covered by the last rebuild
+    updates: int = 0 # since the last rebuild
+    questions: list[str] = field(default_factory=list) # hashes of the questions the summary was made with
+
+
+class IncrementalSummary:
+    """
+    A summary kept up to date as posts are appended to a set, see the module docstring.
+    """
+
+    def __init__(self, path: str, max_updates=MAX_UPDATES, max_growth=MAX_GROWTH, update_max_posts=UPDATE_MAX_POSTS, workers=batch.DEFAULT_WORKERS, **kwargs):
+        self.path = path
+        self.max_updates = max_updates
+        self.max_growth = max_growth
+        self.update_max_posts = update_max_posts
+        self.workers = workers
+        self.kwargs = kwargs # args of summary_tree_1 for rebuilds
+        self.state = self.load()
+
+    def __repr__(self):
+        return f"IncrementalSummary({self.path})"
+
+    def load(self) -> SummaryState:
+        if not os.path.exists(self.path):
+            return SummaryState()
+        with open(self.path, "rt") as f:
+            return SummaryState(**json.load(f))
+
+    def save(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "wt") as f:
+            json.dump(asdict(self.state), f)
+        os.replace(tmp, self.path)
+
+    def _questions(self) -> list[str]:
+        return [api_context_states.get_supported_annotation(name).sha256_quest for name in (SUMMARY, SUMMARY_TREE, SUMMARY_UPDATE)]
+
+    def needs_rebuild(self, keys: list[str]) -> str | None:
+        """
+        Why the summary of the posts with these keys has to be rebuilt rather than updated, if it does.
+        """
+        state = self.state
+        if not state.posts:
+            return "no summary yet"
+        if keys[:len(state.posts)] != state.posts:
+            return "posts were removed or reordered"
+        if state.questions != self._questions():
+            return "the summary questions changed"
+        new = len(keys) - len(state.posts)
+        updates = state.updates + math.ceil(new / self.update_max_posts)
+        if updates > self.max_updates:
+            return f"{updates} updates since the last rebuild"
+        if len(keys) > state.rebuilt_with * (1 + self.max_growth):
+            return f"grew from {state.rebuilt_with} to {len(keys)} posts since the last rebuild"
+        return None
+
+    def update(self, edits: Iterable) -> str:
+        """
+        The summary of edits, the whole set so far with new posts at the end.
+        Should be called in an APIContextManager.
+        """
+        edits = list(edits)
+        post.prefetch(edits)
+        keys = [edit.sha256 for edit in edits]
+        if keys == self.state.posts:
+            return self.state.summary
+        reason = self.needs_rebuild(keys)
+        if reason is not None:
+            logger.info(f"Rebuilding the summary of {len(edits)} posts: {reason}")
+            summary = str(summarize(edits, workers=self.workers, **self.kwargs))
+            self.state = SummaryState(summary, keys, len(keys), 0, self._questions())
+        else:
+            new = edits[len(self.state.posts):]
+            f = api_context_states.get_supported_annotation(SUMMARY_UPDATE)
+            summary, updates = self.state.summary, self.state.updates
+            for i in range(0, len(new), self.update_max_posts):
+                # each call is cached under its posts and the summary it revises
+                summary = str(f(*new[i:i + self.update_max_posts], previous=summary))
+                updates += 1
+            logger.info(f"Updated the summary with {len(new)} new posts in {updates - self.state.updates} calls")
+            self.state = SummaryState(summary, keys, self.state.rebuilt_with, updates, self.state.questions)
+        self.save()
+        return self.state.summary
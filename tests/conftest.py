@@ -0,0 +1,37 @@
+# the tests import the package as `annotation`, like the rest of the code, whatever the checkout is called
+import os
+import pathlib
+import sys
+import tempfile
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+
+# nothing is reached at these defaults, the tests start local stand-ins (mastodon_stub.py, jena_stub.py)
+os.environ.setdefault("MASTODON_API_URL", "http://127.0.0.1:9/api")
+os.environ.setdefault("RDF_URI", "http://127.0.0.1:9")
+os.environ.setdefault("PROMPT_FOLDER", str(ROOT / "questions"))
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+# few loop threads, so that work that holds them while waiting on other work hangs the tests
+os.environ.setdefault("AIO_THREADS", "4")
+
+try:
+    import annotation # noqa: F401
+except ImportError:
+    # through sys.path rather than sys.modules, so that worker processes started by the tests find it too
+    if ROOT.name == "annotation":
+        sys.path.insert(0, str(ROOT.parent))
+    else:
+        link = pathlib.Path(tempfile.mkdtemp()) / "annotation"
+        link.symlink_to(ROOT, target_is_directory=True)
+        sys.path.insert(0, str(link.parent))
+
+
+def write_question(folder, fullname, body):
+    path = folder / f"{fullname}.yaml"
+    path.write_text(body)
+    # a new mtime even within the resolution of the filesystem clock, so that the registry sees the change
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+def static_question(value, header="cache: local\n"):
+    return f"{header}---\nmethod: static\nvalue: \"{value}\"\n"
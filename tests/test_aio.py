@@ -0,0 +1,72 @@
+import asyncio
+import threading
+
+from conftest import static_question, write_question
+
+from annotation import aio, annotation, api_context_manager, post
+from annotation.mastodon_stub import MastodonStub
+
+
+def test_nested_renders_do_not_starve_the_thread_pool(tmp_path):
+    # references under {% if %} are not prefetched, so rendering resolves them and blocks on them
+    write_question(tmp_path, "leaf_1_0", static_question("LEAF {{ post }}"))
+    write_question(tmp_path, "mid_1_0", static_question("{% if true %}MID {{ post.leaf }}{% endif %}"))
+    write_question(tmp_path, "top_1_0", static_question("{% if true %}TOP {{ post.mid }}{% endif %}"))
+    n = 4 * aio.AIO_THREADS
+    edits = [post.EditFromStr(f"nested {i}") for i in range(n)]
+
+    async def annotate_all():
+        with api_context_manager.APIContextManager(prompt_folder=str(tmp_path), write_cache=False) as context:
+            top = context.supported_annotations["top"]
+            return await asyncio.gather(*[top.acall(edit) for edit in edits])
+
+    results = aio.submit(annotate_all).result(timeout=60)
+    assert [str(r) for r in results] == [f"TOP MID LEAF nested {i}" for i in range(n)]
+
+
+def test_posts_are_not_fetched_on_the_loop(tmp_path, monkeypatch):
+    write_question(tmp_path, "echo_1_0", static_question("ECHO {{ post }}"))
+    fetched_on_loop = []
+    request_json = post._request_json
+
+    def recording_request_json(url, params=None):
+        fetched_on_loop.append(aio.on_loop_thread())
+        return request_json(url, params)
+
+    monkeypatch.setattr(post, "_request_json", recording_request_json)
+    statuses = {"loop0": {"id": "loop0", "in_reply_to_id": None, "created_at": "2024-05-01T12:00:00.000Z",
+                          "edited_at": None, "content": "<p>unloaded</p>"}}
+    with MastodonStub(statuses) as stub:
+        with api_context_manager.APIContextManager(prompt_folder=str(tmp_path), mastodon_url=stub.url, write_cache=False) as context:
+            edit = post.Post("loop0").latest()
+            assert not edit.is_loaded
+            assert str(context.supported_annotations["echo"](edit)).split() == ["ECHO", "unloaded"]
+    assert fetched_on_loop and not any(fetched_on_loop)
+
+
+def test_renders_reuse_a_bounded_pool_per_depth(tmp_path, monkeypatch):
+    write_question(tmp_path, "leaf_1_0", static_question("LEAF {{ post }}"))
+    write_question(tmp_path, "mid_1_0", static_question("{% if true %}MID {{ post.leaf }}{% endif %}"))
+    write_question(tmp_path, "top_1_0", static_question("{% if true %}TOP {{ post.mid }}{% endif %}"))
+    monkeypatch.setenv("RENDER_CONCURRENCY", "2")
+    monkeypatch.setattr(aio, "_RENDER_EXECUTORS", {})
+    threads = set()
+    render_jinja2 = annotation.Annotation._render_jinja2
+
+    def recording_render_jinja2(self, *posts, **interpolation_args):
+        threads.add(threading.current_thread())
+        return render_jinja2(self, *posts, **interpolation_args)
+
+    monkeypatch.setattr(annotation.Annotation, "_render_jinja2", recording_render_jinja2)
+    n = 4 * aio.AIO_THREADS
+    edits = [post.EditFromStr(f"bounded {i}") for i in range(n)]
+
+    async def annotate_all():
+        with api_context_manager.APIContextManager(prompt_folder=str(tmp_path), write_cache=False) as context:
+            top = context.supported_annotations["top"]
+            return await asyncio.gather(*[top.acall(edit) for edit in edits])
+
+    results = aio.submit(annotate_all).result(timeout=60)
+    assert [str(r) for r in results] == [f"TOP MID LEAF bounded {i}" for i in range(n)]
+    # 3 * n renders, on at most 2 threads for each of the 3 depths
+    assert len(threads) <= 6
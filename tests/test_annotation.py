@@ -0,0 +1,122 @@
+import json
+
+from conftest import static_question, write_question
+
+from annotation import aio, annotation, api_context_manager, cache, invalidation, llm_response, post, registry
+from annotation.jena_stub import JenaStub
+from annotation.mastodon_stub import MastodonStub
+
+
+def test_memory_cache_checks_dependencies_after_reload(tmp_path):
+    write_question(tmp_path, "mid_1_0", static_question("MID {{ post }}"))
+    write_question(tmp_path, "top_1_0", static_question("TOP {{ post.mid }}"))
+    registry.get_registry(str(tmp_path)).refresh_interval = 0
+    edit = post.EditFromStr("post 1")
+
+    def call(name):
+        with api_context_manager.APIContextManager(prompt_folder=str(tmp_path), write_cache=False) as context:
+            return str(context.supported_annotations[name](edit))
+
+    assert call("top") == "TOP MID post 1"
+    write_question(tmp_path, "mid_1_0", static_question("CHANGED {{ post }}"))
+    assert call("mid") == "CHANGED post 1"
+    assert call("top") == "TOP CHANGED post 1"
+
+
+def test_command_line_args_are_recorded_for_reannotation(tmp_path):
+    write_question(tmp_path, "scored_1_0", "args:\n  scale: 1\n---\nmethod: static\nvalue: \"{{ scale }} {{ post }}\"\n")
+    edit = post.EditFromStr("post 2")
+    with JenaStub() as stub:
+        with api_context_manager.APIContextManager(prompt_folder=str(tmp_path), rdf_uri=stub.url, cmdline_args={"scored": {"scale": 5}}) as context:
+            assert str(context.supported_annotations["scored"](edit)) == "5 post 2"
+        (call_args,) = [o for _, p, o in stub.triples if p == "annot:call_args"]
+        cached = invalidation.CachedAnnotation("annot:0", "scored", 1, 0, "", "", "", call_args=json.loads(json.loads(call_args)),
+                                                  posts={0: ("0", "", "post 2")})
+        call = cached.call()
+        assert call.kwargs == {"scale": 5}
+        # repeated without the command line, it is the same call
+        with api_context_manager.APIContextManager(prompt_folder=str(tmp_path), rdf_uri=stub.url, read_cache=False) as context:
+            assert str(context.supported_annotations[call.name](*call.posts, **call.kwargs)) == "5 post 2"
+        call_hashes = [o for _, p, o in stub.triples if p == "annot:call_hash"]
+    assert len(call_hashes) == 2 and len(set(call_hashes)) == 1
+
+
+def samples(text, ranks):
+    return llm_response.LLMOutput([llm_response.LLMResponse(f"{text} {i}", i, -1.0, f"{text} {i}") for i in ranks])
+
+def test_more_samples_are_not_answered_from_the_request_cache(tmp_path, monkeypatch):
+    write_question(tmp_path, "sampled_1_0", "args:\n  num_answers: 5\n---\nprompt:\n  - user: \"{{ post }}\"\nlegal_answer_type: str\nnum_answers: {{ num_answers }}\n")
+    sent = []
+
+    async def aget_responses(method, **kwargs):
+        sent.append(kwargs["num_answers"])
+        return samples("new", range(kwargs["num_answers"]))
+
+    # the 5 more samples are asked for with the request that the 5 cached ones were
+    monkeypatch.setattr(annotation, "get_cached_request", lambda request_hash: samples("old", range(5)))
+    monkeypatch.setattr(annotation.llm_annot, "aget_responses", aget_responses)
+    annot = annotation.Annotation(str(tmp_path / "sampled_1_0.yaml"), "sampled", 1, 0)
+    with api_context_manager.APIContextManager(prompt_folder=str(tmp_path), request_cache="always", write_cache=False):
+        response = aio.run(annot._execute_prompt, {"method": "openai", "prompt": [{"user": "post"}], "legal_answer_type": "str"},
+                           {"num_answers": 10}, samples=(samples("old", range(5)), 5))
+    assert sent == [5]
+    assert [(r.rank, r.annotation) for r in response.responses] == [(i, f"old {i}") for i in range(5)] + [(5 + i, f"new {i}") for i in range(5)]
+    assert response.request_hash is None
+
+
+def test_cached_samples_cover_num_answers(tmp_path, monkeypatch):
+    write_question(tmp_path, "sampled_1_0", "args:\n  num_answers: 5\n---\nprompt:\n  - user: \"{{ post }}\"\nlegal_answer_type: str\nnum_answers: {{ num_answers }}\n")
+    # annotations of the same call with 5 and 10 samples, the first of the 5 was not a legal answer
+    cached = {"<resp:5>": [1, 2, 3, 4], "<resp:10>": range(10)}
+
+    def get_bindings(command):
+        if "annot:sample_hash" not in command:
+            return [] # no dependencies
+        return [{"annot": {"value": f"annot:{n}"}, "resp": {"value": f"resp:{n}"}, "n": {"value": str(n)},
+                 "time": {"value": "2024-05-01T12:00:00+00:00"}} for n in (5, 10)]
+
+    monkeypatch.setattr(cache, "get_bindings", get_bindings)
+    monkeypatch.setattr(llm_response, "get_cached_response", lambda uri: samples(uri, cached[uri]))
+    annot = annotation.Annotation(str(tmp_path / "sampled_1_0.yaml"), "sampled", 1, 0)
+
+    def cached_samples(num_answers):
+        response, _, _, covered = annot.get_cached_samples({"post0": "post", "num_answers": num_answers})
+        return [r.annotation for r in response.responses] if response is not None else None, covered
+
+    with api_context_manager.APIContextManager(prompt_folder=str(tmp_path)):
+        # the fewest samples that cover the call, truncated to it
+        assert cached_samples(3) == (["<resp:5> 1", "<resp:5> 2"], 5)
+        assert cached_samples(7) == ([f"<resp:10> {i}" for i in range(7)], 10)
+        # or all of the most samples, to be completed
+        assert cached_samples(12) == ([f"<resp:10> {i}" for i in range(10)], 10)
+        # the first sample is not legal
+        assert cached_samples(1) == (None, 0)
+
+
+def test_dedupe_modes_share_call_hashes_by_content(tmp_path):
+    def status(mastodon_id, content, in_reply_to_id=None):
+        return {"id": mastodon_id, "in_reply_to_id": in_reply_to_id, "created_at": "2024-05-01T12:00:00.000Z", "edited_at": None,
+                "content": content, "spoiler_text": "", "sensitive": False, "language": "en", "visibility": "public"}
+
+    # the same reply under roots that say the same thing, and under one that does not
+    statuses = {"root1": status("root1", "<p>a root</p>"),
+                "root2": status("root2", "<p>a  root</p>"),
+                "root3": status("root3", "<p>another root</p>"),
+                "reply1": status("reply1", "<p>same &amp; reply</p>", "root1"),
+                "reply2": status("reply2", "<p>same &   reply</p>", "root2"),
+                "reply3": status("reply3", "same &amp; reply", "root3")}
+    for dedupe in ["content", "thread"]:
+        write_question(tmp_path, f"{dedupe}_1_0", static_question("{{ post }}", header=f"cache: local\ndedupe: {dedupe}\n"))
+    write_question(tmp_path, "plain_1_0", static_question("{{ post }}"))
+    with MastodonStub(statuses) as stub:
+        with api_context_manager.APIContextManager(prompt_folder=str(tmp_path), mastodon_url=stub.url, write_cache=False) as context:
+            replies = post.latest_edits(["reply1", "reply2", "reply3"])
+
+            def call_hashes(name):
+                f = context.supported_annotations[name]
+                return [f.sha256_call(f._hash_args((reply,), f._augment_args_for_interpolation(reply))) for reply in replies]
+
+            content, thread, plain = call_hashes("content"), call_hashes("thread"), call_hashes("plain")
+    assert len(set(content)) == 1
+    assert thread[0] == thread[1] and thread[1] != thread[2]
+    assert len(set(plain)) == 3
@@ -0,0 +1,44 @@
+import time
+
+import pytest
+
+from conftest import static_question, write_question
+
+from annotation import api_context_manager, batch, post
+
+
+def test_worker_processes_gather_their_chunks(tmp_path):
+    # each render takes a second, 8 calls on one process take 8s unless they are in flight together
+    write_question(tmp_path, "slow_1_0", static_question("SLOW {{ __import__('time').sleep(1) }}{{ post }}"))
+    edits = [post.EditFromStr(f"slow {i}") for i in range(8)]
+    with api_context_manager.APIContextManager(prompt_folder=str(tmp_path), write_cache=False):
+        start = time.time()
+        results = batch.annotate_batch("slow", [(edit,) for edit in edits], workers=8, processes=1)
+        elapsed = time.time() - start
+    assert [str(r) for r in results] == [f"SLOW Noneslow {i}" for i in range(8)]
+    assert elapsed < 6
+
+
+def layer_names(layers):
+    return [sorted((call.name, " ".join(str(p) for p in call.posts)) for call in layer) for layer in layers]
+
+def test_calls_are_layered_by_their_dependencies(tmp_path):
+    write_question(tmp_path, "leaf_1_0", static_question("LEAF {{ post }}"))
+    write_question(tmp_path, "mid_1_0", static_question("MID {{ post.leaf }}"))
+    write_question(tmp_path, "pair_1_0", static_question("PAIR {{ post0.mid }} {{ post1.leaf }}"))
+    # extra is only scheduled speculatively, leaf does not declare scale and nosuch is not a question
+    write_question(tmp_path, "top_1_0", static_question("TOP {{ post.mid }} {{ post0.pair(post1) }}{% if false %}{{ post.extra }}{% endif %}"
+                                                         "{{ post.leaf(scale=2) }}{{ post.nosuch }}"))
+    write_question(tmp_path, "extra_1_0", static_question("EXTRA {{ post }}"))
+    a, b = post.EditFromStr("a"), post.EditFromStr("b")
+    with api_context_manager.APIContextManager(prompt_folder=str(tmp_path), write_cache=False):
+        calls = [batch.Call("top", (a, b), {}), batch.Call("mid", (a,), {})]
+        assert layer_names(batch.call_layers(calls)) == [[("leaf", "a"), ("leaf", "b")], [("mid", "a")], [("pair", "a b")], [("top", "a b")]]
+        assert layer_names(batch.call_layers(calls, speculative=True))[0] == [("extra", "a"), ("leaf", "a"), ("leaf", "b")]
+
+def test_cyclic_calls_are_not_layered(tmp_path):
+    write_question(tmp_path, "ping_1_0", static_question("PING {{ post.pong }}"))
+    write_question(tmp_path, "pong_1_0", static_question("PONG {{ post.ping }}"))
+    with api_context_manager.APIContextManager(prompt_folder=str(tmp_path), write_cache=False):
+        with pytest.raises(RecursionError):
+            batch.call_layers([batch.Call("ping", (post.EditFromStr("a"),), {})])
@@ -0,0 +1,31 @@
+import pytest
+
+from annotation import aio, cassette
+
+
+def test_async_exchanges_are_recorded_off_the_loop(tmp_path, monkeypatch):
+    tape = cassette.Cassette(str(tmp_path / "run.sqlite"))
+    recorded_on_loop = []
+    record = tape._record
+
+    def recording(*args):
+        recorded_on_loop.append(aio.on_loop_thread())
+        return record(*args)
+
+    monkeypatch.setattr(tape, "_record", recording)
+
+    async def answer():
+        return {"0": {"text": "yes", "logprob": -0.1}}
+
+    request = {"messages": [{"role": "user", "content": "?"}]}
+    assert aio.submit(tape.aexchange, "llm", request, answer, "record").result(timeout=30) == {"0": {"text": "yes", "logprob": -0.1}}
+    assert recorded_on_loop == [False]
+
+    async def unreachable():
+        raise AssertionError("replayed exchanges are not requested")
+
+    replayed = cassette.Cassette(str(tmp_path / "run.sqlite"))
+    assert aio.submit(replayed.aexchange, "llm", request, unreachable, "replay").result(timeout=30) == {"0": {"text": "yes", "logprob": -0.1}}
+    with pytest.raises(cassette.CassetteMiss):
+        aio.submit(replayed.aexchange, "llm", {"messages": []}, unreachable, "replay").result(timeout=30)
+    assert replayed.counts == {"llm replayed": 1}
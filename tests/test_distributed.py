@@ -0,0 +1,96 @@
+import time
+
+from conftest import static_question, write_question
+
+from annotation import api_context_manager, api_context_states, cache, distributed, post
+from annotation.jena_stub import JenaStub
+from annotation.mastodon_stub import MastodonStub
+
+
+def items(n):
+    return [distributed.WorkItem("echo", ({"content": f"text {i}"},)) for i in range(n)]
+
+# cached in jena, unlike cache: local questions
+ECHO = static_question("ECHO {{ post }}", header="args: {}\n")
+
+
+def test_expired_leases_are_taken_over_with_a_new_token(tmp_path):
+    store = distributed.LeaseStore(str(tmp_path / "jobs.sqlite"))
+    assert store.submit("job", items(3)) == 3
+    assert store.submit("job", items(3)) == 0
+
+    (first, *_) = store.acquire("job", "a", limit=1, lease_seconds=0.2)
+    assert first.token == 1
+    # held by a, the other items are free
+    assert first.item_id not in [lease.item_id for lease in store.acquire("job", "b", limit=3)]
+
+    time.sleep(0.3)
+    (taken,) = store.acquire("job", "c", limit=1)
+    assert (taken.item_id, taken.token) == (first.item_id, 2)
+    # a's lease is fenced off
+    assert store.heartbeat("job", "a", [first]) == [first]
+    assert not store.complete("job", first, "a")
+    assert not store.fail("job", first, "a", "late")
+    assert store.complete("job", taken, "c")
+    assert store.status("job")["done"] == 1
+
+def test_failed_items_are_retried_then_recorded(tmp_path):
+    store = distributed.LeaseStore(str(tmp_path / "jobs.sqlite"))
+    store.submit("job", items(1))
+    for attempt in range(3):
+        (lease,) = store.acquire("job", "a")
+        assert lease.token == attempt + 1
+        assert store.fail("job", lease, "a", "ValueError: boom", max_attempts=3)
+    assert store.acquire("job", "a") == []
+    assert store.status("job") == {"items": 1, "done": 0, "failed": 1, "leased": 0, "pending": 0}
+    assert store.errors("job") == [(items(1)[0].id, "ValueError: boom")]
+
+def test_annotations_of_a_job_are_written_once(tmp_path):
+    write_question(tmp_path, "echo_1_0", ECHO)
+    edit = post.EditFromStr("text 0")
+    with JenaStub() as stub:
+        with api_context_manager.APIContextManager(prompt_folder=str(tmp_path), rdf_uri=stub.url) as context:
+            context = context.replace(annotation_namespace="job:once")
+            # a worker that lost its lease and the one that took it over both write the call
+            for _ in range(2):
+                api_context_states.get_result_cache().clear()
+                assert str(context.run(context.supported_annotations["echo"], edit)) == "ECHO text 0"
+            assert cache.insert_triples_once("annot:other", ["annot:other", "annot:run_by", '"test"'])
+            cache.insert_triples_once("annot:other", ["annot:other", "annot:run_by", '"test"'])
+        annotations = stub.subjects("annot:")
+    assert len(annotations) == 2 and annotations["annot:other"] == 1
+    assert stub.requests["skipped"] == 2
+
+def test_worker_processes_complete_each_item_once(tmp_path, monkeypatch):
+    write_question(tmp_path, "echo_1_0", ECHO)
+    monkeypatch.setenv("LEASE_POLL_SECONDS", "0.2")
+    path = str(tmp_path / "jobs.sqlite")
+    store = distributed.LeaseStore(path)
+    store.submit("job", items(30))
+    # a worker that died holding leases
+    dead = store.acquire("job", "dead", limit=5, lease_seconds=1)
+    with JenaStub() as stub:
+        exitcodes = distributed.work_processes(path, "job", 0, 3, 3, workers=4, prompt_folder=str(tmp_path), rdf_uri=stub.url)
+        annotations = stub.subjects("annot:")
+    assert exitcodes == [0, 0, 0]
+    assert store.status("job") == {"items": 30, "done": 30, "failed": 0, "leased": 0, "pending": 0}
+    owners = dict(store.connection.execute("SELECT item, owner FROM completions WHERE job = 'job'").fetchall())
+    assert len(owners) == 30 and all(owners[lease.item_id] != "dead" for lease in dead)
+    # one annotation per item, each written in a single update
+    assert len(annotations) == 30 and len(set(annotations.values())) == 1
+
+def test_posts_are_pinned_to_their_edit_when_submitted(tmp_path):
+    created = {"id": "pin0", "in_reply_to_id": None, "created_at": "2024-05-01T12:00:00.000Z", "edited_at": None, "content": "<p>first</p>"}
+    store = distributed.LeaseStore(str(tmp_path / "jobs.sqlite"))
+    with MastodonStub({"pin0": created}) as stub:
+        with api_context_manager.APIContextManager(mastodon_url=stub.url):
+            assert store.submit("job", [distributed.WorkItem("echo", ({"id": "pin0"},))]) == 1
+    (lease,) = store.acquire("job", "a")
+    assert lease.item.posts == ({"id": "pin0", "timestamp": "2024-05-01T12:00:00.000Z"},)
+    # a worker that takes the item over after the post was edited still annotates the first edit
+    (edit,) = lease.item.call().posts
+    assert (edit.mastodon_id, str(edit.timestamp)) == ("pin0", "2024-05-01T12:00:00.000Z")
+    # and the same manifest submitted again is the same item
+    with MastodonStub({"pin0": created}) as stub:
+        with api_context_manager.APIContextManager(mastodon_url=stub.url):
+            assert store.submit("job", [distributed.WorkItem("echo", ({"id": "pin0"},))]) == 0
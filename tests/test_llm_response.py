@@ -0,0 +1,25 @@
+from annotation import llm_response
+
+
+def output(*ranks):
+    # ranks come back as strings from jena
+    return llm_response.LLMOutput([llm_response.LLMResponse(f"answer {rank}", str(rank), -1.0, f"answer {rank}") for rank in ranks],
+                                  additional_info={"model": "gpt-4o"})
+
+def test_truncated_keeps_the_first_samples_in_rank_order():
+    # samples 1 and 4 were not legal answers
+    samples = output(3, 0, 5, 2)
+    assert [r.rank for r in samples.truncated(3).responses] == ["0", "2"]
+    assert [r.rank for r in samples.truncated(10).responses] == ["0", "2", "3", "5"]
+    assert samples.truncated(3).additional_info == {"model": "gpt-4o"}
+
+def test_truncated_without_a_legal_sample_is_none():
+    assert output(3, 1).truncated(1) is None
+    assert output().truncated(5) is None
+
+def test_merged_ranks_new_samples_after_the_cached_ones():
+    merged = output(1, 0, 4).merged(output(2, 0), offset=5)
+    assert [(r.rank, r.annotation) for r in merged.responses] == [(0, "answer 0"), (1, "answer 1"), (4, "answer 4"),
+                                                                  (5, "answer 0"), (7, "answer 2")]
+    assert merged.additional_info == {"model": "gpt-4o"}
+    assert [r.rank for r in merged.truncated(6).responses] == [0, 1, 4, 5]
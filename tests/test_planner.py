@@ -0,0 +1,46 @@
+import re
+
+from conftest import static_question, write_question
+
+from annotation import annotation, api_context_manager, llm_response, planner, post
+from annotation.jena_stub import JenaStub
+
+
+def cached_call_hashes(query, triples):
+    # answers the bulk lookups of Annotation.cached_call_hashes from the annotations written
+    match = re.search(r"VALUES \?call_hash \{(.*?)\}", query)
+    if match is None:
+        return []
+    written = set(o for _, p, o in triples if p == "annot:call_hash")
+    return [{"call_hash": {"type": "literal", "value": h.strip('"')}} for h in match.group(1).split() if h in written]
+
+def test_plan_counts_hits_and_misses_without_calling_the_llm(tmp_path, monkeypatch):
+    write_question(tmp_path, "echo_1_0", static_question("ECHO {{ post }}"))
+    write_question(tmp_path, "scored_1_0", "args:\n  model: gpt-4o-mini\n---\nmodel: \"{{ model }}\"\nprompt:\n  - user: \"Score {{ post.echo }}\"\n"
+                                           "legal_answer_type: int\nmax_tokens: 1\n")
+    llm_calls = []
+    original_aget_responses = annotation.llm_annot.aget_responses
+
+    async def aget_responses(method, **kwargs):
+        if method != "openai":
+            return await original_aget_responses(method, **kwargs)
+        llm_calls.append(kwargs)
+        return llm_response.LLMOutput([llm_response.LLMResponse(1, 0, -0.1, "1")])
+
+    monkeypatch.setattr(annotation.llm_annot, "aget_responses", aget_responses)
+    edits = [post.EditFromStr(f"planned {i}") for i in range(3)]
+    with JenaStub(answer=cached_call_hashes) as stub:
+        with api_context_manager.APIContextManager(prompt_folder=str(tmp_path), rdf_uri=stub.url) as context:
+            context.supported_annotations["scored"](edits[0])
+        assert len(llm_calls) == 1
+        with api_context_manager.APIContextManager(prompt_folder=str(tmp_path), rdf_uri=stub.url, write_cache=False):
+            plan = planner.plan("scored", [(edit,) for edit in edits], workers=4)
+        writes = stub.requests["update"]
+    assert len(llm_calls) == 1 and writes == stub.requests["update"]
+    assert plan.layers == [["echo"], ["scored"]]
+    echo, scored = plan.questions["echo"], plan.questions["scored"]
+    # local questions are never looked up, and not asked of an LLM
+    assert (echo.calls, echo.hits, echo.misses, echo.llm_calls) == (3, 0, 3, 0)
+    assert (scored.calls, scored.hits, scored.misses, scored.llm_calls) == (3, 1, 2, 2)
+    assert scored.models == {"gpt-4o-mini"} and scored.completion_tokens == 2 and scored.prompt_tokens > 0 and scored.cost > 0
+    assert scored.unrendered == 0
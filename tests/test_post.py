@@ -0,0 +1,92 @@
+import dateutil.parser
+import pytest
+
+from annotation import api_context_manager, post, tokens
+from annotation.mastodon_stub import MastodonStub
+
+
+def status(mastodon_id, content=None, in_reply_to_id=None):
+    return {"id": mastodon_id,
+            "in_reply_to_id": in_reply_to_id,
+            "created_at": "2024-05-01T12:00:00.000Z",
+            "edited_at": None,
+            "content": content if content is not None else f"<p>post {mastodon_id}</p>",
+            "spoiler_text": "",
+            "sensitive": False,
+            "language": "en",
+            "visibility": "public"}
+
+def statuses(prefix, n):
+    return {f"{prefix}{i}": status(f"{prefix}{i}") for i in range(n)}
+
+
+def test_fetch_statuses_in_chunks():
+    with MastodonStub(statuses("chunk", 29)) as stub:
+        with api_context_manager.APIContextManager(mastodon_url=stub.url):
+            out = post.fetch_statuses([f"chunk{i}" for i in range(29)])
+    assert sorted(out) == sorted(f"chunk{i}" for i in range(29))
+    # the probe, then 29 ids in chunks of 20
+    assert stub.requests == {"statuses": 3}
+
+def test_fetch_statuses_without_batch_endpoint():
+    with MastodonStub(statuses("single", 5), batch=False) as stub:
+        with api_context_manager.APIContextManager(mastodon_url=stub.url):
+            out = post.fetch_statuses([f"single{i}" for i in range(5)])
+    assert sorted(out) == sorted(f"single{i}" for i in range(5))
+    assert stub.requests == {"statuses": 1, "status": 5}
+
+@pytest.mark.parametrize("batch", [True, False])
+def test_fetch_statuses_leaves_out_missing(batch):
+    prefix = f"missing{batch}"
+    with MastodonStub(statuses(prefix, 3), batch=batch) as stub:
+        with api_context_manager.APIContextManager(mastodon_url=stub.url):
+            out = post.fetch_statuses([f"{prefix}0", "404", f"{prefix}2"])
+            assert sorted(out) == [f"{prefix}0", f"{prefix}2"]
+            with pytest.raises(post.RecordNotFoundError):
+                post.latest_edits([f"{prefix}0", "404"])
+
+def test_latest_edits_and_prefetch_load_in_batches():
+    data = statuses("batch", 4)
+    data["batchreply"] = status("batchreply", in_reply_to_id="batch0")
+    with MastodonStub(data) as stub:
+        with api_context_manager.APIContextManager(mastodon_url=stub.url):
+            edits = post.latest_edits(["batch1", "batch2"])
+            assert [edit.content.strip() for edit in edits] == ["post batch1", "post batch2"]
+            assert stub.requests == {"statuses": 2}
+
+            timestamp = dateutil.parser.parse(data["batchreply"]["created_at"])
+            unloaded = [post.Edit.new("batch3", timestamp), post.Edit.new("batchreply", timestamp)]
+            post.prefetch(unloaded)
+            assert all(edit.is_loaded for edit in unloaded)
+            assert unloaded[1].parent.content.strip() == "post batch0"
+    # one request for both edits, the single parent is looked up by itself
+    assert stub.requests == {"statuses": 3, "status": 1}
+
+def test_data_is_fetched_once():
+    with MastodonStub(statuses("data", 1)) as stub:
+        with api_context_manager.APIContextManager(mastodon_url=stub.url):
+            edit = post.latest_edits(["data0"])[0]
+            before = sum(stub.requests.values())
+            assert edit.visibility == "public"
+            assert edit.data["visibility"] == "public"
+            assert edit.visibility == "public"
+    assert sum(stub.requests.values()) == before + 1
+
+def test_within_budget_keeps_the_root_and_the_latest_posts():
+    # 40 characters are 10 tokens, and each post adds 8 more
+    thread = post.PostList(post.EditFromStr(f"{i:02d}" * 20) for i in range(10))
+    kept = thread.within_budget(100, keep_first=1, keep_last=2)
+    assert [str(p)[:2] for p in kept] == ["00", "06", "07", "08", "09"]
+    assert [str(p)[:2] for p in kept.omitted] == ["01", "02", "03", "04", "05"]
+    # over budget, the root and the latest replies are kept anyway
+    kept = thread.within_budget(10, keep_first=1, keep_last=2)
+    assert [str(p)[:2] for p in kept] == ["00", "08", "09"] and len(kept.omitted) == 7
+    assert post.PostList(thread[:2]).within_budget(0) == thread[:2]
+
+def test_within_budget_does_not_fall_back_to_another_tokenizer():
+    thread = post.PostList([post.EditFromStr("a" * 40)] * 4)
+    with pytest.raises(ValueError):
+        thread.within_budget(100, tokenizer="words")
+    if tokens.tiktoken is None:
+        with pytest.raises(ImportError):
+            thread.within_budget(100, tokenizer="tiktoken")
@@ -0,0 +1,23 @@
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+import requests
+
+from annotation import ratelimit
+from annotation.mastodon_stub import MastodonStub
+
+
+def test_windows_are_probed_and_paced(tmp_path):
+    statuses = {"1": {"id": "1", "in_reply_to_id": None, "created_at": "2024-05-01T12:00:00.000Z", "edited_at": None, "content": "<p>1</p>"}}
+    scheduler = ratelimit.RateLimitScheduler("stub", coordination_file=str(tmp_path / "ratelimit.json"), backoff=0.1, max_retries=0)
+    # 24 requests of 8 threads at once, 4 requests per window
+    with MastodonStub(statuses, rate_limit=(4, 0.5)) as stub:
+        url = f"{stub.url}/v1/statuses/1"
+        start = time.time()
+        with ThreadPoolExecutor(8) as pool:
+            codes = list(pool.map(lambda _: scheduler.request(lambda: requests.get(url)).status_code, range(24)))
+        elapsed = time.time() - start
+    assert codes == [200] * 24 and stub.requests["throttled"] == 0
+    assert elapsed >= 5 * 0.5
+    metrics = scheduler.metrics()
+    assert metrics["requests"] == 24 and metrics["throttled"] == 0
@@ -0,0 +1,54 @@
+import pytest
+
+from conftest import static_question, write_question
+
+from annotation import api_context_manager, post, summarize
+
+
+@pytest.fixture
+def rebuilds(tmp_path, monkeypatch):
+    # updates append the posts they were sent to the summary, rebuilds list all of them
+    write_question(tmp_path, "summary_1_0", static_question("{{ posts | join(',') }}"))
+    write_question(tmp_path, "summary_tree_1_0", static_question("{{ posts | join(',') }}"))
+    write_question(tmp_path, "summary_update_1_0", static_question("{{ previous }}+{{ posts | join(',') }}", header="cache: local\nargs:\n  previous: ''\n"))
+    out = []
+
+    def rebuild(edits, **kwargs):
+        out.append(",".join(str(edit) for edit in edits))
+        return out[-1]
+
+    monkeypatch.setattr(summarize, "summarize", rebuild)
+    with api_context_manager.APIContextManager(prompt_folder=str(tmp_path), write_cache=False):
+        yield out
+
+def edits(*ids):
+    return [post.EditFromStr(f"p{i}") for i in ids]
+
+
+def test_updates_send_only_the_new_posts(tmp_path, rebuilds):
+    summary = summarize.IncrementalSummary(str(tmp_path / "topic.json"), update_max_posts=2, max_growth=10)
+    assert summary.update(edits(0, 1, 2)) == "p0,p1,p2"
+    assert summary.update(edits(0, 1, 2)) == "p0,p1,p2"
+    assert summary.update(edits(*range(6))) == "p0,p1,p2+p3,p4+p5"
+    # picked up from the state file
+    summary = summarize.IncrementalSummary(str(tmp_path / "topic.json"), update_max_posts=2, max_growth=10)
+    assert summary.update(edits(*range(7))) == "p0,p1,p2+p3,p4+p5+p6"
+    assert rebuilds == ["p0,p1,p2"]
+    assert summary.state.updates == 3 and summary.state.rebuilt_with == 3
+
+@pytest.mark.parametrize("options,sets,expected", [
+    # after max_updates updates
+    ({"max_updates": 2, "update_max_posts": 1, "max_growth": 10}, [(0, 1), (0, 1, 2), (0, 1, 2, 3), (0, 1, 2, 3, 4)], "p0,p1,p2,p3,p4"),
+    # once the set doubled since the last rebuild
+    ({"max_growth": 1.0}, [(0, 1), (0, 1, 2, 3), (0, 1, 2, 3, 4)], "p0,p1,p2,p3,p4"),
+    # when a post left the set
+    ({"max_growth": 10}, [(0, 1, 2), (0, 1, 2, 3), (0, 2, 3)], "p0,p2,p3"),
+])
+def test_summaries_are_rebuilt(tmp_path, rebuilds, options, sets, expected):
+    summary = summarize.IncrementalSummary(str(tmp_path / "topic.json"), **options)
+    for ids in sets[:-1]:
+        summary.update(edits(*ids))
+    assert len(rebuilds) == 1 and summary.state.updates == len(sets) - 2
+    assert summary.update(edits(*sets[-1])) == expected
+    assert rebuilds[1:] == [expected]
+    assert summary.state.updates == 0 and summary.state.rebuilt_with == len(sets[-1])
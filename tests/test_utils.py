@@ -0,0 +1,22 @@
+import pytest
+
+from annotation import utils
+
+
+def test_tree_chunks_splits_into_at_most_fan_in_parts():
+    assert utils.tree_chunks([], 2, 3) == []
+    assert utils.tree_chunks(range(5), 2, 3) == [(0, 1), (2, 3), (4,)]
+    assert utils.tree_chunks(range(6), 2, 3) == [(0, 1), (2, 3), (4, 5)]
+    # one more than fan_in chunks, parts are fan_in times larger
+    assert utils.tree_chunks(range(7), 2, 3) == [(0, 1, 2, 3, 4, 5), (6,)]
+    assert utils.tree_chunks(range(19), 2, 3) == [tuple(range(18)), (18,)]
+
+def test_tree_chunks_keep_the_parts_of_fewer_items():
+    # the first part of the larger set splits into the parts of the smaller one, whose summaries are reused
+    (first, _) = utils.tree_chunks(range(7), 2, 3)
+    assert utils.tree_chunks(first, 2, 3) == utils.tree_chunks(range(6), 2, 3)
+
+@pytest.mark.parametrize("chunk_size, fan_in", [(2, 1), (2, 0), (0, 3), (-1, 3)])
+def test_tree_chunks_rejects_sizes_that_never_cover_the_items(chunk_size, fan_in):
+    with pytest.raises(ValueError):
+        utils.tree_chunks(range(7), chunk_size, fan_in)
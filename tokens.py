@@ -0,0 +1,90 @@
+"""
+Token counts and prices of LLM calls, for estimates.
+
+Estimates count tokens with tiktoken if it is installed, and approximate them
+by 4 characters per token otherwise. What a template renders must not depend on
+what is installed, so budgets in templates name their tokenizer (see
+PostList.within_budget): chars, the approximation, is the same everywhere and
+needs nothing, tiktoken needs the package and the encoding files it downloads
+on first use (or finds in TIKTOKEN_CACHE_DIR). Prices are in US dollars per million tokens,
+and can be extended or overridden with a json object in MODEL_PRICES, e.g.
+MODEL_PRICES='{"my-model": [1.0, 2.0]}' for input and output prices.
+"""
+import functools
+import json
+import logging
+import math
+import os
+
+try:
+    import tiktoken
+except ImportError: # estimates are then rougher
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+CHARS_PER_TOKEN = 4
+TOKENIZERS = ("chars", "tiktoken")
+MESSAGE_OVERHEAD_TOKENS = 4 # role and separators of each chat message
+REPLY_OVERHEAD_TOKENS = 3
+
+# (input, output) in dollars per million tokens, the longest matching prefix of a model name is used
+PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4-turbo": (10.00, 30.00),
+    "gpt-4": (30.00, 60.00),
+    "gpt-3.5-turbo": (0.50, 1.50),
+    "o1-mini": (3.00, 12.00),
+    "o1": (15.00, 60.00),
+}
+PRICES.update({model: tuple(price) for model, price in json.loads(os.getenv("MODEL_PRICES", "{}")).items()})
+
+
+@functools.cache
+def _encoding(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+def count_tokens(text: str, model: str = "gpt-4o", tokenizer: str | None = None) -> int:
+    """
+    Tokens of text, counted by tokenizer (one of TOKENIZERS), or by the best one installed if None.
+    """
+    if tokenizer not in (None, *TOKENIZERS):
+        raise ValueError(f"Unknown tokenizer {tokenizer}, expected one of {', '.join(TOKENIZERS)}")
+    if tokenizer == "tiktoken" and tiktoken is None:
+        raise ImportError("The tiktoken tokenizer needs the tiktoken package")
+    encoding = _encoding(model) if tokenizer != "chars" else None
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text))
+
+def count_prompt_tokens(prompt: list[dict[str, str]], model: str = "gpt-4o") -> int:
+    """
+    Tokens of a prompt in the format of the question files, a list of {role: content}.
+    """
+    tokens = REPLY_OVERHEAD_TOKENS
+    for message in prompt:
+        for role, content in message.items():
+            tokens += MESSAGE_OVERHEAD_TOKENS + count_tokens(str(content), model)
+    return tokens
+
+def price(model: str) -> tuple[float, float] | None:
+    matches = [prefix for prefix in PRICES if model.startswith(prefix)]
+    if not matches:
+        return None
+    return PRICES[max(matches, key=len)]
+
+def cost(model: str, prompt_tokens: int, completion_tokens: int) -> float | None:
+    """
+    Dollar cost of the tokens, None if the price of the model is not known.
+    """
+    p = price(model)
+    if p is None:
+        return None
+    return (prompt_tokens * p[0] + completion_tokens * p[1]) / 1e6
@@ -1,15 +1,18 @@
+from collections import OrderedDict
 import copy
-import functools
 import hashlib
+import html
 import json
 import os
 import re
 from typing import Any
 import jinja2
 import jinja2.nodes
+import yaml
 from annotation import constants
 import logging
 import subprocess
+import threading
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -38,7 +41,6 @@ def escape_first_last_double_quote(s):
         s = s[:-1] + r"\""
     return s 
 
-@functools.cache
 def sha256_hash_by_lines(*docs : str) -> str:
     sha256_hash = hashlib.sha256()
     for document in docs:
@@ -76,12 +78,40 @@ def clean(content:str):
     cleaned_content = re.sub('( )+', ' ', cleaned_content)
     return cleaned_content
 
+def normalize_content(content: str):
+    """
+    Content with markup, entities and whitespace differences removed, for
+    recognizing duplicate posts.
+    """
+    return re.sub(r"\s+", " ", html.unescape(clean(content))).strip()
+
 def render_with_alias(env, template, alias, **kwargs):
     ast = env.parse(template)
     substitute_aliases(ast, alias)
     rendered_string = env.from_string(ast).render(**kwargs)
     return rendered_string
 
+def compile_with_alias(env: jinja2.Environment, template: str, alias: dict[Any, Any], name: str | None = None) -> jinja2.Template:
+    """
+    Compiles template with aliases substituted, once, so that it can be rendered many times.
+    If env has a bytecode cache, the compiled code is stored there under name, so other
+    processes do not need to parse and compile the template again.
+    """
+    bucket = None
+    if env.bytecode_cache is not None and name is not None:
+        bucket = env.bytecode_cache.get_bucket(env, name, None, json.dumps([template, alias], sort_keys=True))
+    code = bucket.code if bucket is not None else None
+    if code is None:
+        ast = substitute_aliases(env.parse(template), alias)
+        code = env.compile(ast, name=name)
+        if bucket is not None:
+            bucket.code = code
+            try:
+                env.bytecode_cache.set_bucket(bucket) # type:ignore
+            except OSError as e:
+                logger.warning(f"Could not store compiled template {name}: {e}")
+    return env.template_class.from_code(env, code, env.make_globals(None))
+
 def substitute_aliases(template: jinja2.nodes.Template, aliases: dict[Any, Any]):
     for node in template.find_all(jinja2.nodes.Getattr):
         if node.attr in aliases:
@@ -125,6 +155,29 @@ def nested_update_dict(old: dict[Any, Any], new: dict[Any, Any], allow_new=False
 def split_yaml_docs(s: str):
     return s.split("\n---")
 
+# libyaml parses rendered documents several times faster than the pure python loader
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+def load_yaml(s: str):
+    """
+    yaml.safe_load, with the libyaml loader when pyyaml was built with it.
+    """
+    return yaml.load(s, Loader=YAML_LOADER)
+
+def tree_chunks(items, chunk_size: int, fan_in: int) -> list[tuple]:
+    """
+    Splits items into at most fan_in consecutive parts of chunk_size * fan_in**k items, the
+    smallest such size that needs no more than fan_in parts. The parts only depend on the
+    position of the items, so changing or appending items changes only the parts they are in.
+    """
+    if chunk_size < 1 or fan_in < 2:
+        raise ValueError(f"tree_chunks needs chunk_size >= 1 and fan_in >= 2, got chunk_size {chunk_size} and fan_in {fan_in}")
+    items = tuple(items)
+    size = chunk_size
+    while size * fan_in < len(items):
+        size *= fan_in
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
 def overload_ops(cls, coersion):
     def override_first(operator):
         def g(*arguments):
@@ -154,6 +207,40 @@ def get_git_branch() -> str:
     return subprocess.check_output(f'cd {os.path.dirname(__file__)}; git rev-parse --abbrev-ref HEAD', shell=True, executable="/bin/bash").decode('ascii').strip()
 
 
+class LRUCache:
+    """
+    A thread safe dict that holds at most maxsize entries, evicting the least recently used.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
 class Quest:
 
     def __init__(self, name=None, major=None, minor=None, sha256=None):